@@ -16,6 +16,10 @@ When initialised, this library binds a handler to the parent charm's `install` a
 events which applies the patch to the cluster. This should ensure that the service ports are
 correct throughout the charm's life.
 
+Only the leader unit patches the service, and it does so again when leadership changes. The hash
+of the last applied service spec is kept in the charm's stored state, so the Kubernetes API is
+only contacted when the desired spec changes, or after an upgrade, when Juju resets the service.
+
 The constructor simply takes a reference to the parent charm, and a list of
 [`lightkube`](https://github.com/gtsystem/lightkube) ServicePorts that each define a port for the
 service. For information regarding the `lightkube` `ServicePort` model, please visit the
@@ -109,6 +113,29 @@ class SomeCharm(CharmBase):
     # ...
 ```
 
+Importing `lightkube` takes a large share of a hook's startup time. To only import it in the
+hooks patching the service, pass a callable returning the ports rather than the ports themselves,
+and import `ServicePort` in that callable:
+
+```python
+from charms.observability_libs.v1.kubernetes_service_patch import KubernetesServicePatch
+
+class SomeCharm(CharmBase):
+  def __init__(self, *args):
+    # ...
+    self.service_patcher = KubernetesServicePatch(self, self._service_ports)
+    # ...
+
+  def _service_ports(self):
+    from lightkube.models.core_v1 import ServicePort
+
+    return [ServicePort(443, name=f"{self.app.name}")]
+```
+
+The lightkube client is created with `lightkube.Client()` when the service is patched. To use
+another one, e.g. a client whose calls the charm records, pass a callable creating it as
+`client`.
+
 Additionally, you may wish to use mocks in your charm's unit testing to ensure that the library
 does not try to make any API calls, or open any files during testing that are unlikely to be
 present, and could break your tests. The easiest way to do this is during your test `setUp`:
@@ -123,18 +150,19 @@ def setUp(self, *unused):
 ```
 """
 
+import hashlib
+import json
 import logging
 from types import MethodType
-from typing import List, Literal, Optional, Union
-
-from lightkube import ApiError, Client
-from lightkube.core import exceptions
-from lightkube.models.core_v1 import ServicePort, ServiceSpec
-from lightkube.models.meta_v1 import ObjectMeta
-from lightkube.resources.core_v1 import Service
-from lightkube.types import PatchType
+from typing import TYPE_CHECKING, Callable, List, Literal, Optional, Union
+
 from ops.charm import CharmBase
-from ops.framework import BoundEvent, Object
+from ops.framework import BoundEvent, Object, StoredState
+
+if TYPE_CHECKING:
+    from lightkube import Client
+    from lightkube.models.core_v1 import ServicePort
+    from lightkube.resources.core_v1 import Service
 
 logger = logging.getLogger(__name__)
 
@@ -146,18 +174,31 @@ LIBAPI = 1
 
 # Increment this PATCH version before using `charmcraft publish-lib` or reset
 # to 0 if you are raising the major API version
-LIBPATCH = 5
+LIBPATCH = 8
 
 ServiceType = Literal["ClusterIP", "LoadBalancer"]
+Ports = Union[List["ServicePort"], Callable[[], List["ServicePort"]]]
+
+
+def __getattr__(name: str):
+    # lightkube takes a large share of a hook's startup time, so `ServicePort` is only imported
+    # for the charms importing it from here
+    if name == "ServicePort":
+        from lightkube.models.core_v1 import ServicePort
+
+        return ServicePort
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 class KubernetesServicePatch(Object):
     """A utility for patching the Kubernetes service set up by Juju."""
 
+    _stored = StoredState()
+
     def __init__(
         self,
         charm: CharmBase,
-        ports: List[ServicePort],
+        ports: Ports,
         service_name: Optional[str] = None,
         service_type: ServiceType = "ClusterIP",
         additional_labels: Optional[dict] = None,
@@ -165,12 +206,14 @@ class KubernetesServicePatch(Object):
         additional_annotations: Optional[dict] = None,
         *,
         refresh_event: Optional[Union[BoundEvent, List[BoundEvent]]] = None,
+        client: Optional[Callable[[], "Client"]] = None,
     ):
         """Constructor for KubernetesServicePatch.
 
         Args:
             charm: the charm that is instantiating the library.
-            ports: a list of ServicePorts
+            ports: a list of ServicePorts, or a callable returning it. A callable defers
+                importing `lightkube` to the hooks actually patching the service.
             service_name: allows setting custom name to the patched service. If none given,
                 application name will be used.
             service_type: desired type of K8s service. Default value is in line with ServiceSpec's
@@ -183,24 +226,33 @@ class KubernetesServicePatch(Object):
             refresh_event: an optional bound event or list of bound events which
                 will be observed to re-apply the patch (e.g. on port change).
                 The `install` and `upgrade-charm` events would be observed regardless.
+            client: an optional callable creating the lightkube client to patch the service
+                with, called only when patching. Defaults to `lightkube.Client`.
         """
         super().__init__(charm, "kubernetes-service-patch")
         self.charm = charm
         self.service_name = service_name if service_name else self._app
-        self.service = self._service_object(
-            ports,
+        self._ports = ports
+        self._service_args = (
             service_name,
             service_type,
             additional_labels,
             additional_selectors,
             additional_annotations,
         )
+        self._service: Optional["Service"] = None
+        self._new_client = client
+        self._namespace_name: Optional[str] = None
+        # hash of the last service spec applied by this unit
+        self._stored.set_default(spec_hash="")
 
         # Make mypy type checking happy that self._patch is a method
         assert isinstance(self._patch, MethodType)
         # Ensure this patch is applied during the 'install' and 'upgrade-charm' events
         self.framework.observe(charm.on.install, self._patch)
-        self.framework.observe(charm.on.upgrade_charm, self._patch)
+        self.framework.observe(charm.on.upgrade_charm, self._on_upgrade_charm)
+        # Only the leader patches the service, so a new leader checks it is patched
+        self.framework.observe(charm.on.leader_elected, self._patch)
 
         # apply user defined events
         if refresh_event:
@@ -210,15 +262,23 @@ class KubernetesServicePatch(Object):
             for evt in refresh_event:
                 self.framework.observe(evt, self._patch)
 
+    @property
+    def service(self) -> "Service":
+        """The desired Kubernetes service, built on first use."""
+        if self._service is None:
+            ports = self._ports() if callable(self._ports) else self._ports
+            self._service = self._service_object(ports, *self._service_args)
+        return self._service
+
     def _service_object(
         self,
-        ports: List[ServicePort],
+        ports: List["ServicePort"],
         service_name: Optional[str] = None,
         service_type: ServiceType = "ClusterIP",
         additional_labels: Optional[dict] = None,
         additional_selectors: Optional[dict] = None,
         additional_annotations: Optional[dict] = None,
-    ) -> Service:
+    ) -> "Service":
         """Creates a valid Service representation.
 
         Args:
@@ -236,6 +296,10 @@ class KubernetesServicePatch(Object):
         Returns:
             Service: A valid representation of a Kubernetes Service with the correct ports.
         """
+        from lightkube.models.core_v1 import ServiceSpec
+        from lightkube.models.meta_v1 import ObjectMeta
+        from lightkube.resources.core_v1 import Service
+
         if not service_name:
             service_name = self._app
         labels = {"app.kubernetes.io/name": self._app}
@@ -260,20 +324,47 @@ class KubernetesServicePatch(Object):
             ),
         )
 
+    @property
+    def _spec_hash(self) -> str:
+        """Hash of the desired service spec."""
+        spec = json.dumps(self.service.to_dict(), sort_keys=True)
+        return hashlib.sha256(spec.encode("utf-8")).hexdigest()
+
+    def _on_upgrade_charm(self, event) -> None:
+        # Juju overwrites the service on upgrade, so the last applied spec is not current anymore
+        self._stored.spec_hash = ""
+        self._patch(event)
+
     def _patch(self, _) -> None:
         """Patch the Kubernetes service created by Juju to map the correct port.
 
+        Only the leader patches the service, and only if the desired spec differs from the one
+        it last applied.
+
         Raises:
             PatchFailed: if patching fails due to lack of permissions, or otherwise.
         """
+        if not self.charm.unit.is_leader():
+            return
+        spec_hash = self._spec_hash
+        if spec_hash == self._stored.spec_hash:
+            logger.debug("Kubernetes service '%s' already patched", self.service_name)
+            return
+
+        from lightkube import ApiError
+        from lightkube.core import exceptions
+        from lightkube.resources.core_v1 import Service
+        from lightkube.types import PatchType
+
         try:
-            client = Client()
+            client = self._client()
         except exceptions.ConfigError as e:
             logger.warning("Error creating k8s client: %s", e)
             return
 
         try:
             if self._is_patched(client):
+                self._stored.spec_hash = spec_hash
                 return
             if self.service_name != self._app:
                 self._delete_and_create_service(client)
@@ -284,9 +375,12 @@ class KubernetesServicePatch(Object):
             else:
                 logger.error("Kubernetes service patch failed: %s", str(e))
         else:
+            self._stored.spec_hash = spec_hash
             logger.info("Kubernetes service '%s' patched successfully", self._app)
 
-    def _delete_and_create_service(self, client: Client):
+    def _delete_and_create_service(self, client: "Client"):
+        from lightkube.resources.core_v1 import Service
+
         service = client.get(Service, self._app, namespace=self._namespace)
         service.metadata.name = self.service_name  # type: ignore[attr-defined]
         service.metadata.resourceVersion = service.metadata.uid = None  # type: ignore[attr-defined]   # noqa: E501
@@ -299,10 +393,19 @@ class KubernetesServicePatch(Object):
         Returns:
             bool: A boolean indicating if the service patch has been applied.
         """
-        client = Client()
-        return self._is_patched(client)
+        return self._is_patched(self._client())
+
+    def _client(self) -> "Client":
+        if self._new_client is not None:
+            return self._new_client()
+        from lightkube import Client
+
+        return Client()
+
+    def _is_patched(self, client: "Client") -> bool:
+        from lightkube import ApiError
+        from lightkube.resources.core_v1 import Service
 
-    def _is_patched(self, client: Client) -> bool:
         # Get the relevant service from the cluster
         try:
             service = client.get(Service, name=self.service_name, namespace=self._namespace)
@@ -337,5 +440,7 @@ class KubernetesServicePatch(Object):
         Returns:
             str: A string containing the name of the current Kubernetes namespace.
         """
-        with open("/var/run/secrets/kubernetes.io/serviceaccount/namespace", "r") as f:
-            return f.read().strip()
+        if self._namespace_name is None:
+            with open("/var/run/secrets/kubernetes.io/serviceaccount/namespace", "r") as f:
+                self._namespace_name = f.read().strip()
+        return self._namespace_name
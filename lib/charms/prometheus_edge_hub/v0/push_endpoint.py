@@ -0,0 +1,326 @@
+# Copyright 2022 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""# Prometheus Edge Hub push endpoint library.
+
+This library lets charms push metrics directly to the units of a Prometheus Edge Hub
+application, rather than through the Kubernetes service that load balances over all of them.
+
+Pushing through the service spreads the same series over every unit, so each unit's cache
+fills unevenly. Instead, every unit of the hub publishes its own HTTP and gRPC endpoints over
+the `prometheus_edge_hub_push` interface, and the leader publishes the parameters of a
+consistent-hash ring. Clients hash each metric family name onto the ring and always push that
+family to the unit that owns it. When units join or leave, only the families owned by those
+units move.
+
+## Provider Library Usage
+
+The Prometheus Edge Hub charm instantiates `PushEndpointProvider` with the ports of the hub:
+
+```python
+from charms.prometheus_edge_hub.v0.push_endpoint import PushEndpointProvider
+
+class PrometheusEdgeHubCharm(CharmBase):
+    def __init__(self, *args):
+        super().__init__(*args)
+        # ...
+        self.push_endpoint_provider = PushEndpointProvider(self, http_port=9091, grpc_port=9092)
+```
+
+## Requirer Library Usage
+
+Charms pushing metrics add the relation to their `metadata.yaml`
+
+```yaml
+requires:
+  push-endpoint:
+    interface: prometheus_edge_hub_push
+```
+
+and instantiate `PushEndpointRequirer`, which emits `endpoints_changed` whenever the set of
+hub units changes:
+
+```python
+from charms.prometheus_edge_hub.v0.push_endpoint import PushEndpointRequirer
+
+class SomeCharm(CharmBase):
+    def __init__(self, *args):
+        super().__init__(*args)
+        # ...
+        self.push_endpoint = PushEndpointRequirer(self)
+        self.framework.observe(
+            self.push_endpoint.on.endpoints_changed, self._on_push_endpoints_changed
+        )
+
+    def _on_push_endpoints_changed(self, _):
+        router = self.push_endpoint.router()
+        endpoint = router.route("http_requests_total")
+        # push the "http_requests_total" family to endpoint["http"]
+```
+
+`PushRouter` does not depend on Juju and may also be built by pushers outside of the model,
+from the same data the requirer receives, with `PushRouter(endpoints, vnodes=...)`.
+
+This library is not published on Charmhub yet: charms pushing metrics copy it from the
+prometheus-edge-hub-operator repository rather than with `charmcraft fetch-lib`.
+
+## Relation Data
+
+Each unit of the provider sets the `push_endpoint` key of its unit relation data to a JSON
+object with the `unit`, `http` and `grpc` keys. The leader sets the `hash_ring` key of the
+application relation data to a JSON object with the `algorithm` and `vnodes` keys.
+"""
+
+import bisect
+import hashlib
+import json
+import logging
+import socket
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from ops.charm import CharmBase
+from ops.framework import EventBase, EventSource, Object, ObjectEvents
+
+# The unique Charmhub library identifier, never change it
+LIBID = "b8635ed5b6d34a55adfaa6409c972d42"
+
+# Increment this major API version when introducing breaking changes
+LIBAPI = 0
+
+# Increment this PATCH version before using `charmcraft publish-lib` or reset
+# to 0 if you are raising the major API version
+LIBPATCH = 3
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_RELATION_NAME = "push-endpoint"
+RELATION_INTERFACE_NAME = "prometheus_edge_hub_push"
+
+HASH_ALGORITHM = "md5"
+DEFAULT_VNODES = 128
+
+
+class HashRing:
+    """Consistent-hash ring mapping keys to nodes.
+
+    Each node is placed on the ring `vnodes` times, so that keys are evenly spread and adding
+    or removing a node only moves the keys that node owns.
+    """
+
+    def __init__(self, nodes: Iterable[str] = (), vnodes: int = DEFAULT_VNODES):
+        """Build a ring.
+
+        Args:
+            nodes: initial node names.
+            vnodes: number of points each node takes on the ring.
+        """
+        if vnodes < 1:
+            raise ValueError("vnodes must be a positive integer")
+        self._vnodes = vnodes
+        self._points: List[Tuple[int, str]] = []
+        self._hashes: List[int] = []
+        self._nodes: Set[str] = set()
+        for node in nodes:
+            self.add(node)
+
+    @staticmethod
+    def _hash(key: str) -> int:
+        return int.from_bytes(hashlib.md5(key.encode("utf-8")).digest()[:8], "big")
+
+    @property
+    def nodes(self) -> List[str]:
+        """Sorted list of the nodes on the ring."""
+        return sorted(self._nodes)
+
+    def add(self, node: str) -> None:
+        """Place a node on the ring; adding an existing node is a no-op."""
+        if node in self._nodes:
+            return
+        self._nodes.add(node)
+        self._points.extend(
+            (self._hash("{}#{}".format(node, i)), node) for i in range(self._vnodes)
+        )
+        self._points.sort()
+        self._hashes = [point for point, _ in self._points]
+
+    def remove(self, node: str) -> None:
+        """Take a node off the ring; removing an unknown node is a no-op."""
+        if node not in self._nodes:
+            return
+        self._nodes.remove(node)
+        self._points = [(point, owner) for point, owner in self._points if owner != node]
+        self._hashes = [point for point, _ in self._points]
+
+    def get(self, key: str) -> Optional[str]:
+        """Return the node owning `key`, or None if the ring is empty."""
+        if not self._points:
+            return None
+        index = bisect.bisect(self._hashes, self._hash(key)) % len(self._points)
+        return self._points[index][1]
+
+
+class PushRouter:
+    """Route metric families to the hub unit owning them."""
+
+    def __init__(self, endpoints: Dict[str, dict], vnodes: int = DEFAULT_VNODES):
+        """Build a router.
+
+        Args:
+            endpoints: a mapping of unit names to dictionaries with the "http" and "grpc"
+                endpoints of that unit.
+            vnodes: number of points each unit takes on the hash ring. Must match the value
+                published by the provider for all clients to agree on ownership.
+        """
+        self.endpoints = endpoints
+        self._ring = HashRing(endpoints, vnodes=vnodes)
+
+    def route(self, metric_family: str) -> Optional[dict]:
+        """Return the endpoints of the unit owning `metric_family`, or None if there is none."""
+        unit = self._ring.get(metric_family)
+        return self.endpoints[unit] if unit else None
+
+    def group(self, metric_families: Iterable[str]) -> Dict[str, List[str]]:
+        """Group metric families by the unit owning them.
+
+        Returns:
+            A mapping of unit names to the list of metric families to push to that unit.
+        """
+        groups: Dict[str, List[str]] = {}
+        for family in metric_families:
+            unit = self._ring.get(family)
+            if unit:
+                groups.setdefault(unit, []).append(family)
+        return groups
+
+
+class PushEndpointProvider(Object):
+    """Publish the push endpoints of each hub unit."""
+
+    def __init__(
+        self,
+        charm: CharmBase,
+        relation_name: str = DEFAULT_RELATION_NAME,
+        *,
+        http_port: int,
+        grpc_port: int,
+        vnodes: int = DEFAULT_VNODES,
+    ):
+        """Construct a push endpoint provider.
+
+        Args:
+            charm: the charm that is instantiating the library.
+            relation_name: name of the relation with the `prometheus_edge_hub_push` interface.
+            http_port: port the hub accepts HTTP pushes on.
+            grpc_port: port the hub accepts gRPC pushes on.
+            vnodes: number of points each unit takes on the hash ring.
+        """
+        super().__init__(charm, relation_name)
+        self._charm = charm
+        self._relation_name = relation_name
+        self._http_port = http_port
+        self._grpc_port = grpc_port
+        self._vnodes = vnodes
+
+        events = self._charm.on[relation_name]
+        self.framework.observe(events.relation_joined, self._update_relation_data)
+        self.framework.observe(self._charm.on.leader_elected, self._update_relation_data)
+        self.framework.observe(self._charm.on.upgrade_charm, self._update_relation_data)
+        # the unit address may change when the pod is rescheduled
+        for container in self._charm.meta.containers:
+            pebble_ready = self._charm.on[container.replace("-", "_")].pebble_ready
+            self.framework.observe(pebble_ready, self._update_relation_data)
+
+    def _update_relation_data(self, _) -> None:
+        """Publish the unit endpoints and, from the leader, the ring parameters."""
+        host = socket.getfqdn()
+        endpoint = json.dumps(
+            {
+                "unit": self._charm.unit.name,
+                "http": "http://{}:{}".format(host, self._http_port),
+                "grpc": "{}:{}".format(host, self._grpc_port),
+            },
+            sort_keys=True,
+        )
+        ring = json.dumps({"algorithm": HASH_ALGORITHM, "vnodes": self._vnodes}, sort_keys=True)
+        for relation in self._charm.model.relations[self._relation_name]:
+            relation.data[self._charm.unit]["push_endpoint"] = endpoint
+            if self._charm.unit.is_leader():
+                relation.data[self._charm.app]["hash_ring"] = ring
+
+
+class EndpointsChangedEvent(EventBase):
+    """Event emitted when the set of hub push endpoints changes."""
+
+
+class PushEndpointEvents(ObjectEvents):
+    """Events raised by `PushEndpointRequirer`."""
+
+    endpoints_changed = EventSource(EndpointsChangedEvent)
+
+
+class PushEndpointRequirer(Object):
+    """Collect the push endpoints of a Prometheus Edge Hub application."""
+
+    on = PushEndpointEvents()
+
+    def __init__(self, charm: CharmBase, relation_name: str = DEFAULT_RELATION_NAME):
+        """Construct a push endpoint requirer.
+
+        Args:
+            charm: the charm that is instantiating the library.
+            relation_name: name of the relation with the `prometheus_edge_hub_push` interface.
+        """
+        super().__init__(charm, relation_name)
+        self._charm = charm
+        self._relation_name = relation_name
+
+        events = self._charm.on[relation_name]
+        self.framework.observe(events.relation_changed, self._on_relation_changed)
+        self.framework.observe(events.relation_departed, self._on_relation_changed)
+        self.framework.observe(events.relation_broken, self._on_relation_changed)
+
+    def _on_relation_changed(self, _) -> None:
+        self.on.endpoints_changed.emit()
+
+    @property
+    def endpoints(self) -> Dict[str, dict]:
+        """Mapping of hub unit names to their "http" and "grpc" endpoints."""
+        endpoints = {}
+        for relation in self._charm.model.relations[self._relation_name]:
+            for unit in relation.units:
+                try:
+                    endpoint = json.loads(relation.data[unit].get("push_endpoint", "{}"))
+                    if not isinstance(endpoint, dict):
+                        raise TypeError("not a JSON object")
+                except (ValueError, TypeError) as e:
+                    logger.error("Invalid push endpoint from %s: %s", unit.name, e)
+                    continue
+                if endpoint.get("http") and endpoint.get("grpc"):
+                    endpoints[unit.name] = endpoint
+        return endpoints
+
+    @property
+    def vnodes(self) -> int:
+        """Number of points each hub unit takes on the hash ring."""
+        for relation in self._charm.model.relations[self._relation_name]:
+            if not relation.app:
+                continue
+            try:
+                ring = json.loads(relation.data[relation.app].get("hash_ring", "{}"))
+                if not isinstance(ring, dict):
+                    raise TypeError("not a JSON object")
+                vnodes = int(ring["vnodes"]) if "vnodes" in ring else None
+                if vnodes is not None and vnodes < 1:
+                    raise ValueError("vnodes must be a positive integer")
+            except (ValueError, TypeError) as e:
+                logger.error("Invalid hash ring from %s: %s", relation.app.name, e)
+                continue
+            if ring.get("algorithm", HASH_ALGORITHM) != HASH_ALGORITHM:
+                logger.warning("Unsupported hash ring algorithm: %s", ring["algorithm"])
+            if vnodes is not None:
+                return vnodes
+        return DEFAULT_VNODES
+
+    def router(self) -> PushRouter:
+        """Build a router over the hub units currently related."""
+        return PushRouter(self.endpoints, vnodes=self.vnodes)
@@ -232,6 +232,40 @@ by `jobs()` as follows
             prometheus_scrape_config.append(job)
         ...
 
+The event is only emitted when the scrape jobs, scrape metadata, alert
+rules or unit addresses of the relation actually changed, so a provider
+setting the same relation data again does not cause a reload. The number
+of emissions skipped this way is available as
+`self.metrics_consumer.suppressed_events`.
+
+### Service discovery
+
+With `jobs()` every unit of a metrics provider is a static config of its
+job, so any unit joining or leaving changes the Prometheus configuration
+and needs a reload. Alternatively the targets of the units may be left
+to Prometheus service discovery. `sd_jobs()` returns the same jobs with
+those targets replaced by an `http_sd_configs` or a `file_sd_configs`
+entry, and `target_groups()` returns the target groups of each such job,
+by the name it is discovered under. The jobs only change when the scrape
+jobs of a provider do, while unit changes only change the target groups,
+which Prometheus picks up without a reload.
+
+For `file_sd`, the target groups of each job are written as JSON to
+`<directory>/<name>.json`, e.g. in the Prometheus workload container
+
+    def _on_scrape_targets_changed(self, event):
+        ...
+        scrape_jobs = self.metrics_consumer.sd_jobs(file_sd_dir=TARGETS_DIR)
+        for name, groups in self.metrics_consumer.target_groups().items():
+            container.push(
+                os.path.join(TARGETS_DIR, name + ".json"), json.dumps(groups), make_dirs=True
+            )
+        ...
+
+For `http_sd`, a `TargetGroupServer` serves the target groups of each job
+at `<url>/<name>`. It needs to run in a long lived process, as charm
+hooks are short lived, and be given the target groups with `update()`.
+
 ## Alerting Rules
 
 This charm library also supports gathering alerting rules from all
@@ -309,22 +343,50 @@ over unit relation data using the `prometheus_scrape_unit_name` and
 `scrape_jobs` and `alert_rules` keys in application relation data
 of Metrics provider charms hold eponymous information.
 
+### Compact encoding
+
+A `MetricsEndpointConsumer` advertises the encodings it can decode, as a
+JSON list under the `supported_encodings` key of its application relation
+data. When `compact-v1` is among them, `MetricsEndpointProvider` and
+`MetricsEndpointAggregator` may send `scrape_jobs` and `alert_rules` in that
+encoding instead of plain JSON, whenever it is shorter. A `compact-v1` value
+starts with `compact-v1:` followed by one of
+
+- `j:` and a JSON object `{"refs": [...], "value": ...}`, where every
+  object or list that occurs more than once in the value, such as the
+  topology labels and relabel configs repeated across jobs, is stored once
+  in `refs` and replaced by `{"$ref": <index in refs>}`;
+- `z:` and the same JSON object, compressed with zlib and base64 encoded;
+- `chunks:<n>`, in which case the value is the concatenation of the values
+  of the keys `<key>.0` to `<key>.<n - 1>`, each at most 256 KiB.
+
+Values sent to consumers that do not advertise `compact-v1` are plain JSON.
+
 """  # noqa: W505
 
+import base64
+import functools
+import hashlib
 import ipaddress
 import json
 import logging
 import os
-import platform
+import re
 import socket
-import subprocess
-from collections import OrderedDict
+import zlib
+from collections import Counter, OrderedDict
 from pathlib import Path
-from typing import Dict, List, Optional, Union
+from typing import Any, Dict, List, Mapping, Optional, Union
 
-import yaml
 from ops.charm import CharmBase, RelationRole
-from ops.framework import BoundEvent, EventBase, EventSource, Object, ObjectEvents
+from ops.framework import (
+    BoundEvent,
+    EventBase,
+    EventSource,
+    Object,
+    ObjectEvents,
+    StoredState,
+)
 
 # The unique Charmhub library identifier, never change it
 LIBID = "bc84295fef5f4049878f07b131968ee2"
@@ -334,7 +396,7 @@ LIBAPI = 0
 
 # Increment this PATCH version before using `charmcraft publish-lib` or reset
 # to 0 if you are raising the major API version
-LIBPATCH = 20
+LIBPATCH = 34
 
 logger = logging.getLogger(__name__)
 
@@ -364,6 +426,17 @@ RELATION_INTERFACE_NAME = "prometheus_scrape"
 
 DEFAULT_ALERT_RULES_RELATIVE_PATH = "./src/prometheus_alert_rules"
 
+SUPPORTED_ENCODINGS_KEY = "supported_encodings"
+COMPACT_ENCODING = "compact-v1"
+# Keys of application relation data that may hold compact encoded values
+COMPACT_KEYS = ("scrape_jobs", "alert_rules")
+_COMPACT_PREFIX = COMPACT_ENCODING + ":"
+# Objects and lists whose JSON is shorter than this are not worth a reference
+_COMPACT_MIN_REF_SIZE = 32
+# Values shorter than this are not compressed
+_COMPACT_MIN_COMPRESS_SIZE = 1024
+_COMPACT_CHUNK_SIZE = 256 * 1024
+
 
 class RelationNotFoundError(Exception):
     """Raised if there is no relation with the given name is found."""
@@ -496,6 +569,243 @@ def _sanitize_scrape_configuration(job) -> dict:
     return sanitized_job
 
 
+def _set_relation_data(databag, key: str, value: str) -> bool:
+    """Set a key of a relation databag, unless it already has that value.
+
+    Each write is a `relation-set` call that also fires `relation-changed` on the
+    remote units, so writing a value the databag already holds is avoided.
+
+    Args:
+        databag: the `RelationDataContent` to write to.
+        key: the key to set.
+        value: the string to set it to.
+
+    Returns:
+        whether the databag was written to.
+    """
+    if databag.get(key) == value:
+        return False
+    databag[key] = value
+    return True
+
+
+@functools.lru_cache(maxsize=8)
+def _compact_dumps(text: str) -> str:
+    """Encode a JSON document as a `compact-v1` value, without chunking it.
+
+    Memoized, so that a payload sent over several relations is only encoded once.
+
+    Args:
+        text: the JSON document.
+
+    Returns:
+        the `compact-v1` value.
+    """
+    document = json.dumps(_deduplicate(json.loads(text)), separators=(",", ":"))
+    if len(document) >= _COMPACT_MIN_COMPRESS_SIZE:
+        compressed = base64.b64encode(zlib.compress(document.encode("utf-8"))).decode("ascii")
+        if len(compressed) < len(document):
+            return _COMPACT_PREFIX + "z:" + compressed
+    return _COMPACT_PREFIX + "j:" + document
+
+
+def _deduplicate(value: Any) -> dict:
+    """Store each object or list occurring more than once in a value only once.
+
+    Args:
+        value: the decoded JSON document.
+
+    Returns:
+        the document as `{"refs": [...], "value": ...}`, where repeated objects and lists
+        are replaced by a `{"$ref": <index in refs>}`.
+    """
+    canonical, counts = _json_occurrences(value)
+
+    refs = []  # type: List[Any]
+    ref_index = {}  # type: Dict[str, int]
+
+    def encode(node: Any) -> Any:
+        if not isinstance(node, (dict, list)):
+            return node
+        key = canonical.get(id(node))
+        if key is None or counts[key] < 2 or len(key) < _COMPACT_MIN_REF_SIZE:
+            return encode_children(node)
+        if key not in ref_index:
+            ref_index[key] = len(refs)
+            refs.append(None)
+            refs[ref_index[key]] = encode_children(node)
+        return {"$ref": ref_index[key]}
+
+    def encode_children(node: Any) -> Any:
+        if isinstance(node, dict):
+            return {k: encode(v) for k, v in node.items()}
+        return [encode(v) for v in node]
+
+    encoded = encode(value)
+    return {"refs": refs, "value": encoded}
+
+
+def _json_occurrences(value: Any) -> tuple:
+    """Canonical JSON of the objects and lists in a value, and how often each occurs.
+
+    Occurrences nested in a repeated object or list are only counted once.
+
+    Args:
+        value: the decoded JSON document.
+
+    Returns:
+        a tuple of the canonical JSON of each object and list by `id`, and a `Counter`
+        of the occurrences of each canonical JSON.
+    """
+    canonical = {}  # type: Dict[int, str]
+    counts = Counter()  # type: Counter
+
+    def count(node: Any) -> None:
+        if not isinstance(node, (dict, list)):
+            return
+        key = json.dumps(node, sort_keys=True, separators=(",", ":"))
+        canonical[id(node)] = key
+        counts[key] += 1
+        if counts[key] == 1:
+            for child in node.values() if isinstance(node, dict) else node:
+                count(child)
+
+    count(value)
+    return canonical, counts
+
+
+def _compact_loads(value: str) -> Any:
+    """Decode a `compact-v1` value, without chunks.
+
+    Args:
+        value: the `compact-v1` value.
+
+    Returns:
+        the decoded document.
+
+    Raises:
+        ValueError: if the value is not a valid `compact-v1` value.
+    """
+    if not value.startswith(_COMPACT_PREFIX):
+        raise ValueError("not a {} value".format(COMPACT_ENCODING))
+    form, _, payload = value.split(":", 1)[1].partition(":")
+    if form == "z":
+        try:
+            payload = zlib.decompress(base64.b64decode(payload)).decode("utf-8")
+        except (zlib.error, TypeError) as e:
+            raise ValueError("invalid compressed value: {}".format(e))
+    elif form != "j":
+        raise ValueError("unknown {} form: {}".format(COMPACT_ENCODING, form))
+
+    document = json.loads(payload)
+    refs = document["refs"]
+
+    # References are expanded into copies, so that the result can be modified freely
+    def decode(node: Any) -> Any:
+        if isinstance(node, dict):
+            if len(node) == 1 and isinstance(node.get("$ref"), int):
+                return decode(refs[node["$ref"]])
+            return {k: decode(v) for k, v in node.items()}
+        if isinstance(node, list):
+            return [decode(v) for v in node]
+        return node
+
+    return decode(document["value"])
+
+
+def _encoded_relation_data(key: str, text: str, encodings: List[str]) -> Dict[str, str]:
+    """Relation data holding a JSON document, in the best encoding a consumer supports.
+
+    Args:
+        key: the relation data key of the document.
+        text: the JSON document.
+        encodings: the encodings the consumer supports.
+
+    Returns:
+        the keys to set and their values.
+    """
+    if COMPACT_ENCODING not in encodings:
+        return {key: text}
+
+    value = _compact_dumps(text)
+    if len(value) >= len(text):
+        return {key: text}
+    if len(value) <= _COMPACT_CHUNK_SIZE:
+        return {key: value}
+
+    chunks = []
+    while value:
+        chunks.append(value[:_COMPACT_CHUNK_SIZE])
+        value = value[_COMPACT_CHUNK_SIZE:]
+    data = {"{}.{}".format(key, index): chunk for index, chunk in enumerate(chunks)}
+    data[key] = "{}chunks:{}".format(_COMPACT_PREFIX, len(chunks))
+    return data
+
+
+def _set_encoded_relation_data(databag, key: str, text: str, encodings: List[str]) -> None:
+    """Set a JSON document in a relation databag, in the best encoding a consumer supports.
+
+    Chunks left from an earlier, larger value are removed, and unchanged keys are not written.
+
+    Args:
+        databag: the `RelationDataContent` to write to.
+        key: the relation data key of the document.
+        text: the JSON document.
+        encodings: the encodings the consumer supports.
+    """
+    data = _encoded_relation_data(key, text, encodings)
+    for stale in [k for k in databag if _is_chunk_key(k, key) and k not in data]:
+        del databag[stale]
+    for data_key, value in data.items():
+        _set_relation_data(databag, data_key, value)
+
+
+def _is_chunk_key(data_key: str, key: str) -> bool:
+    """Whether a relation data key holds a chunk of the value of another key."""
+    base, _, index = data_key.rpartition(".")
+    return base == key and index.isdigit()
+
+
+def _decoded_relation_data(data: Mapping[str, str]) -> Dict[str, str]:
+    """Relation data, with `compact-v1` values decoded into plain JSON and chunk keys dropped.
+
+    A value that cannot be decoded is left out and logged.
+
+    Args:
+        data: the relation data, e.g. a `RelationDataContent`.
+
+    Returns:
+        the relation data, as plain JSON.
+    """
+    decoded = dict(data)
+    for key in COMPACT_KEYS:
+        value = decoded.get(key)
+        if not value or not value.startswith(_COMPACT_PREFIX):
+            continue
+        for data_key in [k for k in decoded if _is_chunk_key(k, key)]:
+            del decoded[data_key]
+        try:
+            if value.startswith(_COMPACT_PREFIX + "chunks:"):
+                count = int(value.rsplit(":", 1)[1])
+                value = "".join(data["{}.{}".format(key, index)] for index in range(count))
+            decoded[key] = json.dumps(_compact_loads(value))
+        except (KeyError, ValueError) as e:
+            logger.error("Could not decode %s from relation data: %s", key, e)
+            del decoded[key]
+    return decoded
+
+
+def _supported_encodings(relation) -> List[str]:
+    """Encodings the consumer on the other side of a relation advertised it can decode."""
+    if not relation.app:
+        return []
+    try:
+        encodings = json.loads(relation.data[relation.app].get(SUPPORTED_ENCODINGS_KEY, "[]"))
+    except ValueError:
+        return []
+    return encodings if isinstance(encodings, list) else []
+
+
 class JujuTopology:
     """Class for storing and formatting juju topology information."""
 
@@ -773,14 +1083,52 @@ class AlertRules:
     #   the "alert" and "expr" keys.
     # - alert rule (singular): a single dictionary that has the "alert" and "expr" keys.
 
-    def __init__(self, topology: Optional[JujuTopology] = None):
+    def __init__(
+        self, topology: Optional[JujuTopology] = None, file_index: Optional[Mapping] = None
+    ):
         """Build and alert rule object.
 
         Args:
             topology: an optional `JujuTopology` instance that is used to annotate all alert rules.
+            file_index: an optional index of the rule files read by an earlier instance, as left
+                in its `file_index` attribute. Files whose path, modification time and size are
+                unchanged, or whose content is identical to an indexed file, are not parsed again.
         """
         self.topology = topology
         self.alert_groups = []  # type: List[dict]
+        # path -> modification time, size, sha256 and JSON encoded content of each rule file read
+        self.file_index = {}  # type: Dict[str, dict]
+        self._previous_index = file_index or {}
+        self._index_by_hash = {
+            entry["sha256"]: entry for entry in self._previous_index.values()
+        }  # type: Dict[str, Mapping]
+
+    def _load(self, file_path: Path):
+        """Parse a rules file, reusing the result of an earlier parse of the same content."""
+        stat = file_path.stat()
+        entry = self._previous_index.get(str(file_path))
+        if not entry or (entry["mtime"], entry["size"]) != (stat.st_mtime_ns, stat.st_size):
+            content = file_path.read_bytes()
+            digest = hashlib.sha256(content).hexdigest()
+            entry = self._index_by_hash.get(digest)
+            if not entry:
+                # deferred, as most hooks never parse alert rules
+                import yaml
+
+                rule_file = yaml.safe_load(content)
+                try:
+                    entry = {"sha256": digest, "content": json.dumps(rule_file)}
+                except (TypeError, ValueError):
+                    # not representable in JSON, so not indexed
+                    return rule_file
+                self._index_by_hash[digest] = entry
+        self.file_index[str(file_path)] = {
+            "mtime": stat.st_mtime_ns,
+            "size": stat.st_size,
+            "sha256": entry["sha256"],
+            "content": entry["content"],
+        }
+        return json.loads(entry["content"])
 
     def _from_file(self, root_path: Path, file_path: Path) -> List[dict]:
         """Read a rules file from path, injecting juju topology.
@@ -793,46 +1141,45 @@ class AlertRules:
             A list of dictionaries representing the rules file, if file is valid (the structure is
             formed by `yaml.safe_load` of the file); an empty list otherwise.
         """
-        with file_path.open() as rf:
-            # Load a list of rules from file then add labels and filters
-            try:
-                rule_file = yaml.safe_load(rf)
-
-            except Exception as e:
-                logger.error("Failed to read alert rules from %s: %s", file_path.name, e)
-                return []
-
-            if _is_official_alert_rule_format(rule_file):
-                alert_groups = rule_file["groups"]
-            elif _is_single_alert_rule_format(rule_file):
-                # convert to list of alert groups
-                # group name is made up from the file name
-                alert_groups = [{"name": file_path.stem, "rules": [rule_file]}]
-            else:
-                # invalid/unsupported
-                logger.error("Invalid rules file: %s", file_path.name)
-                return []
-
-            # update rules with additional metadata
-            for alert_group in alert_groups:
-                # update group name with topology and sub-path
-                alert_group["name"] = self._group_name(
-                    str(root_path),
-                    str(file_path),
-                    alert_group["name"],
-                )
+        # Load a list of rules from file then add labels and filters
+        try:
+            rule_file = self._load(file_path)
+
+        except Exception as e:
+            logger.error("Failed to read alert rules from %s: %s", file_path.name, e)
+            return []
 
-                # add "juju_" topology labels
-                for alert_rule in alert_group["rules"]:
-                    if "labels" not in alert_rule:
-                        alert_rule["labels"] = {}
+        if _is_official_alert_rule_format(rule_file):
+            alert_groups = rule_file["groups"]
+        elif _is_single_alert_rule_format(rule_file):
+            # convert to list of alert groups
+            # group name is made up from the file name
+            alert_groups = [{"name": file_path.stem, "rules": [rule_file]}]
+        else:
+            # invalid/unsupported
+            logger.error("Invalid rules file: %s", file_path.name)
+            return []
 
-                    if self.topology:
-                        alert_rule["labels"].update(self.topology.as_promql_label_dict())
-                        # insert juju topology filters into a prometheus alert rule
-                        alert_rule["expr"] = self.topology.render(alert_rule["expr"])
+        # update rules with additional metadata
+        for alert_group in alert_groups:
+            # update group name with topology and sub-path
+            alert_group["name"] = self._group_name(
+                str(root_path),
+                str(file_path),
+                alert_group["name"],
+            )
 
-            return alert_groups
+            # add "juju_" topology labels
+            for alert_rule in alert_group["rules"]:
+                if "labels" not in alert_rule:
+                    alert_rule["labels"] = {}
+
+                if self.topology:
+                    alert_rule["labels"].update(self.topology.as_promql_label_dict())
+                    # insert juju topology filters into a prometheus alert rule
+                    alert_rule["expr"] = self.topology.render(alert_rule["expr"])
+
+        return alert_groups
 
     def _group_name(self, root_path: str, file_path: str, group_name: str) -> str:
         """Generate group name from path and topology.
@@ -871,10 +1218,20 @@ class AlertRules:
             recursive: a flag indicating whether a glob is recursive (nested) or not.
 
         Returns:
-            List of files in `dir_path` that have one of the suffixes specified in `suffixes`.
+            Sorted list of files in `dir_path` that have one of the suffixes specified in
+            `suffixes`.
         """
-        all_files_in_dir = dir_path.glob("**/*" if recursive else "*")
-        return list(filter(lambda f: f.is_file() and f.suffix in suffixes, all_files_in_dir))
+        files = []
+        directories = [dir_path]
+        while directories:
+            with os.scandir(directories.pop()) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        if recursive:
+                            directories.append(Path(entry.path))
+                    elif entry.is_file() and os.path.splitext(entry.name)[1] in suffixes:
+                        files.append(Path(entry.path))
+        return sorted(files)
 
     def _from_dir(self, dir_path: Path, recursive: bool) -> List[dict]:
         """Read all rule files in a directory.
@@ -956,10 +1313,19 @@ class MonitoringEvents(ObjectEvents):
     targets_changed = EventSource(TargetsChangedEvent)
 
 
+class _RelationSnapshot:
+    """Remote data of a relation with a metrics provider, read once in a hook."""
+
+    def __init__(self, app_data: Dict[str, str], hosts: Dict[str, str]):
+        self.app_data = app_data
+        self.hosts = hosts
+
+
 class MetricsEndpointConsumer(Object):
     """A Prometheus based Monitoring service."""
 
     on = MonitoringEvents()
+    _stored = StoredState()
 
     def __init__(self, charm: CharmBase, relation_name: str = DEFAULT_RELATION_NAME):
         """A Prometheus based Monitoring service.
@@ -991,7 +1357,26 @@ class MetricsEndpointConsumer(Object):
         self._charm = charm
         self._relation_name = relation_name
         self._transformer = PromqlTransformer(self._charm)
+        # relation id -> hash of the relation's alert rules and scrape metadata, with the
+        # identifier and JSON encoded alert rules `alerts()` returned for them
+        self._stored.set_default(alerts={})
+        # relation id -> hash of the relation's scrape jobs, scrape metadata and unit addresses,
+        # with the JSON encoded static scrape configuration `jobs()` returned for them
+        self._stored.set_default(jobs={})
+        # relation id -> fingerprint of the relation's effective scrape config and alert rules
+        # when `targets_changed` was last emitted for it, and the number of emissions skipped
+        # because the fingerprint had not changed
+        self._stored.set_default(fingerprints={}, suppressed_events=0)
+        # relation id -> remote unit -> JSON encoded [unit name, address] the unit last set,
+        # kept across hooks as a unit's data only changes along with a relation-changed
+        # event for it, so that each hook only reads the data of the units that changed
+        self._stored.set_default(unit_hosts={})
+        # relation id -> snapshot of its remote data for the current hook
+        self._snapshots = {}  # type: Dict[int, _RelationSnapshot]
         events = self._charm.on[relation_name]
+        self.framework.observe(events.relation_joined, self._advertise_encodings)
+        self.framework.observe(self._charm.on.leader_elected, self._advertise_encodings)
+        self.framework.observe(self._charm.on.upgrade_charm, self._advertise_encodings)
         self.framework.observe(events.relation_changed, self._on_metrics_provider_relation_changed)
         self.framework.observe(
             events.relation_departed, self._on_metrics_provider_relation_departed
@@ -1003,15 +1388,21 @@ class MetricsEndpointConsumer(Object):
         Anytime there are changes in relations between Prometheus
         and metrics provider charms the Prometheus charm is informed,
         through a `TargetsChangedEvent` event. The Prometheus charm can
-        then choose to update its scrape configuration.
+        then choose to update its scrape configuration. Changes that leave
+        the effective scrape configuration and alert rules of the relation
+        as they were, such as a provider setting the same unit address
+        again, are not passed on.
 
         Args:
             event: a `CharmEvent` in response to which the Prometheus
                 charm must update its scrape configuration.
         """
-        rel_id = event.relation.id
-
-        self.on.targets_changed.emit(relation_id=rel_id)
+        self._snapshots.pop(event.relation.id, None)
+        if event.unit:
+            unit_hosts = dict(self._stored.unit_hosts.get(str(event.relation.id), {}))
+            unit_hosts[event.unit.name] = self._unit_host(event.relation, event.unit)
+            self._stored.unit_hosts[str(event.relation.id)] = unit_hosts
+        self._emit_targets_changed(event.relation)
 
     def _on_metrics_provider_relation_departed(self, event):
         """Update job config when a metrics provider departs.
@@ -1025,26 +1416,193 @@ class MetricsEndpointConsumer(Object):
             event: a `CharmEvent` that indicates a metrics provider
                unit has departed.
         """
-        rel_id = event.relation.id
-        self.on.targets_changed.emit(relation_id=rel_id)
+        self._snapshots.pop(event.relation.id, None)
+        self._emit_targets_changed(event.relation)
+
+    def _advertise_encodings(self, _) -> None:
+        """Let metrics providers know which encodings of their relation data can be decoded."""
+        if not self._charm.unit.is_leader():
+            return
+
+        encodings = json.dumps([COMPACT_ENCODING])
+        for relation in self._charm.model.relations[self._relation_name]:
+            _set_relation_data(relation.data[self._charm.app], SUPPORTED_ENCODINGS_KEY, encodings)
+
+    @property
+    def suppressed_events(self) -> int:
+        """Number of `targets_changed` emissions skipped since the relation had not changed."""
+        return self._stored.suppressed_events
+
+    def _emit_targets_changed(self, relation) -> None:
+        """Emit `targets_changed` for a relation, unless its fingerprint is unchanged."""
+        fingerprint = self._fingerprint(relation)
+        key = str(relation.id)
+        if self._stored.fingerprints.get(key) == fingerprint:
+            logger.debug("Relation %s is unchanged, not emitting targets_changed", relation.id)
+            self._stored.suppressed_events += 1
+            return
+
+        current = {str(r.id) for r in self._charm.model.relations[self._relation_name]}
+        fingerprints = {k: v for k, v in self._stored.fingerprints.items() if k in current}
+        fingerprints[key] = fingerprint
+        self._stored.fingerprints = fingerprints
+        self.on.targets_changed.emit(relation_id=relation.id)
+
+    def _fingerprint(self, relation) -> str:
+        """Hash of what the scrape jobs and alert rules of a relation are built from.
+
+        JSON encoded values are decoded and encoded again with sorted keys, so that
+        a provider encoding the same value differently does not change the hash.
+        """
+        if not relation.units or not relation.app:
+            return ""
+
+        def canonical(raw: Optional[str]) -> Optional[str]:
+            try:
+                return json.dumps(json.loads(raw), sort_keys=True) if raw else raw
+            except ValueError:
+                return raw
+
+        snapshot = self._snapshot(relation)
+        inputs = [
+            canonical(snapshot.app_data.get("scrape_jobs")),
+            canonical(snapshot.app_data.get("scrape_metadata")),
+            canonical(snapshot.app_data.get("alert_rules")),
+            snapshot.hosts,
+        ]
+        return hashlib.sha256(json.dumps(inputs, sort_keys=True).encode("utf-8")).hexdigest()
 
     def jobs(self) -> list:
         """Fetch the list of scrape jobs.
 
+        The static scrape configuration of each relation is only built again when its scrape
+        jobs, scrape metadata or unit addresses, or the version of this library, changed since
+        the last call, possibly in an earlier hook.
+
         Returns:
             A list consisting of all the static scrape configurations
             for each related `MetricsEndpointProvider` that has specified
             its scrape targets.
         """
         scrape_jobs = []
+        cache = {}  # type: Dict[str, dict]
 
         for relation in self._charm.model.relations[self._relation_name]:
-            static_scrape_jobs = self._static_scrape_config(relation)
+            digest = self._static_scrape_config_hash(relation)
+            cached = self._stored.jobs.get(str(relation.id))
+            if cached and cached["hash"] == digest:
+                static_scrape_jobs = json.loads(cached["jobs"])
+            else:
+                static_scrape_jobs = self._static_scrape_config(relation)
+            cache[str(relation.id)] = {"hash": digest, "jobs": json.dumps(static_scrape_jobs)}
             if static_scrape_jobs:
                 scrape_jobs.extend(static_scrape_jobs)
 
+        if cache != self._stored.jobs:
+            self._stored.jobs = cache
         return scrape_jobs
 
+    def sd_jobs(
+        self, http_sd_url: Optional[str] = None, file_sd_dir: Optional[str] = None
+    ) -> list:
+        """Fetch the list of scrape jobs, with the targets of units discovered.
+
+        Jobs labeled with Juju topology get either an `http_sd_configs` entry for
+        `<http_sd_url>/<name>` or a `file_sd_configs` entry for `<file_sd_dir>/<name>.json`
+        instead of a static config per unit, where `<name>` is the key of the job's target
+        groups in `target_groups()`. Targets with fully qualified hosts are left as static
+        configs.
+
+        Args:
+            http_sd_url: base URL target groups are served under, e.g. by a
+                `TargetGroupServer`.
+            file_sd_dir: directory, as seen by Prometheus, target group files are written to.
+
+        Returns:
+            A list of scrape jobs, which only changes when the scrape jobs or scrape metadata
+            of a related `MetricsEndpointProvider` do.
+
+        Raises:
+            ValueError: unless exactly one of `http_sd_url` and `file_sd_dir` is given.
+        """
+        if (http_sd_url is None) == (file_sd_dir is None):
+            raise ValueError("exactly one of http_sd_url and file_sd_dir must be given")
+
+        scrape_jobs = []
+        for job, groups in self._service_discovery_jobs():
+            if groups is not None:
+                name = _target_group_name(job["job_name"])
+                if http_sd_url is not None:
+                    url = "{}/{}".format(http_sd_url.rstrip("/"), name)
+                    job["http_sd_configs"] = [{"url": url}]
+                else:
+                    path = os.path.join(str(file_sd_dir), name + ".json")
+                    job["file_sd_configs"] = [{"files": [path]}]
+            scrape_jobs.append(job)
+        return scrape_jobs
+
+    def target_groups(self) -> Dict[str, list]:
+        """Fetch the target groups of the units of each job discovered in `sd_jobs()`.
+
+        Returns:
+            A dictionary mapping the name each job is discovered under to its list of target
+            groups, as `http_sd` and `file_sd` expect them: one group of targets and labels
+            per unit.
+        """
+        return {
+            _target_group_name(job["job_name"]): groups
+            for job, groups in self._service_discovery_jobs()
+            if groups is not None
+        }
+
+    def _service_discovery_jobs(self) -> list:
+        """Scrape jobs without the static configs of their units, with those configs.
+
+        Returns:
+            A list of (job, target groups) tuples, in the order of `jobs()`. The target groups
+            are None for jobs without Juju topology, whose targets are not discovered.
+        """
+        sd_jobs = []
+        for relation in self._charm.model.relations[self._relation_name]:
+            if not relation.units:
+                continue
+            app_data = self._snapshot(relation).app_data
+            raw_jobs = json.loads(app_data.get("scrape_jobs", "[]"))
+            scrape_metadata = json.loads(app_data.get("scrape_metadata", "{}"))
+            if not raw_jobs:
+                continue
+            if not scrape_metadata:
+                sd_jobs.extend((job, None) for job in raw_jobs)
+                continue
+
+            for job in self._static_scrape_config(relation):
+                configs = job["static_configs"]
+                groups = [c for c in configs if "juju_unit" in c.get("labels", {})]
+                job["static_configs"] = [c for c in configs if c not in groups]
+                if not job["static_configs"]:
+                    del job["static_configs"]
+                # as in `jobs()` with at least one unit, so that the job does not change with
+                # the number of units
+                instance_relabel_config = job["relabel_configs"][-1]
+                if "juju_unit" not in instance_relabel_config["source_labels"]:
+                    instance_relabel_config["source_labels"].append("juju_unit")
+                sd_jobs.append((job, groups))
+        return sd_jobs
+
+    def _static_scrape_config_hash(self, relation) -> str:
+        """Hash of the relation data `_static_scrape_config` builds the relation's jobs from."""
+        if not relation.units:
+            return ""
+        snapshot = self._snapshot(relation)
+        # jobs built by an older version of the library are built again after an upgrade
+        inputs = [
+            snapshot.app_data.get("scrape_jobs", "[]"),
+            snapshot.app_data.get("scrape_metadata", "{}"),
+            snapshot.hosts,
+            [LIBAPI, LIBPATCH],
+        ]
+        return hashlib.sha256(json.dumps(inputs, sort_keys=True).encode("utf-8")).hexdigest()
+
     def alerts(self) -> dict:
         """Fetch alerts for all relations.
 
@@ -1082,22 +1640,43 @@ class MetricsEndpointConsumer(Object):
             container.push(path, rules, make_dirs=True)
         ```
 
+        The alert rules of each relation are only parsed and transformed again when its alert
+        rules or scrape metadata, or the version of this library, changed since the last call,
+        possibly in an earlier hook.
+
         Returns:
             A dictionary mapping the Juju topology identifier of the source charm to
             its list of alert rule groups.
         """
         alerts = {}  # type: Dict[str, dict] # mapping b/w juju identifiers and alert rule files
+        cache = {}  # type: Dict[str, dict]
         for relation in self._charm.model.relations[self._relation_name]:
             if not relation.units or not relation.app:
                 continue
 
-            alert_rules = json.loads(relation.data[relation.app].get("alert_rules", "{}"))
+            app_data = self._snapshot(relation).app_data
+            raw_alert_rules = app_data.get("alert_rules", "{}")
+            raw_scrape_metadata = app_data.get("scrape_metadata")
+            # the library version is part of the hash, so that rules transformed by an older
+            # version are transformed again after an upgrade
+            digest = hashlib.sha256(
+                "{}\0{}\0{}.{}".format(
+                    raw_alert_rules, raw_scrape_metadata, LIBAPI, LIBPATCH
+                ).encode("utf-8")
+            ).hexdigest()
+            cached = self._stored.alerts.get(str(relation.id))
+            if cached and cached["hash"] == digest:
+                cache[str(relation.id)] = dict(cached)
+                alerts[cached["identifier"]] = json.loads(cached["alert_rules"])
+                continue
+
+            alert_rules = json.loads(raw_alert_rules)
             if not alert_rules:
                 continue
 
             identifier = None
             try:
-                scrape_metadata = json.loads(relation.data[relation.app]["scrape_metadata"])
+                scrape_metadata = json.loads(app_data["scrape_metadata"])
                 identifier = ProviderTopology.from_relation_data(scrape_metadata).identifier
                 alerts[identifier] = self._transformer.apply_label_matchers(alert_rules)
 
@@ -1115,7 +1694,14 @@ class MetricsEndpointConsumer(Object):
                 )
                 continue
             alerts[identifier] = alert_rules
+            cache[str(relation.id)] = {
+                "hash": digest,
+                "identifier": identifier,
+                "alert_rules": json.dumps(alert_rules),
+            }
 
+        if cache != self._stored.alerts:
+            self._stored.alerts = cache
         return alerts
 
     def _get_identifier_by_alert_rules(self, rules: dict) -> Union[str, None]:
@@ -1176,12 +1762,13 @@ class MetricsEndpointConsumer(Object):
         if not relation.units:
             return []
 
-        scrape_jobs = json.loads(relation.data[relation.app].get("scrape_jobs", "[]"))
+        app_data = self._snapshot(relation).app_data
+        scrape_jobs = json.loads(app_data.get("scrape_jobs", "[]"))
 
         if not scrape_jobs:
             return []
 
-        scrape_metadata = json.loads(relation.data[relation.app].get("scrape_metadata", "{}"))
+        scrape_metadata = json.loads(app_data.get("scrape_metadata", "{}"))
 
         if not scrape_metadata:
             return scrape_jobs
@@ -1213,18 +1800,56 @@ class MetricsEndpointConsumer(Object):
             A dictionary that maps unit names to unit addresses for
             the specified relation.
         """
+        return dict(self._snapshot(relation).hosts)
+
+    def _snapshot(self, relation) -> _RelationSnapshot:
+        """Remote application data and unit addresses of a relation.
+
+        The application databag is read and decoded once per hook. Unit databags are only read
+        for units whose address is not known from an earlier hook, since the
+        relation-changed handler reads the databag of the unit that changed.
+
+        Args:
+            relation: An `ops.model.Relation` object.
+
+        Returns:
+            a `_RelationSnapshot` of the relation's remote data.
+        """
+        if relation.id in self._snapshots:
+            return self._snapshots[relation.id]
+
+        app_data = _decoded_relation_data(relation.data[relation.app]) if relation.app else {}
+        known = self._stored.unit_hosts.get(str(relation.id), {})
+        unit_hosts = {
+            unit.name: known.get(unit.name) or self._unit_host(relation, unit)
+            for unit in relation.units
+        }
         hosts = {}
-        for unit in relation.units:
-            # TODO deprecate and remove unit.name
-            unit_name = relation.data[unit].get("prometheus_scrape_unit_name") or unit.name
-            # TODO deprecate and remove "prometheus_scrape_host"
-            unit_address = relation.data[unit].get(
-                "prometheus_scrape_unit_address"
-            ) or relation.data[unit].get("prometheus_scrape_host")
+        for unit in sorted(relation.units, key=lambda u: u.name):
+            unit_name, unit_address = json.loads(unit_hosts[unit.name])
             if unit_name and unit_address:
-                hosts.update({unit_name: unit_address})
-
-        return hosts
+                hosts[unit_name] = unit_address
+
+        if unit_hosts != known:
+            current = {str(r.id) for r in self._charm.model.relations[self._relation_name]}
+            stored = {k: v for k, v in self._stored.unit_hosts.items() if k in current}
+            stored[str(relation.id)] = unit_hosts
+            self._stored.unit_hosts = stored
+
+        self._snapshots[relation.id] = _RelationSnapshot(app_data, hosts)
+        return self._snapshots[relation.id]
+
+    @staticmethod
+    def _unit_host(relation, unit) -> str:
+        """JSON encoded [unit name, address] a remote unit set in its relation data."""
+        data = relation.data[unit]
+        # TODO deprecate and remove unit.name
+        unit_name = data.get("prometheus_scrape_unit_name") or unit.name
+        # TODO deprecate and remove "prometheus_scrape_host"
+        unit_address = data.get("prometheus_scrape_unit_address") or data.get(
+            "prometheus_scrape_host"
+        )
+        return json.dumps([unit_name, unit_address])
 
     def _labeled_static_job_config(self, job, job_name_prefix, hosts, scrape_metadata) -> dict:
         """Construct labeled job configuration for a single job.
@@ -1390,6 +2015,82 @@ class MetricsEndpointConsumer(Object):
         return static_config
 
 
+def _target_group_name(job_name: str) -> str:
+    """Name the target groups of a job are discovered under, usable in URLs and file names."""
+    return re.sub(r"[^A-Za-z0-9_.-]", "_", job_name)
+
+
+class TargetGroupServer:
+    """Serve target groups to Prometheus `http_sd_configs`.
+
+    The target groups of each job, as returned by `MetricsEndpointConsumer.target_groups()`,
+    are served as JSON at `<url>/<name>`. Requests are served from a background thread
+    until `stop()` is called, so the server needs a long lived process, not a charm hook.
+
+    Args:
+        host: address to listen on.
+        port: port to listen on, or 0 for any free port.
+    """
+
+    def __init__(self, host: str = "0.0.0.0", port: int = 0):
+        # deferred, as only a process serving target groups needs them
+        import threading
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        documents = {}  # type: Dict[str, bytes]
+        self._documents = documents
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):  # noqa: N802
+                body = documents.get(self.path.strip("/"))
+                if body is None:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logger.debug("%s - %s", self.address_string(), format % args)
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        """Base URL the target groups are served under, to give to `sd_jobs()`."""
+        host, port = self._server.server_address[:2]
+        return "http://{}:{}".format(host, port)
+
+    def update(self, target_groups: Mapping[str, list]) -> None:
+        """Replace the served target groups.
+
+        Args:
+            target_groups: a dictionary mapping names to lists of target groups, as returned
+                by `MetricsEndpointConsumer.target_groups()`.
+        """
+        documents = {
+            name: json.dumps(groups).encode("utf-8") for name, groups in target_groups.items()
+        }
+        # a single assignment of each key, so that concurrent requests see whole documents
+        for name in set(self._documents) - set(documents):
+            self._documents.pop(name, None)
+        self._documents.update(documents)
+
+    def start(self) -> None:
+        """Start serving requests in a background thread."""
+        self._thread.start()
+
+    def stop(self) -> None:
+        """Stop serving requests and release the listening socket."""
+        if self._thread.is_alive():
+            self._server.shutdown()
+        self._server.server_close()
+
+
 def _resolve_dir_against_charm_path(charm: CharmBase, *path_elements: str) -> str:
     """Resolve the provided path items against the directory of the main file.
 
@@ -1424,6 +2125,8 @@ def _resolve_dir_against_charm_path(charm: CharmBase, *path_elements: str) -> st
 class MetricsEndpointProvider(Object):
     """A metrics endpoint for Prometheus."""
 
+    _stored = StoredState()
+
     def __init__(
         self,
         charm,
@@ -1559,6 +2262,8 @@ class MetricsEndpointProvider(Object):
         # sanitize job configurations to the supported subset of parameters
         jobs = [] if jobs is None else jobs
         self._jobs = [_sanitize_scrape_configuration(job) for job in jobs]
+        # index of the alert rule files, so that unchanged files are not parsed again
+        self._stored.set_default(alert_rules_index={})
 
         events = self._charm.on[self._relation_name]
         self.framework.observe(events.relation_joined, self._set_scrape_job_spec)
@@ -1608,20 +2313,43 @@ class MetricsEndpointProvider(Object):
         if not self._charm.unit.is_leader():
             return
 
-        alert_rules = AlertRules(topology=self.topology)
+        alert_rules = AlertRules(topology=self.topology, file_index=self._stored.alert_rules_index)
         alert_rules.add_path(self._alert_rules_path, recursive=True)
         alert_rules_as_dict = alert_rules.as_dict()
+        if alert_rules.file_index != self._stored.alert_rules_index:
+            self._stored.alert_rules_index = alert_rules.file_index
+
+        # Serialized once for all relations, and only written where they differ
+        scrape_metadata = json.dumps(self._scrape_metadata)
+        scrape_jobs = json.dumps(self._scrape_jobs)
+        alert_rules_json = json.dumps(alert_rules_as_dict) if alert_rules_as_dict else None
 
         for relation in self._charm.model.relations[self._relation_name]:
-            relation.data[self._charm.app]["scrape_metadata"] = json.dumps(self._scrape_metadata)
-            relation.data[self._charm.app]["scrape_jobs"] = json.dumps(self._scrape_jobs)
+            databag = relation.data[self._charm.app]
+            encodings = _supported_encodings(relation)
+            _set_relation_data(databag, "scrape_metadata", scrape_metadata)
+            _set_encoded_relation_data(databag, "scrape_jobs", scrape_jobs, encodings)
 
-            if alert_rules_as_dict:
+            if alert_rules_json:
                 # Update relation data with the string representation of the rule file.
                 # Juju topology is already included in the "scrape_metadata" field above.
                 # The consumer side of the relation uses this information to name the rules file
                 # that is written to the filesystem.
-                relation.data[self._charm.app]["alert_rules"] = json.dumps(alert_rules_as_dict)
+                _set_encoded_relation_data(databag, "alert_rules", alert_rules_json, encodings)
+
+    def update_scrape_job_spec(self, jobs):
+        """Update the scrape job specification and forward it to all related consumers.
+
+        This allows charms whose scrape targets depend on configuration to change the
+        jobs originally given to the constructor.
+
+        Args:
+            jobs: a list of dictionaries where each dictionary represents the Prometheus
+                scrape configuration for a single job, in the same format as the `jobs`
+                argument of the constructor.
+        """
+        self._jobs = [_sanitize_scrape_configuration(job) for job in jobs]
+        self._set_scrape_job_spec(None)
 
     def _set_unit_ip(self, _):
         """Set unit host address.
@@ -1633,11 +2361,16 @@ class MetricsEndpointProvider(Object):
         to be able to use this method as an event handler, although no access to the
         event is actually needed.
         """
-        for relation in self._charm.model.relations[self._relation_name]:
-            relation.data[self._charm.unit]["prometheus_scrape_unit_address"] = socket.getfqdn()
-            relation.data[self._charm.unit]["prometheus_scrape_unit_name"] = str(
-                self._charm.model.unit.name
-            )
+        relations = self._charm.model.relations[self._relation_name]
+        if not relations:
+            return
+
+        unit_address = socket.getfqdn()
+        unit_name = str(self._charm.model.unit.name)
+        for relation in relations:
+            databag = relation.data[self._charm.unit]
+            _set_relation_data(databag, "prometheus_scrape_unit_address", unit_address)
+            _set_relation_data(databag, "prometheus_scrape_unit_name", unit_name)
 
     def _is_valid_unit_address(self, address: str) -> bool:
         """Validate a unit address.
@@ -1694,6 +2427,8 @@ class PrometheusRulesProvider(Object):
         recursive: Whether or not to scan for rule files recursively.
     """
 
+    _stored = StoredState()
+
     def __init__(
         self,
         charm: CharmBase,
@@ -1716,6 +2451,8 @@ class PrometheusRulesProvider(Object):
                 e.message,
             )
         self.dir_path = dir_path
+        # index of the alert rule files, so that unchanged files are not parsed again
+        self._stored.set_default(alert_rules_index={})
 
         events = self._charm.on[self._relation_name]
         event_sources = [
@@ -1737,9 +2474,11 @@ class PrometheusRulesProvider(Object):
         if not self._charm.unit.is_leader():
             return
 
-        alert_rules = AlertRules()
+        alert_rules = AlertRules(file_index=self._stored.alert_rules_index)
         alert_rules.add_path(self.dir_path, recursive=self._recursive)
         alert_rules_as_dict = alert_rules.as_dict()
+        if alert_rules.file_index != self._stored.alert_rules_index:
+            self._stored.alert_rules_index = alert_rules.file_index
 
         logger.info("Updating relation data with rule files from disk")
         for relation in self._charm.model.relations[self._relation_name]:
@@ -1829,8 +2568,14 @@ class MetricsEndpointAggregator(Object):
     advisable to change this option, if required it can be done by
     setting the "relabel_instance" keyword argument to `False` when
     constructing an aggregator object.
+
+    Scrape jobs and alert rules are kept in an index persisted in the charm's stored state, by
+    job or group name and unit, so that changes and departures of scrape targets only touch the
+    affected job or group instead of decoding, filtering and encoding all of them.
     """
 
+    _stored = StoredState()
+
     def __init__(self, charm, relation_names, relabel_instance=True):
         """Construct a `MetricsEndpointAggregator`.
 
@@ -1855,10 +2600,14 @@ class MetricsEndpointAggregator(Object):
         self._prometheus_relation = relation_names["prometheus"]
         self._alert_rules_relation = relation_names["alert_rules"]
         self._relabel_instance = relabel_instance
+        # job name -> job and its static configs by unit, group name -> alert rules by unit
+        self._stored.set_default(jobs={}, groups={}, indexed=False)
 
         # manage Prometheus charm relation events
         prometheus_events = self._charm.on[self._prometheus_relation]
         self.framework.observe(prometheus_events.relation_joined, self._set_prometheus_data)
+        # the consumer advertises the encodings it supports in its application data
+        self.framework.observe(prometheus_events.relation_changed, self._set_prometheus_data)
 
         # manage list of Prometheus scrape jobs from related scrape targets
         target_events = self._charm.on[self._target_relation]
@@ -1877,23 +2626,8 @@ class MetricsEndpointAggregator(Object):
         `MetricsEndpointAggregator`, that Prometheus unit is provided
         with the complete set of existing scrape jobs and alert rules.
         """
-        jobs = []  # list of scrape jobs, one per relation
-        for relation in self.model.relations[self._target_relation]:
-            targets = self._get_targets(relation)
-            if targets and relation.app:
-                jobs.append(self._static_scrape_job(targets, relation.app.name))
-
-        groups = []  # list of alert rule groups, one group per relation
-        for relation in self.model.relations[self._alert_rules_relation]:
-            unit_rules = self._get_alert_rules(relation)
-            if unit_rules and relation.app:
-                appname = relation.app.name
-                rules = self._label_alert_rules(unit_rules, appname)
-                group = {"name": self._group_name(appname), "rules": rules}
-                groups.append(group)
-
-        event.relation.data[self._charm.app]["scrape_jobs"] = json.dumps(jobs)
-        event.relation.data[self._charm.app]["alert_rules"] = json.dumps({"groups": groups})
+        self._ensure_store()
+        self._publish([event.relation])
 
     def _set_target_job_data(self, targets: dict, app_name: str, **kwargs) -> None:
         """Update scrape jobs in response to scrape target changes.
@@ -1907,15 +2641,10 @@ class MetricsEndpointAggregator(Object):
             targets: a `dict` containing target information
             app_name: a `str` identifying the application
         """
+        self._ensure_store()
         # new scrape job for the relation that has changed
-        updated_job = self._static_scrape_job(targets, app_name, **kwargs)
-
-        for relation in self.model.relations[self._prometheus_relation]:
-            jobs = json.loads(relation.data[self._charm.app].get("scrape_jobs", "[]"))
-            # list of scrape jobs that have not changed
-            jobs = [job for job in jobs if updated_job["job_name"] != job["job_name"]]
-            jobs.append(updated_job)
-            relation.data[self._charm.app]["scrape_jobs"] = json.dumps(jobs)
+        self._store_job(self._static_scrape_job(targets, app_name, **kwargs))
+        self._publish()
 
     def _update_prometheus_jobs(self, event):
         """Update scrape jobs in response to scrape target changes.
@@ -1928,15 +2657,10 @@ class MetricsEndpointAggregator(Object):
         if not targets:
             return
 
+        self._ensure_store()
         # new scrape job for the relation that has changed
-        updated_job = self._static_scrape_job(targets, event.relation.app.name)
-
-        for relation in self.model.relations[self._prometheus_relation]:
-            jobs = json.loads(relation.data[self._charm.app].get("scrape_jobs", "[]"))
-            # list of scrape jobs that have not changed
-            jobs = [job for job in jobs if updated_job["job_name"] != job["job_name"]]
-            jobs.append(updated_job)
-            relation.data[self._charm.app]["scrape_jobs"] = json.dumps(jobs)
+        self._store_job(self._static_scrape_job(targets, event.relation.app.name))
+        self._publish()
 
     def _remove_prometheus_jobs(self, event):
         """Remove scrape jobs when a target departs.
@@ -1944,34 +2668,22 @@ class MetricsEndpointAggregator(Object):
         Any time a scrape target departs, any Prometheus scrape job
         associated with that specific scrape target is removed.
         """
+        self._ensure_store()
         job_name = self._job_name(event.relation.app.name)
-        unit_name = event.unit.name
-
-        for relation in self.model.relations[self._prometheus_relation]:
-            jobs = json.loads(relation.data[self._charm.app].get("scrape_jobs", "[]"))
-            if not jobs:
-                continue
-
-            changed_job = [j for j in jobs if j.get("job_name") == job_name]
-            if not changed_job:
-                continue
-            changed_job = changed_job[0]
-
-            # list of scrape jobs that have not changed
-            jobs = [job for job in jobs if job.get("job_name") != job_name]
-
-            # list of scrape jobs for units of the same application that still exist
-            configs_kept = [
-                config
-                for config in changed_job["static_configs"]  # type: ignore
-                if config.get("labels", {}).get("juju_unit") != unit_name
-            ]
-
-            if configs_kept:
-                changed_job["static_configs"] = configs_kept  # type: ignore
-                jobs.append(changed_job)
+        entry = self._stored.jobs.get(job_name)
+        if not entry or event.unit.name not in entry["static_configs"]:
+            return
 
-            relation.data[self._charm.app]["scrape_jobs"] = json.dumps(jobs)
+        # scrape configs for units of the same application that still exist
+        configs = dict(entry["static_configs"])
+        del configs[event.unit.name]
+        if configs:
+            job = json.loads(entry["job"])
+            job["static_configs"] = [json.loads(config) for config in configs.values()]
+            self._store_job(job)
+        else:
+            del self._stored.jobs[job_name]
+        self._publish()
 
     def _update_alert_rules(self, event):
         """Update alert rules in response to scrape target changes.
@@ -1984,18 +2696,9 @@ class MetricsEndpointAggregator(Object):
         if not unit_rules:
             return
 
-        appname = event.relation.app.name
-        rules = self._label_alert_rules(unit_rules, appname)
-        # the alert rule group that has changed
-        updated_group = {"name": self._group_name(appname), "rules": rules}
-
-        for relation in self.model.relations[self._prometheus_relation]:
-            alert_rules = json.loads(relation.data[self._charm.app].get("alert_rules", "{}"))
-            groups = alert_rules.get("groups", [])
-            # list of alert rule groups that have not changed
-            groups = [group for group in groups if updated_group["name"] != group["name"]]
-            groups.append(updated_group)
-            relation.data[self._charm.app]["alert_rules"] = json.dumps({"groups": groups})
+        self._ensure_store()
+        self._store_group(event.relation.app.name, unit_rules)
+        self._publish()
 
     def _remove_alert_rules(self, event):
         """Remove alert rules for departed targets.
@@ -2003,40 +2706,99 @@ class MetricsEndpointAggregator(Object):
         Any time a scrape target departs any alert rules associated
         with that specific scrape target is removed.
         """
+        self._ensure_store()
         group_name = self._group_name(event.relation.app.name)
-        unit_name = event.unit.name
+        entry = self._stored.groups.get(group_name)
+        if not entry or event.unit.name not in entry["rules"]:
+            return
 
-        for relation in self.model.relations[self._prometheus_relation]:
-            alert_rules = json.loads(relation.data[self._charm.app].get("alert_rules", "{}"))
-            if not alert_rules:
-                continue
+        # alert rules not associated with departing unit
+        rules = dict(entry["rules"])
+        del rules[event.unit.name]
+        if rules:
+            self._stored.groups[group_name] = self._group_entry(group_name, rules)
+        else:
+            del self._stored.groups[group_name]
+        self._publish()
 
-            groups = alert_rules.get("groups", [])
-            if not groups:
-                continue
+    def _ensure_store(self) -> None:
+        """Index the jobs and alert rules of all related scrape targets, if not done yet.
 
-            changed_group = [group for group in groups if group["name"] == group_name]
-            if not changed_group:
-                continue
-            changed_group = changed_group[0]
+        The store is kept across hooks. It only needs building from the relations once, e.g.
+        after an upgrade from a version of this library without it.
+        """
+        if self._stored.indexed:
+            return
 
-            # list of alert rule groups that have not changed
-            groups = [group for group in groups if group["name"] != group_name]
+        self._stored.jobs = {}
+        for relation in self.model.relations[self._target_relation]:
+            targets = self._get_targets(relation)
+            if targets and relation.app:
+                self._store_job(self._static_scrape_job(targets, relation.app.name))
 
-            # list of alert rules not associated with departing unit
-            rules_kept = [
-                rule
-                for rule in changed_group.get("rules")  # type: ignore
-                if rule.get("labels").get("juju_unit") != unit_name
-            ]
+        self._stored.groups = {}
+        for relation in self.model.relations[self._alert_rules_relation]:
+            unit_rules = self._get_alert_rules(relation)
+            if unit_rules and relation.app:
+                self._store_group(relation.app.name, unit_rules)
+
+        self._stored.indexed = True
+
+    def _store_job(self, job: dict) -> None:
+        """Replace a scrape job in the store, indexing its static configs by unit."""
+        static_configs = {}
+        for index, config in enumerate(job.get("static_configs", [])):
+            unit_name = config.get("labels", {}).get("juju_unit", str(index))
+            static_configs[unit_name] = config
+        # in unit order, so that the relation data does not change with the order of units
+        job = dict(job, static_configs=[static_configs[unit] for unit in sorted(static_configs)])
+        self._stored.jobs[job["job_name"]] = {
+            "job": json.dumps({k: v for k, v in job.items() if k != "static_configs"}),
+            "static_configs": {unit: json.dumps(static_configs[unit]) for unit in static_configs},
+            "rendered": json.dumps(job),
+        }
+
+    def _store_group(self, appname: str, unit_rules: dict) -> None:
+        """Replace the alert rule group of an application in the store."""
+        rules = {
+            unit_name: json.dumps(self._label_alert_rules({unit_name: rules}, appname))
+            for unit_name, rules in unit_rules.items()
+        }
+        group_name = self._group_name(appname)
+        self._stored.groups[group_name] = self._group_entry(group_name, rules)
+
+    @staticmethod
+    def _group_entry(group_name: str, rules: Mapping[str, str]) -> dict:
+        """Store entry for an alert rule group, from the JSON encoded rules of each unit."""
+        group_rules = [rule for unit in sorted(rules) for rule in json.loads(rules[unit])]
+        return {
+            "rules": dict(rules),
+            "rendered": json.dumps({"name": group_name, "rules": group_rules}),
+        }
 
-            if rules_kept:
-                changed_group["rules"] = rules_kept  # type: ignore
-                groups.append(changed_group)
+    def _publish(self, relations: Optional[list] = None) -> None:
+        """Set the stored scrape jobs and alert rules in the Prometheus relations.
 
-            relation.data[self._charm.app]["alert_rules"] = (
-                json.dumps({"groups": groups}) if groups else "{}"
+        The relation data is assembled from the JSON of each job and group, rendered when that
+        job or group last changed, so nothing is decoded or encoded again.
+        """
+        jobs = self._stored.jobs
+        groups = self._stored.groups
+        scrape_jobs = "[{}]".format(", ".join(jobs[name]["rendered"] for name in sorted(jobs)))
+        alert_rules = (
+            '{{"groups": [{}]}}'.format(
+                ", ".join(groups[name]["rendered"] for name in sorted(groups))
             )
+            if groups
+            else "{}"
+        )
+        if relations is None:
+            relations = self.model.relations[self._prometheus_relation]
+        for relation in relations:
+            databag = relation.data[self._charm.app]
+            encodings = _supported_encodings(relation)
+            _set_encoded_relation_data(databag, "scrape_jobs", scrape_jobs, encodings)
+            _set_encoded_relation_data(databag, "alert_rules", alert_rules, encodings)
 
     def _get_targets(self, relation) -> dict:
         """Fetch scrape targets for a relation.
@@ -2085,6 +2847,8 @@ class MetricsEndpointAggregator(Object):
             structure "rule dictionary" corresponds to single
             Prometheus alert rule.
         """
+        import yaml
+
         rules = {}
         for unit in relation.units:
             unit_rules = yaml.safe_load(relation.data[unit].get("groups", ""))
@@ -2219,31 +2983,175 @@ class MetricsEndpointAggregator(Object):
         )
 
 
-class PromqlTransformer:
-    """Uses promql-transform to inject label matchers into alert rule expressions."""
+_PROMQL_TOKEN = re.compile(
+    r"""
+    (?P<space>\s+|\#[^\n]*)
+    |(?P<string>"(?:[^"\\\n]|\\.)*"|'(?:[^'\\\n]|\\.)*'|`[^`]*`)
+    |(?P<duration>(?:[0-9]+(?:ms|[smhdwy]))+(?![a-zA-Z0-9_:]))
+    |(?P<number>0[xX][0-9a-fA-F]+|(?:[0-9]+\.?[0-9]*|\.[0-9]+)(?:[eE][+-]?[0-9]+)?)
+    |(?P<identifier>[a-zA-Z_:][a-zA-Z0-9_:]*)
+    |(?P<operator>=~|!~|!=|==|<=|>=|[-+*/%^<>=,(){}\[\]@:])
+    """,
+    re.VERBOSE,
+)
+# identifiers that are never vector selectors, as PromQL reserves them
+_PROMQL_KEYWORDS = {
+    "and",
+    "atan2",
+    "avg",
+    "bool",
+    "bottomk",
+    "by",
+    "count",
+    "count_values",
+    "group",
+    "group_left",
+    "group_right",
+    "ignoring",
+    "inf",
+    "limitk",
+    "limit_ratio",
+    "max",
+    "min",
+    "nan",
+    "offset",
+    "on",
+    "or",
+    "quantile",
+    "stddev",
+    "stdvar",
+    "sum",
+    "topk",
+    "unless",
+    "without",
+}
+# keywords followed by a parenthesised list of label names
+_PROMQL_LABEL_LIST_KEYWORDS = {"by", "without", "on", "ignoring", "group_left", "group_right"}
+_PROMQL_CLOSING = {"{": "}", "[": "]", "(": ")"}
+_PROMQL_MATCH_OPERATORS = {"=", "!=", "=~", "!~"}
 
-    _path = None
-    _disabled = False
 
-    @property
-    def path(self):
-        """Lazy lookup of the path of promql-transform."""
-        if self._disabled:
-            return None
-        if not self._path:
-            self._path = self._get_transformer_path()
-            if not self._path:
-                logger.debug("Skipping injection of juju topology as label matchers")
-                self._disabled = True
-        return self._path
+def _promql_tokens(expression: str) -> List[tuple]:
+    """Split a PromQL expression into `(kind, text, start, end)` tokens, without whitespace.
+
+    Raises:
+        ValueError: if the expression contains characters no PromQL token starts with, or has
+            unbalanced brackets.
+    """
+    tokens = []
+    opened = []
+    position = 0
+    while position < len(expression):
+        match = _PROMQL_TOKEN.match(expression, position)
+        if not match:
+            raise ValueError("Unexpected character at {}: {}".format(position, expression))
+        text = match.group()
+        if text in _PROMQL_CLOSING:
+            opened.append(_PROMQL_CLOSING[text])
+        elif text in _PROMQL_CLOSING.values() and (not opened or opened.pop() != text):
+            raise ValueError("Unbalanced '{}' at {}: {}".format(text, position, expression))
+        if match.lastgroup != "space":
+            tokens.append((match.lastgroup, text, match.start(), match.end()))
+        position = match.end()
+    if opened:
+        raise ValueError("Missing '{}': {}".format(opened[-1], expression))
+    return tokens
+
+
+def _closing_index(tokens: List[tuple], index: int) -> int:
+    """Index of the token closing the bracket opened at `index`."""
+    opening = tokens[index][1]
+    depth = 0
+    for i in range(index, len(tokens)):
+        if tokens[i][1] == opening:
+            depth += 1
+        elif tokens[i][1] == _PROMQL_CLOSING[opening]:
+            depth -= 1
+            if depth == 0:
+                return i
+    raise ValueError("Unbalanced '{}' at {}".format(opening, tokens[index][2]))
+
+
+def _format_matchers(matchers: tuple) -> str:
+    return ",".join(
+        '{}="{}"'.format(name, value.replace("\\", "\\\\").replace('"', '\\"'))
+        for name, value in matchers
+    )
+
+
+@functools.lru_cache(maxsize=4096)
+def _inject_label_matchers(expression: str, matchers: tuple) -> str:
+    """Add equality label matchers to every vector selector of a PromQL expression.
+
+    Selectors already matching on one of the labels keep their own matcher for that label.
+    Everything else in the expression is left as written.
+
+    Args:
+        expression: a PromQL expression.
+        matchers: a tuple of `(label, value)` pairs.
+
+    Returns:
+        The expression with the matchers injected.
+
+    Raises:
+        ValueError: if the expression cannot be tokenized or has unbalanced brackets.
+    """
+    tokens = _promql_tokens(expression)
+    # (position, text) insertions, in increasing position
+    insertions = []
+    i = 0
+    while i < len(tokens):
+        kind, text, _, end = tokens[i]
+        following = tokens[i + 1][1] if i + 1 < len(tokens) else None
+        if kind == "identifier" and text.lower() in _PROMQL_LABEL_LIST_KEYWORDS:
+            i = _closing_index(tokens, i + 1) + 1 if following == "(" else i + 1
+        elif text == "[":
+            # range or subquery durations
+            i = _closing_index(tokens, i) + 1
+        elif kind == "identifier" and (text.lower() in _PROMQL_KEYWORDS or following == "("):
+            i += 1
+        elif kind == "identifier" and following != "{":
+            insertions.append((end, "{{{}}}".format(_format_matchers(matchers))))
+            i += 1
+        elif text == "{" or kind == "identifier":
+            opening = i if text == "{" else i + 1
+            closing = _closing_index(tokens, opening)
+            inner = tokens[opening:closing][1:]
+            present = {
+                name
+                for (_, name, _, _), (_, operator, _, _) in zip(inner, inner[1:])
+                if operator in _PROMQL_MATCH_OPERATORS
+            }
+            missing = tuple((name, value) for name, value in matchers if name not in present)
+            if missing:
+                separator = "," if inner and inner[-1][1] != "," else ""
+                insertions.append((tokens[closing][2], separator + _format_matchers(missing)))
+            i = closing + 1
+        else:
+            i += 1
+
+    parts = []
+    previous = 0
+    for position, text in insertions:
+        parts.extend([expression[previous:position], text])
+        previous = position
+    parts.append(expression[previous:])
+    return "".join(parts)
+
+
+class PromqlTransformer:
+    """Injects label matchers into alert rule expressions.
+
+    Expressions are rewritten in-process by a PromQL tokenizer, so relating to many
+    applications does not fork a process per alert rule. Rewritten expressions are memoized
+    by expression and topology.
+    """
 
     def __init__(self, charm):
         self._charm = charm
 
     def apply_label_matchers(self, rules):
         """Will apply label matchers to the expression of all alerts in all supplied groups."""
-        if not self.path:
-            return rules
         for group in rules["groups"]:
             rules_in_group = group.get("rules", [])
             for rule in rules_in_group:
@@ -2266,39 +3174,8 @@ class PromqlTransformer:
     def _apply_label_matcher(self, expression, topology):
         if not topology:
             return expression
-        if not self.path:
-            logger.debug(
-                "`promql-transform` unavailable. leaving expression unchanged: %s", expression
-            )
-            return expression
-        args = [str(self.path)]
-        args.extend(
-            ["--label-matcher={}={}".format(key, value) for key, value in topology.items()]
-        )
-
-        args.extend(["{}".format(expression)])
-        # noinspection PyBroadException
         try:
-            return self._exec(args)
-        except Exception as e:
+            return _inject_label_matchers(expression, tuple(topology.items()))
+        except ValueError as e:
             logger.debug('Applying the expression failed: "%s", falling back to the original', e)
             return expression
-
-    def _get_transformer_path(self) -> Optional[Path]:
-        arch = platform.processor()
-        arch = "amd64" if arch == "x86_64" else arch
-        res = "promql-transform-{}".format(arch)
-        try:
-            path = Path(res).resolve()
-            path.chmod(0o777)
-            return path
-        except NotImplementedError:
-            logger.debug("System lacks support for chmod")
-        except FileNotFoundError:
-            logger.debug('Could not locate promql transform at: "{}"'.format(res))
-        return None
-
-    def _exec(self, cmd):
-        result = subprocess.run(cmd, check=False, stdout=subprocess.PIPE)
-        output = result.stdout.decode("utf-8").strip()
-        return output
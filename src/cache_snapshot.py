@@ -0,0 +1,172 @@
+# Copyright 2022 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""Keep the hub cache across restarts by draining it to disk and pushing it back.
+
+Scraping the hub drains its cache in the Prometheus text exposition format. Before the hub is
+restarted, the cache is scraped into a gzip-compressed snapshot on the workload's persistent
+storage. Once the hub is back, the snapshot is read back and pushed to the hub in chunks of
+whole metric families, so that neither the charm nor the hub holds the whole cache twice.
+
+The uncompressed offset up to which the snapshot has been replayed is kept next to it, so that
+a replay cut short resumes after the last chunk the hub got rather than pushing it again.
+"""
+
+import gzip
+import logging
+import shutil
+import tempfile
+import urllib.error
+import urllib.request
+from typing import IO, Iterator, List
+
+from ops.model import Container
+from ops.pebble import PathError
+
+logger = logging.getLogger(__name__)
+
+CHUNK_BYTES = 1024 * 1024
+HUB_TIMEOUT = 30
+CONTENT_TYPE = "text/plain; version=0.0.4"
+
+
+class CacheSnapshot:
+    """Snapshot of the hub cache stored in the workload container."""
+
+    def __init__(self, container: Container, path: str, hub_url: str):
+        """Constructor for CacheSnapshot.
+
+        Args:
+            container: the workload container holding the snapshot.
+            path: path of the snapshot file in the workload container.
+            hub_url: base URL of the hub HTTP API, as reachable from the charm.
+        """
+        self._container = container
+        self._path = path
+        self._offset_path = f"{path}.offset"
+        self._metrics_url = f"{hub_url}/metrics"
+
+    @property
+    def exists(self) -> bool:
+        """Whether a snapshot is waiting to be replayed."""
+        return self._container.exists(self._path)
+
+    def save(self) -> bool:
+        """Drains the hub cache into the snapshot.
+
+        Any snapshot not replayed yet is kept and the cache is appended to it, so that
+        successive restarts before a successful replay do not lose samples.
+
+        Returns:
+            whether the cache was drained.
+        """
+        with tempfile.TemporaryFile() as compressed:
+            if self.exists:
+                shutil.copyfileobj(self._container.pull(self._path, encoding=None), compressed)
+            else:
+                self._remove_offset()
+            try:
+                with urllib.request.urlopen(self._metrics_url, timeout=HUB_TIMEOUT) as response:
+                    # concatenated gzip members form a valid gzip stream
+                    with gzip.GzipFile(fileobj=compressed, mode="ab") as snapshot:
+                        shutil.copyfileobj(response, snapshot)
+            except (urllib.error.URLError, OSError) as e:
+                logger.warning("Failed to drain the hub cache into a snapshot: %s", e)
+                return False
+            compressed.seek(0)
+            self._container.push(self._path, compressed, make_dirs=True, encoding=None)
+        logger.info("Saved hub cache snapshot to %s", self._path)
+        return True
+
+    def restore(self) -> bool:
+        """Pushes the snapshot back into the hub and removes it.
+
+        The hub is not waited for: if it does not answer, the replay is left for a later
+        attempt, which resumes after the last chunk the hub got.
+
+        Returns:
+            whether the snapshot was fully replayed. A snapshot that could not be replayed is
+            kept for a later attempt.
+        """
+        try:
+            source = self._container.pull(self._path, encoding=None)
+        except PathError:
+            return True
+        offset = self._replayed_offset()
+        pushed = 0
+        try:
+            with gzip.GzipFile(fileobj=source, mode="rb") as snapshot:
+                _skip(snapshot, offset)
+                for chunk in _chunks(snapshot, CHUNK_BYTES):
+                    try:
+                        self._push(chunk)
+                    except urllib.error.HTTPError as e:
+                        if not 400 <= e.code < 500:
+                            raise
+                        # retrying would not help, e.g. when the cache limit is reached
+                        logger.warning(
+                            "Hub rejected %d bytes of cache snapshot: %s", len(chunk), e
+                        )
+                    else:
+                        pushed += len(chunk)
+                    offset += len(chunk)
+                    self._container.push(self._offset_path, str(offset), make_dirs=True)
+        except (urllib.error.URLError, OSError, EOFError) as e:
+            logger.warning("Failed to replay cache snapshot after %d bytes: %s", offset, e)
+            return False
+        self._container.remove_path(self._path)
+        self._remove_offset()
+        logger.info("Replayed %d bytes of cache snapshot into the hub", pushed)
+        return True
+
+    def _replayed_offset(self) -> int:
+        """Returns the uncompressed offset up to which the snapshot was replayed already."""
+        try:
+            return int(self._container.pull(self._offset_path).read())
+        except (PathError, ValueError):
+            return 0
+
+    def _remove_offset(self) -> None:
+        if self._container.exists(self._offset_path):
+            self._container.remove_path(self._offset_path)
+
+    def _push(self, chunk: bytes) -> None:
+        request = urllib.request.Request(
+            self._metrics_url,
+            data=chunk,
+            method="POST",
+            headers={"Content-Type": CONTENT_TYPE},
+        )
+        with urllib.request.urlopen(request, timeout=HUB_TIMEOUT):
+            pass
+
+
+def _skip(snapshot: IO[bytes], size: int) -> None:
+    """Reads past the first `size` bytes of the snapshot, without holding them."""
+    while size > 0:
+        skipped = len(snapshot.read(min(size, CHUNK_BYTES)))
+        if not skipped:
+            raise EOFError("cache snapshot shorter than its replayed offset")
+        size -= skipped
+
+
+def _chunks(snapshot: IO[bytes], chunk_bytes: int) -> Iterator[bytes]:
+    """Splits an exposition stream into chunks of whole metric families.
+
+    A metric family starts with its "# HELP"/"# TYPE" comments, so a comment following a
+    sample starts a new family. Chunks are cut at family boundaries once they reach
+    `chunk_bytes`.
+    """
+    chunk: List[bytes] = []
+    size = 0
+    previous_is_sample = False
+    for line in snapshot:
+        is_comment = line.startswith(b"#")
+        if is_comment and previous_is_sample and size >= chunk_bytes:
+            yield b"".join(chunk)
+            chunk, size = [], 0
+        chunk.append(line)
+        size += len(line)
+        previous_is_sample = not is_comment and bool(line.strip())
+    if chunk:
+        yield b"".join(chunk)
@@ -2,58 +2,162 @@
 # Copyright 2021 Canonical Ltd.
 # See LICENSE file for licensing details.
 
+import hashlib
+import json
 import logging
+import socket
+import time
+from functools import cached_property
+from pathlib import Path
+from typing import Optional
 
-from charms.observability_libs.v1.kubernetes_service_patch import (
-    KubernetesServicePatch,
-    ServicePort,
-)
+from charms.observability_libs.v1.kubernetes_service_patch import KubernetesServicePatch
+from charms.prometheus_edge_hub.v0.push_endpoint import PushEndpointProvider
 from charms.prometheus_k8s.v0.prometheus_scrape import MetricsEndpointProvider
-from ops.charm import CharmBase, PebbleReadyEvent, RelationJoinedEvent
+from ops.charm import (
+    CharmBase,
+    PebbleReadyEvent,
+    RelationJoinedEvent,
+    UpdateStatusEvent,
+)
+from ops.framework import EventBase, StoredState
 from ops.main import main
 from ops.model import (
     ActiveStatus,
+    BlockedStatus,
+    Container,
     MaintenanceStatus,
     ModelError,
     Relation,
     WaitingStatus,
 )
-from ops.pebble import Layer
+from ops.pebble import CheckLevel, CheckStatus, Layer, PathError
+
+from cache_snapshot import CacheSnapshot
+from instrumentation import Instrumentation
+from rolling_restart import RollingRestart
 
 logger = logging.getLogger(__name__)
 
 PROMETHEUS_EDGE_HUB_PORT = 9091
 PROMETHEUS_EDGE_HUB_GRPC_PORT = 9092
+# Port the hub listens on when the ingest front-end takes over the public push port
+PROMETHEUS_EDGE_HUB_INTERNAL_PORT = 9093
 CHARM_NAME = "prometheus-edge-hub"
+PEER_RELATION_NAME = "replicas"
+SNAPSHOT_STORAGE_NAME = "cache-snapshot"
+SNAPSHOT_PATH = "/var/lib/prometheus-edge-hub/cache-snapshot.gz"
+HTTP_CHECK_NAME = f"{CHARM_NAME}-http"
+GRPC_CHECK_NAME = f"{CHARM_NAME}-grpc"
+# How long a restart waits for the hub to accept connections, which measures its restart latency
+HUB_READY_TIMEOUT = 5
+HUB_READY_POLL_INTERVAL = 0.1
+INGEST_NAME = "ingest"
+INGEST_CHECK_NAME = f"{INGEST_NAME}-tcp"
+# The ingest package is copied from the charm into this directory of the ingest container
+INGEST_SOURCE_PATH = Path(__file__).parent / INGEST_NAME
+INGEST_PATH = "/opt/ingest"
+INGEST_METRICS_PATH = "/ingest/metrics"
+REMOTE_WRITE_RELATION_NAME = "receive-remote-write"
+SCRAPE_MODES = ("service", "unit")
+CGROUP_V2_MEMORY_LIMIT_PATH = "/sys/fs/cgroup/memory.max"
+CGROUP_V1_MEMORY_LIMIT_PATH = "/sys/fs/cgroup/memory/memory.limit_in_bytes"
+# cgroup v1 reports "no limit" as a page-aligned value close to 2^63
+CGROUP_UNLIMITED_THRESHOLD = 2**60
+# Upper bound of the resident memory of one cached series in prometheus-edge-hub 1.1.0, Go GC
+# headroom included, as the cgroup counts it. The hub-memory-benchmark CI job measures it from
+# the RSS of the workload image holding 10k to 1M pushed series (bytes_per_series in its
+# benchmark.json), and fails if it exceeds this bound
+SERIES_MEMORY_BYTES = 1024
+# Memory used by the hub process regardless of the cache size
+HUB_BASE_MEMORY_BYTES = 32 * 1024 * 1024
+# With priority classes, the ingest sidecar keeps the cache within the limit, and the hub limit
+# is only a backstop for the pushes the sidecar does not see (gRPC)
+ADMISSION_BACKSTOP_PERCENT = 25
+# Resident memory of one sample held by the ingest sidecar with priority classes, rounded up.
+# Measured at about 1.2 KiB from the RSS of a process holding 100k to 1M samples of two labels
+# (CPython 3.11), see test_admission_memory_per_sample in tests/benchmark
+HELD_SAMPLE_MEMORY_BYTES = 1536
+# Memory used by the ingest sidecar regardless of the samples it holds, about 22 MiB measured
+INGEST_BASE_MEMORY_BYTES = 32 * 1024 * 1024
 
 
 class PrometheusEdgeHubCharm(CharmBase):
+    _stored = StoredState()
+
     def __init__(self, *args):
         super().__init__(*args)
         self._container_name = self._service_name = CHARM_NAME
         self._container = self.unit.get_container(CHARM_NAME)
+        self._ingest_container = self.unit.get_container(INGEST_NAME)
+        hub_url = f"http://localhost:{PROMETHEUS_EDGE_HUB_PORT}"
+        # instrument before anything else calls Pebble or hook tools
+        self._instrumentation = Instrumentation(self, [self._container], hub_url)
+        self._stored.set_default(restart_latency=None)
         self.framework.observe(self.on.prometheus_edge_hub_pebble_ready, self._configure)
+        self.framework.observe(self.on.ingest_pebble_ready, self._configure)
         self.framework.observe(
             self.on.metrics_endpoint_relation_joined, self._on_metrics_endpoint_relation_joined
         )
         self.framework.observe(self.on.config_changed, self._configure)
+        remote_write = self.on[REMOTE_WRITE_RELATION_NAME]
+        self.framework.observe(remote_write.relation_changed, self._configure)
+        self.framework.observe(remote_write.relation_departed, self._configure)
+        self.framework.observe(remote_write.relation_broken, self._configure)
+        self.framework.observe(self.on.update_status, self._on_update_status)
+        self.framework.observe(self.on.stop, self._on_stop)
+        self._cache_snapshot = CacheSnapshot(self._container, SNAPSHOT_PATH, hub_url)
         self._service_patcher = KubernetesServicePatch(
-            self,
-            [
-                ServicePort(name=CHARM_NAME, port=PROMETHEUS_EDGE_HUB_PORT),
-                ServicePort(name=f"{CHARM_NAME}-grpc", port=PROMETHEUS_EDGE_HUB_GRPC_PORT),
-            ],
+            self, self._service_ports, client=self._instrumentation.kubernetes_client
+        )
+        self.metrics_endpoint_provider = MetricsEndpointProvider(self, jobs=self._scrape_jobs)
+        self.push_endpoint_provider = PushEndpointProvider(
+            self, http_port=PROMETHEUS_EDGE_HUB_PORT, grpc_port=PROMETHEUS_EDGE_HUB_GRPC_PORT
         )
-        self.metrics_endpoint_provider = MetricsEndpointProvider(
+        self._rolling_restart = RollingRestart(
             self,
-            jobs=[
+            PEER_RELATION_NAME,
+            restart=self._restart_workloads,
+            is_ready=lambda: self._hub_is_ready,
+        )
+
+    @staticmethod
+    def _service_ports() -> list:
+        """Returns the ports of the Kubernetes service.
+
+        lightkube is only imported here, so that hooks not patching the service skip loading it.
+        """
+        from lightkube.models.core_v1 import ServicePort
+
+        return [
+            ServicePort(name=CHARM_NAME, port=PROMETHEUS_EDGE_HUB_PORT),
+            ServicePort(name=f"{CHARM_NAME}-grpc", port=PROMETHEUS_EDGE_HUB_GRPC_PORT),
+        ]
+
+    @property
+    def _scrape_jobs(self) -> list:
+        """Returns the scrape jobs matching the configured scrape mode.
+
+        In "unit" mode the wildcard host makes Prometheus scrape every unit individually,
+        otherwise the Kubernetes service is scraped. With the ingest sidecar, its own metrics
+        are scraped from every unit by a second job. While the hub is drained to remote-write,
+        scraping it returns no samples, so its job is not published.
+        """
+        if self.model.config["scrape_mode"] == "unit":
+            target = f"*:{PROMETHEUS_EDGE_HUB_PORT}"
+        else:
+            target = f"{self.app.name}:{PROMETHEUS_EDGE_HUB_PORT}"
+        jobs = [] if self._remote_write_urls else [{"static_configs": [{"targets": [target]}]}]
+        if self._ingest_enabled:
+            # the ingest metrics of every unit, apart from the hub's, see `ingest.app.Router`
+            jobs.append(
                 {
-                    "static_configs": [
-                        {"targets": [f"{self.app.name}:{PROMETHEUS_EDGE_HUB_PORT}"]}
-                    ],
+                    "job_name": INGEST_NAME,
+                    "metrics_path": INGEST_METRICS_PATH,
+                    "static_configs": [{"targets": [f"*:{PROMETHEUS_EDGE_HUB_PORT}"]}],
                 }
-            ],
-        )
+            )
+        return jobs
 
     def _command(self) -> str:
         """
@@ -62,13 +166,167 @@ class PrometheusEdgeHubCharm(CharmBase):
         """
         config = self.model.config
         args = [f"-grpc-port={PROMETHEUS_EDGE_HUB_GRPC_PORT}"]
-        if config["metrics_count_limit"] != -1:
-            args.append(f"-limit={config['metrics_count_limit']}")
+        if self._hub_port != PROMETHEUS_EDGE_HUB_PORT:
+            args.append(f"-port={self._hub_port}")
+        metrics_count_limit = self._metrics_count_limit()
+        # a derived limit is all the hub memory allows, so the backstop is reserved within it
+        # rather than on top, see `_admission_limit`
+        derived = self._metrics_count_limit_derived
+        if metrics_count_limit != -1 and self._priority_classes_text and not derived:
+            backstop = metrics_count_limit * (100 + ADMISSION_BACKSTOP_PERCENT) // 100
+            args.append(f"-limit={backstop}")
+        elif metrics_count_limit != -1:
+            args.append(f"-limit={metrics_count_limit}")
         if config["scrape_timeout"] != 10:
             args.append(f"-scrapeTimeout={config['scrape_timeout']}")
         command = ["prometheus-edge-hub"] + args
         return " ".join(command)
 
+    @property
+    def _ingest_enabled(self) -> bool:
+        config = self.model.config
+        return any(
+            (
+                config["ingest_frontend"],
+                config["ingest_batch_pushes"],
+                config["ingest_aggregation_rules"].strip(),
+                self._priority_classes_text,
+                self._remote_write_urls,
+            )
+        )
+
+    @property
+    def _applied_hub_port(self) -> int:
+        """Returns the HTTP port of the hub in its current pebble plan."""
+        service = self._container.get_plan().services.get(CHARM_NAME)
+        command = service.command.split() if service is not None else []
+        for arg in command:
+            if arg.startswith("-port="):
+                return int(arg.split("=", 1)[1])
+        return PROMETHEUS_EDGE_HUB_PORT
+
+    @property
+    def _remote_write_urls(self) -> list:
+        """Returns the remote-write URLs the units of related Prometheus applications publish.
+
+        While there are some, the ingest sidecar drains the hub and sends its samples to them.
+        """
+        urls = set()
+        for relation in self.model.relations[REMOTE_WRITE_RELATION_NAME]:
+            for unit in relation.units:
+                try:
+                    url = json.loads(relation.data[unit].get("remote_write", "{}")).get("url")
+                except (json.JSONDecodeError, AttributeError):
+                    logger.warning("Ignoring invalid remote_write data of %s", unit.name)
+                    continue
+                if url:
+                    urls.add(url)
+        return sorted(urls)
+
+    @property
+    def _hub_port(self) -> int:
+        """Returns the HTTP port of the hub, which is internal when the ingest front-end is on."""
+        if self._ingest_enabled:
+            return PROMETHEUS_EDGE_HUB_INTERNAL_PORT
+        return PROMETHEUS_EDGE_HUB_PORT
+
+    @property
+    def _metrics_count_limit_derived(self) -> bool:
+        """Whether the cache limit is derived from the container memory limit."""
+        config = self.model.config
+        return config["metrics_count_limit"] == -1 and config["metrics_count_limit_auto"]
+
+    def _metrics_count_limit(self) -> int:
+        """Returns the cache limit, derived from the container memory limit in auto mode.
+
+        An explicitly configured limit always takes precedence. -1 means no limit, and 0 a
+        memory limit too low for the hub to hold any series, see `_config_error`.
+        """
+        config = self.model.config
+        if not self._metrics_count_limit_derived:
+            return config["metrics_count_limit"]
+        memory_limit = self._container_memory_limit
+        if memory_limit is None:
+            logger.warning("Container has no memory limit, the hub cache is not limited")
+            return -1
+        headroom = config["metrics_count_limit_headroom"]
+        usable_memory = memory_limit * (100 - headroom) // 100 - HUB_BASE_MEMORY_BYTES
+        return max(0, usable_memory // SERIES_MEMORY_BYTES)
+
+    def _admission_limit(self) -> int:
+        """Returns the number of samples the ingest sidecar holds with priority classes.
+
+        A derived cache limit is already all the hub memory allows, so the backstop of the hub
+        is reserved within it. The samples are held in the ingest container, so its memory
+        limit bounds them as well. -1 means no limit.
+
+        Raises:
+            ValueError: if the ingest container memory limit is too low to hold samples.
+        """
+        limit = self._metrics_count_limit()
+        if limit == -1:
+            return -1
+        if self._metrics_count_limit_derived:
+            limit = limit * 100 // (100 + ADMISSION_BACKSTOP_PERCENT)
+        memory_limit = self._ingest_memory_limit
+        if memory_limit is not None:
+            headroom = self.model.config["metrics_count_limit_headroom"]
+            usable_memory = memory_limit * (100 - headroom) // 100 - INGEST_BASE_MEMORY_BYTES
+            if usable_memory < HELD_SAMPLE_MEMORY_BYTES:
+                raise ValueError(f"the {INGEST_NAME} container memory limit is too low")
+            limit = min(limit, usable_memory // HELD_SAMPLE_MEMORY_BYTES)
+        return limit
+
+    @cached_property
+    def _container_memory_limit(self) -> Optional[int]:
+        """Returns the cgroup memory limit of the workload container in bytes, if any.
+
+        The limit is only pulled from the container once per hook, as the charm is instantiated
+        for each hook.
+        """
+        return self._memory_limit(self._container)
+
+    @cached_property
+    def _ingest_memory_limit(self) -> Optional[int]:
+        """Returns the cgroup memory limit of the ingest container in bytes, if any known."""
+        return self._memory_limit(self._ingest_container)
+
+    @staticmethod
+    def _memory_limit(container: Container) -> Optional[int]:
+        if not container.can_connect():
+            return None
+        for path in (CGROUP_V2_MEMORY_LIMIT_PATH, CGROUP_V1_MEMORY_LIMIT_PATH):
+            try:
+                value = container.pull(path).read().strip()
+            except PathError:
+                continue
+            if value == "max" or not value.isdigit() or int(value) >= CGROUP_UNLIMITED_THRESHOLD:
+                return None
+            return int(value)
+        return None
+
+    @property
+    def _active_status_message(self) -> str:
+        """Returns the unit status message.
+
+        It shows the cache limit when it is derived, and that the hub is not scraped while it
+        is drained to remote-write.
+        """
+        config = self.model.config
+        messages = []
+        if self._metrics_count_limit_derived:
+            metrics_count_limit = self._metrics_count_limit()
+            if metrics_count_limit == -1:
+                messages.append("Cache limit: unlimited (no memory limit)")
+            else:
+                headroom = config["metrics_count_limit_headroom"]
+                messages.append(
+                    f"Cache limit: {metrics_count_limit} series ({headroom}% memory headroom)"
+                )
+        if self._remote_write_urls:
+            messages.append("Hub drained to remote-write, not scraped")
+        return "; ".join(messages)
+
     @property
     def _pebble_layer(self) -> Layer:
         """Returns the pebble layer."""
@@ -81,38 +339,358 @@ class PrometheusEdgeHubCharm(CharmBase):
                         "override": "replace",
                         "startup": "enabled",
                         "command": self._command(),
+                        "backoff-delay": "1s",
+                        "backoff-limit": "10s",
+                        "on-check-failure": {
+                            HTTP_CHECK_NAME: "restart",
+                            GRPC_CHECK_NAME: "restart",
+                        },
+                    },
+                },
+                "checks": {
+                    HTTP_CHECK_NAME: {
+                        "override": "replace",
+                        "level": "ready",
+                        "period": "5s",
+                        "timeout": "3s",
+                        "threshold": 3,
+                        # GET /metrics drains the cache, so it must never be used as a probe
+                        "http": {"url": f"http://localhost:{self._hub_port}/debug"},
+                    },
+                    GRPC_CHECK_NAME: {
+                        "override": "replace",
+                        "level": "ready",
+                        "period": "5s",
+                        "timeout": "3s",
+                        "threshold": 3,
+                        "tcp": {"port": PROMETHEUS_EDGE_HUB_GRPC_PORT},
                     },
                 },
             }
         )
 
+    @property
+    def _ingest_settings(self) -> dict:
+        """Returns the settings of the ingest sidecar, see `ingest.config.DEFAULTS`."""
+        config = self.model.config
+        return {
+            "listen_port": PROMETHEUS_EDGE_HUB_PORT,
+            "hub_port": PROMETHEUS_EDGE_HUB_INTERNAL_PORT,
+            "hub_connections": config["ingest_hub_connections"],
+            "max_connections": config["ingest_max_connections"],
+            "batch_pushes": config["ingest_batch_pushes"],
+            "batch_max_bytes": config["ingest_batch_max_bytes"],
+            "batch_max_age": config["ingest_batch_max_age"],
+            "aggregation_rules": self._aggregation_rules(),
+            "priority_classes": self._priority_classes(),
+            "admission_limit": self._admission_limit() if self._priority_classes_text else -1,
+            "remote_write_urls": self._remote_write_urls,
+            "remote_write_interval": config["remote_write_interval"],
+            "remote_write_shards": config["remote_write_shards"],
+            "remote_write_capacity": config["remote_write_queue_capacity"],
+            "remote_write_max_samples": config["remote_write_max_samples_per_send"],
+            "remote_write_labels": {
+                "juju_model": self.model.name,
+                "juju_model_uuid": self.model.uuid,
+                "juju_application": self.app.name,
+                "juju_unit": self.unit.name,
+                "juju_charm": CHARM_NAME,
+            },
+        }
+
+    def _aggregation_rules(self) -> list:
+        """Returns the aggregation rules of the ingest sidecar, see `ingest.aggregation`.
+
+        yaml and the rule compiler are only imported here, when rules are configured.
+
+        Raises:
+            ValueError: if the rules are not valid.
+        """
+        text = self.model.config["ingest_aggregation_rules"]
+        if not text.strip():
+            return []
+        import yaml
+
+        from ingest.aggregation import compile_rules
+
+        try:
+            rules = yaml.safe_load(text)
+        except yaml.YAMLError:
+            raise ValueError("not valid YAML")
+        compile_rules(rules)
+        return rules
+
+    @property
+    def _priority_classes_text(self) -> str:
+        return self.model.config["ingest_priority_classes"].strip()
+
+    def _priority_classes(self) -> list:
+        """Returns the priority classes of the ingest sidecar, see `ingest.admission`.
+
+        yaml and the class compiler are only imported here, when classes are configured.
+
+        Raises:
+            ValueError: if the classes are not valid, or the cache is not limited.
+        """
+        text = self._priority_classes_text
+        if not text:
+            return []
+        import yaml
+
+        from ingest.admission import compile_classes
+
+        try:
+            classes = yaml.safe_load(text)
+        except yaml.YAMLError:
+            raise ValueError("not valid YAML")
+        compile_classes(classes)
+        if self._admission_limit() == -1:
+            raise ValueError("the cache is not limited, see metrics_count_limit")
+        return classes
+
+    @staticmethod
+    def _ingest_sources() -> dict:
+        """Returns the modules of the ingest package, by file name."""
+        return {path.name: path.read_text() for path in sorted(INGEST_SOURCE_PATH.glob("*.py"))}
+
+    def _ingest_layer(self, sources: dict) -> Layer:
+        """Returns the pebble layer of the ingest sidecar.
+
+        The settings and a hash of the package are part of the service environment, so that
+        the service is restarted whenever either changes.
+        """
+        version = hashlib.sha256(json.dumps(sources, sort_keys=True).encode()).hexdigest()
+        return Layer(
+            {
+                "summary": f"{INGEST_NAME} pebble layer",
+                "services": {
+                    INGEST_NAME: {
+                        "summary": "ingest front-end of the hub push port",
+                        "override": "replace",
+                        "startup": "enabled",
+                        "command": "python3 -m ingest",
+                        "environment": {
+                            "PYTHONPATH": INGEST_PATH,
+                            "INGEST_CONFIG": json.dumps(self._ingest_settings, sort_keys=True),
+                            "INGEST_VERSION": version,
+                        },
+                        "backoff-delay": "1s",
+                        "backoff-limit": "10s",
+                        "on-check-failure": {INGEST_CHECK_NAME: "restart"},
+                    },
+                },
+                "checks": {
+                    INGEST_CHECK_NAME: {
+                        "override": "replace",
+                        "level": "ready",
+                        "period": "5s",
+                        "timeout": "3s",
+                        "threshold": 3,
+                        "tcp": {"port": PROMETHEUS_EDGE_HUB_PORT},
+                    },
+                },
+            }
+        )
+
+    @property
+    def _ingest_needs_restart(self) -> bool:
+        """Whether the running ingest sidecar must be restarted or stopped to match the config."""
+        container = self._ingest_container
+        if not container.can_connect():
+            return False
+        try:
+            if not container.get_service(INGEST_NAME).is_running():
+                return False
+        except ModelError:
+            return False
+        if not self._ingest_enabled:
+            return True
+        layer = self._ingest_layer(self._ingest_sources())
+        return container.get_plan().services != layer.services
+
+    def _configure_ingest(self) -> bool:
+        """Runs the ingest sidecar when enabled, and stops it otherwise.
+
+        Returns:
+            whether the sidecar is as configured, which needs its container when enabled.
+        """
+        container = self._ingest_container
+        if not container.can_connect():
+            return not self._ingest_enabled
+        plan = container.get_plan()
+        if not self._ingest_enabled:
+            if INGEST_NAME in plan.services:
+                disabled = {"override": "merge", "startup": "disabled"}
+                container.add_layer(
+                    INGEST_NAME, {"services": {INGEST_NAME: disabled}}, combine=True
+                )
+                if container.get_service(INGEST_NAME).is_running():
+                    container.stop(INGEST_NAME)
+            return True
+        sources = self._ingest_sources()
+        layer = self._ingest_layer(sources)
+        if plan.services != layer.services:
+            for name, source in sources.items():
+                container.push(f"{INGEST_PATH}/{INGEST_NAME}/{name}", source, make_dirs=True)
+            container.add_layer(INGEST_NAME, layer, combine=True)
+            container.replan()
+            logger.info("Configured %s front-end", INGEST_NAME)
+        return True
+
+    def _config_error(self) -> Optional[str]:
+        """Returns why the configuration is invalid, if it is."""
+        scrape_mode = self.model.config["scrape_mode"]
+        if scrape_mode not in SCRAPE_MODES:
+            return f"Invalid scrape_mode: {scrape_mode}"
+        if not 0 <= self.model.config["metrics_count_limit_headroom"] < 100:
+            return "metrics_count_limit_headroom must be in [0, 99]"
+        if self._metrics_count_limit_derived and self._metrics_count_limit() == 0:
+            # an unlimited cache would be the worst fallback for the smallest containers
+            return "Container memory limit too low for metrics_count_limit_auto"
+        try:
+            self._aggregation_rules()
+        except ValueError as e:
+            return f"Invalid ingest_aggregation_rules: {e}"
+        try:
+            self._priority_classes()
+        except ValueError as e:
+            return f"Invalid ingest_priority_classes: {e}"
+        return None
+
     def _configure(self, event: PebbleReadyEvent):
         """
         Configures the pebble layer and patches the Kubernetes services if there's a change to
         be made
         """
+        config_error = self._config_error()
+        if config_error:
+            self.unit.status = BlockedStatus(config_error)
+            return
+        self.metrics_endpoint_provider.update_scrape_job_spec(self._scrape_jobs)
         if self._container.can_connect():
             self.unit.status = MaintenanceStatus("Configuring pod")
-            plan = self._container.get_plan()
-            layer = self._pebble_layer
-            if plan.services != layer.services:
-                self._container.add_layer(CHARM_NAME, layer, combine=True)
-                self._container.restart(CHARM_NAME)
-                logger.info(f"Restarted container {CHARM_NAME}")
-            self.unit.status = ActiveStatus()
+            ingest_ready = self._update_workloads(event)
+            if not self._restore_cache_snapshot():
+                # retried at the start of the next hook rather than waiting for the hub here
+                event.defer()
+            if self._rolling_restart.pending:
+                self.unit.status = WaitingStatus("Waiting for rolling restart")
+            elif not ingest_ready:
+                self.unit.status = WaitingStatus(f"Waiting for {INGEST_NAME} container")
+            else:
+                self.unit.status = ActiveStatus(self._active_status_message)
         else:
             self.unit.status = WaitingStatus("Waiting for container to be ready...")
             event.defer()
 
+    def _update_workloads(self, event: EventBase) -> bool:
+        """Restarts the workloads the config changes, taking turns with peers if running.
+
+        Returns:
+            whether the ingest sidecar is as configured or waits for its turn to restart.
+        """
+        hub_changed = self._container.get_plan().services != self._pebble_layer.services
+        ingest_needs_restart = self._ingest_needs_restart
+        if (hub_changed and self._service_is_running) or ingest_needs_restart:
+            # restarting wipes the cache or drops pushes, so units take turns
+            if not self._rolling_restart.pending:
+                self._rolling_restart.request()
+        elif hub_changed:
+            self._restart_workloads()
+        if self._rolling_restart.pending and self._rolling_restart.resume():
+            # checked again at the start of the next hook, to hand over to the next unit
+            event.defer()
+        # an ingest sidecar not running yet is started without waiting for a turn, unless
+        # the hub has yet to give it the public push port
+        ingest_ready = True
+        if not ingest_needs_restart and self._applied_hub_port == self._hub_port:
+            ingest_ready = self._configure_ingest()
+        return ingest_ready
+
+    def _restart_workloads(self):
+        """Restarts the hub, or only the ingest sidecar when the hub is unchanged.
+
+        With peers, this runs on this unit's turn in the rolling restart.
+        """
+        layer = self._pebble_layer
+        if self._container.get_plan().services != layer.services:
+            self._container.add_layer(CHARM_NAME, layer, combine=True)
+            self._restart_hub()
+        else:
+            self._configure_ingest()
+
+    def _restart_hub(self):
+        """Restarts the hub with the current pebble layer, keeping its cache if possible."""
+        if self._snapshot_storage_attached and self._service_is_running:
+            self._cache_snapshot.save()
+        if not self._ingest_enabled:
+            # the front-end gives the public port back before the hub listens on it again
+            self._configure_ingest()
+        self._container.restart(CHARM_NAME)
+        logger.info(f"Restarted container {CHARM_NAME}")
+        self._configure_ingest()
+        self._wait_for_hub_ready()
+        self._restore_cache_snapshot()
+        self._update_active_statuses()
+        self.unit.status = ActiveStatus(self._active_status_message)
+
+    def _wait_for_hub_ready(self) -> bool:
+        """Polls the hub for a little while after a restart, recording how long it took.
+
+        Returns:
+            whether the hub got ready. If not, the restart latency is left unknown.
+        """
+        started_at = time.monotonic()
+        while not self._hub_is_ready:
+            if time.monotonic() - started_at >= HUB_READY_TIMEOUT:
+                logger.warning("%s not ready %ds after start", CHARM_NAME, HUB_READY_TIMEOUT)
+                self._stored.restart_latency = None
+                return False
+            time.sleep(HUB_READY_POLL_INTERVAL)
+        self._stored.restart_latency = time.monotonic() - started_at
+        logger.info("%s ready %.1fs after start", CHARM_NAME, self._stored.restart_latency)
+        return True
+
+    def _on_stop(self, _):
+        """Saves the hub cache before the pod goes away."""
+        if self._snapshot_storage_attached and self._service_is_running:
+            self._cache_snapshot.save()
+
+    def _restore_cache_snapshot(self) -> bool:
+        """Replays the cache snapshot left by a previous hub process, if any.
+
+        Returns:
+            whether no replay is left to retry.
+        """
+        if self._snapshot_storage_attached and self._service_is_running:
+            return self._cache_snapshot.restore()
+        return True
+
+    @property
+    def _snapshot_storage_attached(self) -> bool:
+        return bool(self.model.storages[SNAPSHOT_STORAGE_NAME])
+
     def _on_metrics_endpoint_relation_joined(self, event: RelationJoinedEvent):
         if not self.unit.is_leader():
             return
-        self._update_relation_active_status(
-            relation=event.relation, is_active=self._service_is_running
-        )
-        if not self._service_is_running:
+        hub_is_ready = self._hub_is_ready
+        self._update_relation_active_status(relation=event.relation, is_active=hub_is_ready)
+        if not hub_is_ready:
             event.defer()
+
+    def _on_update_status(self, _: UpdateStatusEvent):
+        """Refreshes the scrape relations' active flag as the hub checks go up or down."""
+        # retry a replay that could not complete after the last restart
+        self._restore_cache_snapshot()
+        self._update_active_statuses()
+
+    def _update_active_statuses(self):
+        """Sets the active flag of every scrape relation to whether the hub is ready."""
+        if not self.unit.is_leader():
             return
+        hub_is_ready = self._hub_is_ready
+        for relation in self.model.relations["metrics-endpoint"]:
+            self._update_relation_active_status(relation=relation, is_active=hub_is_ready)
 
     def _update_relation_active_status(self, relation: Relation, is_active: bool):
         relation.data[self.unit].update(
@@ -125,12 +703,35 @@ class PrometheusEdgeHubCharm(CharmBase):
     def _service_is_running(self) -> bool:
         if self._container.can_connect():
             try:
-                self._container.get_service(self._service_name)
-                return True
+                return self._container.get_service(self._service_name).is_running()
             except ModelError:
                 pass
         return False
 
+    @property
+    def _hub_ports_open(self) -> bool:
+        """Whether the hub accepts connections on its ports.
+
+        Pebble checks report "up" until their failure threshold is reached, so right after a
+        restart the ports are probed directly as well. With the ingest sidecar, its public push
+        port is probed too.
+        """
+        ports = {self._hub_port, PROMETHEUS_EDGE_HUB_PORT, PROMETHEUS_EDGE_HUB_GRPC_PORT}
+        for port in sorted(ports):
+            try:
+                socket.create_connection(("localhost", port), timeout=1).close()
+            except OSError:
+                return False
+        return True
+
+    @property
+    def _hub_is_ready(self) -> bool:
+        """Whether the hub is running, accepts connections and passes all its ready checks."""
+        if not self._service_is_running or not self._hub_ports_open:
+            return False
+        checks = self._container.get_checks(level=CheckLevel.READY)
+        return bool(checks) and all(check.status == CheckStatus.UP for check in checks.values())
+
 
 if __name__ == "__main__":
     main(PrometheusEdgeHubCharm)
@@ -0,0 +1,12 @@
+# Copyright 2022 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""Ingest sidecar running in front of the hub's push port.
+
+The charm copies this package into the `ingest` container and runs it there with
+`python3 -m ingest`, so it only uses the Python standard library, of Python 3.8 or later.
+Clients connect to it on the public push port. Their requests are read, possibly several per
+connection, and forwarded to the hub over a small pool of persistent local connections, so
+that the hub no longer pays for a connection per push. Pushes may also be merged into batches,
+so that the hub parses a few large bodies rather than many small ones.
+"""
@@ -0,0 +1,35 @@
+# Copyright 2022 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""Entry point of the ingest sidecar: `python3 -m ingest`.
+
+Settings are read as JSON from the `INGEST_CONFIG` environment variable, or from the file
+given with `--config`.
+"""
+
+import argparse
+import logging
+import os
+
+from .app import run
+from .config import Config
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(prog="ingest", description=__doc__)
+    parser.add_argument("--config", help="path of a JSON settings file")
+    parser.add_argument("--log-level", default="INFO")
+    args = parser.parse_args()
+    logging.basicConfig(
+        level=args.log_level, format="%(asctime)s %(levelname)s %(name)s: %(message)s"
+    )
+    if args.config:
+        with open(args.config) as config_file:
+            config = Config.from_json(config_file.read())
+    else:
+        config = Config.from_json(os.environ.get("INGEST_CONFIG", ""))
+    run(config)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,319 @@
+# Copyright 2022 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""Hold pushed series within the cache limit, evicting lower priority series to make room.
+
+Once the hub holds `metrics_count_limit` samples it rejects every push until it is scraped, so
+one noisy client can lock out everyone else. With priority classes, the sidecar holds the
+samples pushed since the hub was last drained, at most `limit` of them, and only sends them to
+the hub right before it is scraped, or drained by the egress stage. Classes are listed from the
+highest priority to the lowest, each with label matchers:
+
+    - name: critical
+      match: {__name__: "up|node_.*", severity: critical}
+    - name: bulk
+      match: {job: "batch_.*"}
+
+Matchers are regular expressions matching whole label values, a missing label being empty, and
+`__name__` the name of the metric family. Series matching no class are in the `default` class,
+below all others. When the store is full, a new sample evicts the least recently pushed series
+of the lowest class holding any, unless that class is above its own, in which case the sample
+is rejected and its push answered with a 429.
+
+A series is the samples of a family sharing labels other than `le` and `quantile`, so that
+histograms and summaries are evicted whole. A sample pushed again replaces the one held, as
+Prometheus would only keep one of them.
+
+Samples are held rather than sent to the hub as they come, as the hub cannot delete series, so
+a series could not be evicted once in it. Samples the hub does not accept at a drain, other than
+with a 400, are held again. Held samples are sent to the hub when the sidecar stops, but are
+lost if it is killed, which a hub holding them would have survived.
+"""
+
+import asyncio
+import collections
+import logging
+import re
+from typing import Any, Dict, List, Mapping, Optional, Sequence, Tuple
+
+from .aggregation import LABEL_NAME
+from .exposition import CONTENT_TYPE, Family, parse_sample, render
+from .metrics import Counter, Gauge, Registry
+from .protocol import ProtocolError, Request, Response, text_response
+from .upstream import UpstreamPool
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CLASS = "default"
+# labels telling apart the samples of a histogram or summary series
+SERIES_SAMPLE_LABELS = ("le", "quantile")
+# size of the pushes the store is sent to the hub in
+FLUSH_BYTES = 1024 * 1024
+
+Labels = Tuple[Tuple[str, str], ...]
+# family name and labels of a series, and of a sample of it
+SeriesKey = Tuple[str, Labels]
+SampleKey = Tuple[str, Labels]
+
+
+class PriorityClass:
+    """A compiled priority class."""
+
+    __slots__ = ("name", "matchers")
+
+    def __init__(self, name: str, matchers: Mapping[str, "re.Pattern[str]"]):
+        self.name = name
+        self.matchers = dict(matchers)
+
+    def matches(self, labels: Mapping[str, str]) -> bool:
+        return all(
+            matcher.fullmatch(labels.get(label, "")) for label, matcher in self.matchers.items()
+        )
+
+
+def compile_class(spec: Mapping[str, Any]) -> PriorityClass:
+    """Check a priority class and compile it.
+
+    Raises:
+        ValueError: if the class is invalid.
+    """
+    if not isinstance(spec, Mapping):
+        raise ValueError("a class must be a mapping")
+    unknown = set(spec) - {"name", "match"}
+    if unknown:
+        raise ValueError("unknown class keys: {}".format(", ".join(sorted(unknown))))
+    name = spec.get("name")
+    if not isinstance(name, str) or not LABEL_NAME.match(name):
+        raise ValueError("invalid class name: {!r}".format(name))
+    if name == DEFAULT_CLASS:
+        raise ValueError("{} is the class of series matching no class".format(DEFAULT_CLASS))
+    match = spec.get("match", {})
+    if not isinstance(match, Mapping) or not match:
+        raise ValueError("{}: match must be a mapping of label names to patterns".format(name))
+    matchers = {}
+    for label, pattern in match.items():
+        if not isinstance(label, str) or not (label == "__name__" or LABEL_NAME.match(label)):
+            raise ValueError("{}: invalid label name: {!r}".format(name, label))
+        try:
+            matchers[label] = re.compile(str(pattern))
+        except re.error as e:
+            raise ValueError("{}: invalid pattern for {}: {}".format(name, label, e))
+    return PriorityClass(name, matchers)
+
+
+def compile_classes(specs: Sequence[Mapping[str, Any]]) -> List[PriorityClass]:
+    """Check priority classes and compile them, from the highest priority to the lowest.
+
+    Raises:
+        ValueError: if a class is invalid, or two classes have the same name.
+    """
+    if not isinstance(specs, list):
+        raise ValueError("classes must be a list")
+    classes = [compile_class(spec) for spec in specs]
+    names = [priority_class.name for priority_class in classes]
+    if len(set(names)) != len(names):
+        raise ValueError("class names must be unique")
+    return classes
+
+
+class Admission:
+    """Holds the series pushed since the last drain of the hub, and sends them to it."""
+
+    def __init__(
+        self, classes: List[PriorityClass], limit: int, pool: UpstreamPool, registry: Registry
+    ):
+        """Constructor for Admission.
+
+        Args:
+            classes: compiled classes, see `compile_classes`.
+            limit: largest number of samples held.
+            pool: connections to the hub.
+            registry: where the admission metrics are added.
+        """
+        self._classes = classes + [PriorityClass(DEFAULT_CLASS, {})]
+        self._limit = limit
+        self._pool = pool
+        # series key -> sample key -> line, one store per class, least recently pushed first
+        self._held: List["collections.OrderedDict[SeriesKey, Dict[SampleKey, str]]"] = [
+            collections.OrderedDict() for _ in self._classes
+        ]
+        self._priorities: Dict[SeriesKey, int] = {}
+        self._types: Dict[str, Tuple[Optional[str], Optional[str]]] = {}
+        self.size = 0
+        self.evicted = [0] * len(self._classes)
+        self.rejected = [0] * len(self._classes)
+        self.flush_failures = 0
+        for metric, name, help, read in (
+            (Counter, "evicted_series", "Series evicted.", lambda: self._by_class(self.evicted)),
+            (
+                Counter,
+                "rejected_samples",
+                "Samples rejected as the store was full of higher priority series.",
+                lambda: self._by_class(self.rejected),
+            ),
+            (
+                Gauge,
+                "held_samples",
+                "Samples held until the next drain of the hub.",
+                lambda: self._by_class([sum(map(len, held.values())) for held in self._held]),
+            ),
+        ):
+            suffix = "_total" if metric is Counter else ""
+            registry.add(
+                metric("ingest_admission_{}{}".format(name, suffix), help, read, label="class")
+            )
+        registry.add(
+            Counter(
+                "ingest_admission_flush_failures_total",
+                "Pushes of held samples the hub did not accept.",
+                lambda: self.flush_failures,
+            )
+        )
+
+    def _by_class(self, values: List[int]) -> Dict[str, int]:
+        return {c.name: value for c, value in zip(self._classes, values)}
+
+    def push(self, families: List[Family]) -> Response:
+        """Hold the samples of a push, evicting lower priority series if the store is full.
+
+        Raises:
+            ProtocolError: if a sample is malformed, or a family changes type.
+        """
+        samples = self._parse(families)
+        rejected: Dict[str, int] = {}
+        for key, sample_key, line, labels in samples:
+            priority = self._priorities.get(key)
+            if priority is None:
+                priority = self._classify(key[0], labels)
+            if not self._admit(priority, key, sample_key, line):
+                name = self._classes[priority].name
+                rejected[name] = rejected.get(name, 0) + 1
+        if rejected:
+            counts = ", ".join("{} {}".format(n, name) for name, n in sorted(rejected.items()))
+            return text_response(429, "Cache full, rejected samples: {}\n".format(counts))
+        return Response(200)
+
+    def _parse(self, families: List[Family]) -> list:
+        """The series key, sample key, line and labels of each sample of a push."""
+        types = {}
+        samples = []
+        for family in families:
+            known_help, known_type = self._types.get(family.name, (None, None))
+            if None not in (known_type, family.type) and known_type != family.type:
+                raise ProtocolError(
+                    "{} is held as a {}, not a {}".format(family.name, known_type, family.type)
+                )
+            types[family.name] = (known_help or family.help, known_type or family.type)
+            for line in family.samples:
+                try:
+                    name, labels, _, _ = parse_sample(line)
+                except ValueError:
+                    raise ProtocolError("malformed sample: {}".format(line[:200]))
+                sample_labels = tuple(sorted(labels.items()))
+                series_labels = tuple(
+                    item for item in sample_labels if item[0] not in SERIES_SAMPLE_LABELS
+                )
+                samples.append(((family.name, series_labels), (name, sample_labels), line, labels))
+        self._types.update(types)
+        return samples
+
+    def _classify(self, family: str, labels: Dict[str, str]) -> int:
+        labels = dict(labels, __name__=family)
+        for priority, priority_class in enumerate(self._classes):
+            if priority_class.matches(labels):
+                return priority
+        return len(self._classes) - 1
+
+    def _admit(self, priority: int, key: SeriesKey, sample_key: SampleKey, line: str) -> bool:
+        held = self._held[priority]
+        samples = held.get(key)
+        if samples is not None and sample_key in samples:
+            samples[sample_key] = line
+            held.move_to_end(key)
+            return True
+        while self.size >= self._limit:
+            if not self._evict(priority):
+                self.rejected[priority] += 1
+                return False
+        # the series may just have been evicted to make room for its own new sample
+        samples = held.get(key)
+        if samples is None:
+            samples = held[key] = {}
+            self._priorities[key] = priority
+        held.move_to_end(key)
+        samples[sample_key] = line
+        self.size += 1
+        return True
+
+    def _evict(self, priority: int) -> bool:
+        """Evict the least recently pushed series of the lowest class, if not above `priority`."""
+        for lower in range(len(self._held) - 1, priority - 1, -1):
+            held = self._held[lower]
+            if held:
+                key, samples = held.popitem(last=False)
+                del self._priorities[key]
+                self.size -= len(samples)
+                self.evicted[lower] += 1
+                return True
+        return False
+
+    async def flush(self) -> None:
+        """Send the samples held to the hub, in pushes of about `FLUSH_BYTES`."""
+        if not self.size:
+            return
+        held, types = self._held, self._types
+        self._held = [collections.OrderedDict() for _ in self._classes]
+        self._priorities = {}
+        self._types = {}
+        self.size = 0
+        families: Dict[str, Family] = {}
+        for store in held:
+            for (name, _), samples in store.items():
+                if name not in families:
+                    families[name] = Family(name, *types.get(name, (None, None)))
+                families[name].samples.extend(samples.values())
+        chunks: List[List[Family]] = [[]]
+        size = 0
+        for family in families.values():
+            if size >= FLUSH_BYTES:
+                chunks.append([])
+                size = 0
+            chunks[-1].append(family)
+            size += sum(map(len, family.samples))
+        await asyncio.gather(*(self._send(chunk) for chunk in chunks))
+
+    async def _send(self, families: List[Family]) -> None:
+        body = render(families).encode("utf-8")
+        request = Request("POST", "/metrics", "HTTP/1.1", [("Content-Type", CONTENT_TYPE)], body)
+        try:
+            response = await self._pool.request(request)
+        except ProtocolError as e:
+            logger.warning("Failed to send held samples, holding them again: %s", e)
+            self.flush_failures += 1
+            self._requeue(families)
+            return
+        if response.status == 400:
+            # malformed for the hub, so holding them again would only fail again
+            logger.warning("Hub rejected held samples: %s", response.body[:200])
+            self.flush_failures += 1
+        elif response.status >= 300:
+            logger.warning(
+                "Hub answered held samples with %d, holding them again", response.status
+            )
+            self.flush_failures += 1
+            self._requeue(families)
+
+    def _requeue(self, families: List[Family]) -> None:
+        """Hold samples the hub did not accept again, unless pushed again since."""
+        try:
+            samples = self._parse(families)
+        except ProtocolError as e:
+            logger.warning("Dropping held samples: %s", e)
+            return
+        for key, sample_key, line, labels in samples:
+            priority = self._priorities.get(key)
+            if priority is None:
+                priority = self._classify(key[0], labels)
+            elif sample_key in self._held[priority][key]:
+                continue
+            self._admit(priority, key, sample_key, line)
@@ -0,0 +1,301 @@
+# Copyright 2022 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""Aggregate pushed samples before they reach the hub, e.g. per-device counters summed by site.
+
+A rule names a metric, the labels to group its samples by, an operation and a time bucket:
+
+    {"match": "device_bytes_total", "by": ["site"], "op": "sum", "interval": 60}
+
+Samples of a metric matched by a rule are not sent to the hub, and a push whose samples are all
+aggregated is answered at once. Every `interval` seconds, on
+wall clock boundaries, each group of the bucket is sent as one sample named after the rule:
+
+- `sum`: the sum over the series of the group of the last value of each series in the bucket,
+  so that summing counters gives a counter as long as each series is pushed in every bucket.
+- `max`: the largest value pushed to the group in the bucket.
+- `last`: the last value pushed to the group in the bucket.
+
+Rules are indexed by metric name, so that a sample costs one lookup however many rules there
+are, and samples of other metrics are passed on without being parsed. Only counter, gauge and
+untyped metrics are aggregated, and a push of a metric as a counter once aggregated as a gauge,
+or the other way around, is refused. Aggregates the hub does not accept, other than with a 400,
+are merged back into the next bucket.
+"""
+
+import asyncio
+import logging
+import math
+import re
+import time
+from typing import Any, Dict, List, Mapping, Optional, Sequence, Tuple
+
+from .exposition import CONTENT_TYPE, Family, format_sample, parse_sample, render
+from .metrics import Counter, Registry
+from .protocol import ProtocolError, Request
+from .upstream import UpstreamPool
+
+logger = logging.getLogger(__name__)
+
+OPERATIONS = ("sum", "max", "last")
+METRIC_NAME = re.compile(r"^[a-zA-Z_:][a-zA-Z0-9_:]*$")
+LABEL_NAME = re.compile(r"^[a-zA-Z_][a-zA-Z0-9_]*$")
+AGGREGATED_TYPES = (None, "counter", "gauge", "untyped")
+# types a rule must not mix, as the sum of a counter and a gauge is neither
+EXCLUSIVE_TYPES = ("counter", "gauge")
+
+
+class Rule:
+    """A compiled aggregation rule."""
+
+    __slots__ = ("match", "by", "op", "interval", "name")
+
+    def __init__(self, match: str, by: Sequence[str], op: str, interval: float, name: str):
+        self.match = match
+        self.by = tuple(by)
+        self.op = op
+        self.interval = interval
+        self.name = name
+
+
+def compile_rule(rule: Mapping[str, Any]) -> Rule:
+    """Check an aggregation rule and compile it.
+
+    Raises:
+        ValueError: if the rule is invalid.
+    """
+    if not isinstance(rule, Mapping):
+        raise ValueError("a rule must be a mapping")
+    unknown = set(rule) - {"match", "by", "op", "interval", "as"}
+    if unknown:
+        raise ValueError("unknown rule keys: {}".format(", ".join(sorted(unknown))))
+    match = rule.get("match")
+    if not isinstance(match, str) or not METRIC_NAME.match(match):
+        raise ValueError("invalid metric name to match: {!r}".format(match))
+    by = rule.get("by", [])
+    if not isinstance(by, list) or not all(
+        isinstance(label, str) and LABEL_NAME.match(label) for label in by
+    ):
+        raise ValueError("{}: by must be a list of label names".format(match))
+    op = rule.get("op", "sum")
+    if op not in OPERATIONS:
+        raise ValueError("{}: op must be one of {}".format(match, ", ".join(OPERATIONS)))
+    interval = rule.get("interval", 60)
+    if isinstance(interval, bool) or not isinstance(interval, (int, float)) or interval <= 0:
+        raise ValueError("{}: interval must be a positive number of seconds".format(match))
+    default_name = "{}:{}:{}".format("_".join(by), match, op) if by else "{}:{}".format(match, op)
+    name = rule.get("as", default_name)
+    if not isinstance(name, str) or not METRIC_NAME.match(name):
+        raise ValueError("{}: invalid metric name to aggregate as: {!r}".format(match, name))
+    return Rule(match, by, op, float(interval), name)
+
+
+def compile_rules(rules: Sequence[Mapping[str, Any]]) -> Dict[str, List[Rule]]:
+    """Check aggregation rules and compile them, indexed by the metric they match.
+
+    Raises:
+        ValueError: if a rule is invalid, or two rules aggregate as the same metric.
+    """
+    if not isinstance(rules, list):
+        raise ValueError("rules must be a list")
+    index: Dict[str, List[Rule]] = {}
+    names = set()
+    for rule in map(compile_rule, rules):
+        if rule.name in names:
+            raise ValueError("several rules aggregate as {}".format(rule.name))
+        names.add(rule.name)
+        index.setdefault(rule.match, []).append(rule)
+    return index
+
+
+class Aggregate:
+    """The groups of a rule in the current bucket."""
+
+    def __init__(self, rule: Rule):
+        self.rule = rule
+        self.type: Optional[str] = None
+        # group label values -> value, or for sums, series labels -> last value
+        self.groups: Dict[Tuple[str, ...], Any] = {}
+        self.deadline = self.next_deadline(time.time())
+
+    def next_deadline(self, now: float) -> float:
+        return (math.floor(now / self.rule.interval) + 1) * self.rule.interval
+
+    def add(self, labels: Dict[str, str], value: float) -> None:
+        group = tuple(labels.get(label, "") for label in self.rule.by)
+        if self.rule.op == "sum":
+            self.groups.setdefault(group, {})[tuple(sorted(labels.items()))] = value
+        elif self.rule.op == "max" and group in self.groups:
+            self.groups[group] = max(self.groups[group], value)
+        else:
+            self.groups[group] = value
+
+    def check_type(self, family: Family) -> None:
+        """Raises ProtocolError if the family mixes counters and gauges into the aggregate."""
+        if self.type in EXCLUSIVE_TYPES and family.type in EXCLUSIVE_TYPES:
+            if family.type != self.type:
+                raise ProtocolError(
+                    "{} is aggregated as a {}, not a {}".format(
+                        self.rule.match, self.type, family.type
+                    )
+                )
+
+    def drain(self, now: float) -> Dict[Tuple[str, ...], Any]:
+        """The groups of the bucket, and start the next bucket."""
+        self.deadline = self.next_deadline(now)
+        groups, self.groups = self.groups, {}
+        return groups
+
+    def requeue(self, groups: Dict[Tuple[str, ...], Any]) -> None:
+        """Merge the groups of a bucket the hub did not accept into the current bucket.
+
+        Values pushed since take precedence, as they are the more recent.
+        """
+        for group, value in groups.items():
+            current = self.groups.get(group)
+            if current is None:
+                self.groups[group] = value
+            elif self.rule.op == "sum":
+                self.groups[group] = dict(value, **current)
+            elif self.rule.op == "max":
+                self.groups[group] = max(current, value)
+
+    def family(self, groups: Dict[Tuple[str, ...], Any]) -> Family:
+        """The aggregated family of drained groups."""
+        rule = self.rule
+        family = Family(
+            rule.name,
+            "{} of {} by {}.".format(rule.op, rule.match, ", ".join(rule.by) or "nothing"),
+            "gauge" if rule.op == "max" else self.type,
+        )
+        for group, value in sorted(groups.items()):
+            if rule.op == "sum":
+                value = sum(value.values())
+            family.samples.append(format_sample(rule.name, zip(rule.by, group), value))
+        return family
+
+
+class Aggregator:
+    """Folds the samples matched by rules into aggregates, and sends them to the hub."""
+
+    def __init__(self, rules: Dict[str, List[Rule]], pool: UpstreamPool, registry: Registry):
+        """Constructor for Aggregator.
+
+        Args:
+            rules: compiled rules, see `compile_rules`.
+            pool: connections to the hub.
+            registry: where the aggregation metrics are added.
+        """
+        self._pool = pool
+        self._index = {
+            match: [Aggregate(rule) for rule in match_rules]
+            for match, match_rules in rules.items()
+        }
+        self._aggregates = [a for aggregates in self._index.values() for a in aggregates]
+        self._task: Optional[asyncio.Future] = None
+        self._stopping: Optional[asyncio.Event] = None
+        self.samples = 0
+        self.series = 0
+        self.flush_failures = 0
+        for name, help, read in (
+            ("samples", "Samples folded into aggregates.", lambda: self.samples),
+            ("series", "Aggregated series sent to the hub.", lambda: self.series),
+            ("flush_failures", "Aggregates the hub did not accept.", lambda: self.flush_failures),
+        ):
+            registry.add(Counter("ingest_aggregation_{}_total".format(name), help, read))
+
+    def matches(self, families: List[Family]) -> bool:
+        """Whether some of the families are aggregated."""
+        return any(family.name in self._index for family in families)
+
+    def absorb(self, families: List[Family]) -> List[Family]:
+        """Fold the samples matched by rules into their aggregates, and return the others.
+
+        Raises:
+            ProtocolError: if a family mixes counters and gauges into an aggregate.
+        """
+        kept = []
+        for family in families:
+            for aggregate in self._index.get(family.name, ()):
+                aggregate.check_type(family)
+        for family in families:
+            aggregates = self._index.get(family.name)
+            if aggregates is None or family.type not in AGGREGATED_TYPES:
+                kept.append(family)
+                continue
+            unparsed = []
+            for line in family.samples:
+                try:
+                    _, labels, value, _ = parse_sample(line)
+                except ValueError:
+                    unparsed.append(line)  # for the hub to reject
+                    continue
+                for aggregate in aggregates:
+                    aggregate.type = aggregate.type or family.type
+                    aggregate.add(labels, value)
+                self.samples += 1
+            if unparsed:
+                family.samples = unparsed
+                kept.append(family)
+        return kept
+
+    def start(self) -> None:
+        """Start sending the aggregates at the end of their buckets."""
+        if self._aggregates:
+            self._stopping = asyncio.Event()
+            self._task = asyncio.ensure_future(self._run())
+
+    async def close(self) -> None:
+        """Stop, sending the aggregates of the current buckets."""
+        if self._task is not None and self._stopping is not None:
+            # stopped rather than cancelled, as before Python 3.12 `asyncio.wait_for` may
+            # swallow a cancellation coming as the hub answers
+            self._stopping.set()
+            await self._task
+        await self._send(self._aggregates, time.time())
+
+    async def _run(self) -> None:
+        assert self._stopping is not None
+        while not self._stopping.is_set():
+            deadline = min(aggregate.deadline for aggregate in self._aggregates)
+            try:
+                await asyncio.wait_for(self._stopping.wait(), max(0, deadline - time.time()))
+                return
+            except asyncio.TimeoutError:
+                pass
+            now = time.time()
+            await self._send([a for a in self._aggregates if a.deadline <= now], now)
+
+    async def _send(self, aggregates: List[Aggregate], now: float) -> None:
+        drained = [(a, groups) for a, groups in ((a, a.drain(now)) for a in aggregates) if groups]
+        if not drained:
+            return
+        families = [aggregate.family(groups) for aggregate, groups in drained]
+        body = render(families).encode("utf-8")
+        request = Request("POST", "/metrics", "HTTP/1.1", [("Content-Type", CONTENT_TYPE)], body)
+        try:
+            response = await self._pool.request(request)
+        except ProtocolError as e:
+            logger.warning("Failed to send aggregates, sending them with the next bucket: %s", e)
+            self.flush_failures += 1
+            self._requeue(drained)
+            return
+        if response.status == 400:
+            # malformed for the hub, so sending them again would only fail again
+            logger.warning("Hub rejected aggregates: %s", response.body[:200])
+            self.flush_failures += 1
+            return
+        if response.status >= 300:
+            logger.warning(
+                "Hub answered aggregates with %d, sending them with the next bucket",
+                response.status,
+            )
+            self.flush_failures += 1
+            self._requeue(drained)
+            return
+        self.series += sum(len(family.samples) for family in families)
+
+    @staticmethod
+    def _requeue(drained: List[Tuple[Aggregate, Dict[Tuple[str, ...], Any]]]) -> None:
+        for aggregate, groups in drained:
+            aggregate.requeue(groups)
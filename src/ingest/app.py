@@ -0,0 +1,220 @@
+# Copyright 2022 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""Assembles the stages of the sidecar and runs them until it is stopped."""
+
+import asyncio
+import logging
+import signal
+from typing import Optional
+
+from .admission import Admission, compile_classes
+from .aggregation import Aggregator, compile_rules
+from .batcher import Batcher, batchable
+from .config import Config
+from .exposition import CONTENT_TYPE, parse, render
+from .frontend import Frontend
+from .metrics import Counter, Registry
+from .protocol import ProtocolError, Request, Response, text_response
+from .remote_write import Egress, Endpoint
+from .upstream import UpstreamPool
+
+logger = logging.getLogger(__name__)
+
+
+# the metrics of the sidecar itself, apart from the hub's so that draining the hub never
+# drains them, e.g. into the cache snapshot
+METRICS_PATH = "/ingest/metrics"
+
+
+class Router:
+    """Passes pushes through the aggregator, and admission or batcher, if any, to the hub.
+
+    With priority classes, pushes in the protobuf format or compressed are refused, as they
+    would fill the hub without going through admission. Held samples are sent to the hub right
+    before it is scraped. When the hub is drained by the
+    egress stage, a scrape drains it into the remote-write queues and gets no samples, so that
+    the cache snapshot taken before a restart hands them to remote-write rather than saving
+    them. The metrics of the sidecar are served on `METRICS_PATH`.
+    """
+
+    def __init__(
+        self,
+        pool: UpstreamPool,
+        aggregator: Optional[Aggregator],
+        batcher: Optional[Batcher],
+        registry: Registry,
+        egress: Optional[Egress] = None,
+        admission: Optional[Admission] = None,
+    ):
+        self._pool = pool
+        self._aggregator = aggregator
+        self._batcher = batcher
+        self._registry = registry
+        self._egress = egress
+        self._admission = admission
+
+    async def handle(self, request: Request) -> Response:
+        if request.path == METRICS_PATH and request.method == "GET":
+            return Response(200, [("Content-Type", CONTENT_TYPE)], self._registry.exposition())
+        if request.path == "/metrics":
+            staged = any((self._aggregator, self._batcher, self._admission))
+            if request.method == "POST" and staged and batchable(request):
+                return await self._push(request)
+            if request.method in ("POST", "PUT") and self._admission is not None:
+                return text_response(
+                    415, "Only POSTs of uncompressed text are accepted with priority classes\n"
+                )
+            if request.method == "GET":
+                return await self._scrape(request)
+        return await self._pool.request(request)
+
+    async def _push(self, request: Request) -> Response:
+        try:
+            families = parse(request.body.decode("utf-8"))
+        except UnicodeDecodeError:
+            raise ProtocolError("push is not valid UTF-8")
+        if self._aggregator is not None and self._aggregator.matches(families):
+            families = self._aggregator.absorb(families)
+            if not families:
+                return Response(200)
+            request.body = render(families).encode("utf-8")
+        if self._admission is not None:
+            return self._admission.push(families)
+        if self._batcher is not None:
+            return await self._batcher.push(families, len(request.body))
+        return await self._pool.request(request)
+
+    async def _scrape(self, request: Request) -> Response:
+        if self._egress is not None:
+            await self._egress.drain()
+            return Response(200, [("Content-Type", CONTENT_TYPE)])
+        if self._admission is not None:
+            await self._admission.flush()
+        return await self._pool.request(request)
+
+
+class App:
+    """The ingest sidecar: a front-end passing requests to the hub over an upstream pool."""
+
+    def __init__(self, config: Config):
+        self.config = config
+        self.registry = Registry()
+        self.pool = UpstreamPool(
+            config.hub_host,
+            config.hub_port,
+            config.hub_connections,
+            config.hub_max_response_bytes,
+            config.hub_timeout,
+        )
+        self.aggregator = None
+        if config.aggregation_rules:
+            self.aggregator = Aggregator(
+                compile_rules(config.aggregation_rules), self.pool, self.registry
+            )
+        self.admission = None
+        if config.priority_classes:
+            if config.admission_limit < 0:
+                raise ValueError("priority classes need an admission limit")
+            self.admission = Admission(
+                compile_classes(config.priority_classes),
+                config.admission_limit,
+                self.pool,
+                self.registry,
+            )
+        self.batcher = None
+        if config.batch_pushes:
+            self.batcher = Batcher(
+                self.pool, config.batch_max_bytes, config.batch_max_age, self.registry
+            )
+        self.egress = None
+        if config.remote_write_urls:
+            endpoints = [
+                Endpoint(
+                    url,
+                    config.remote_write_shards,
+                    config.remote_write_capacity,
+                    config.remote_write_max_samples,
+                    config.remote_write_timeout,
+                )
+                for url in config.remote_write_urls
+            ]
+            self.egress = Egress(
+                self.pool,
+                endpoints,
+                config.remote_write_interval,
+                config.remote_write_labels,
+                self.registry,
+                self.admission,
+            )
+        router = Router(
+            self.pool,
+            self.aggregator,
+            self.batcher,
+            self.registry,
+            self.egress,
+            self.admission,
+        )
+        self.frontend = Frontend(
+            router.handle,
+            config.max_connections,
+            config.max_pipeline,
+            config.max_body_bytes,
+            config.idle_timeout,
+        )
+        self.registry.add(
+            Counter(
+                "ingest_requests_total",
+                "Requests received from clients.",
+                lambda: self.frontend.requests,
+            )
+        )
+        self.registry.add(
+            Counter(
+                "ingest_hub_requests_total",
+                "Requests sent to the hub.",
+                lambda: self.pool.requests,
+            )
+        )
+
+    async def start(self) -> None:
+        if self.aggregator is not None:
+            self.aggregator.start()
+        if self.egress is not None:
+            self.egress.start()
+        await self.frontend.start(
+            self.config.listen_host, self.config.listen_port, self.config.backlog
+        )
+        logger.info(
+            "Forwarding port %d to %s:%d",
+            self.frontend.port,
+            self.config.hub_host,
+            self.config.hub_port,
+        )
+
+    async def stop(self) -> None:
+        await self.frontend.stop()
+        if self.aggregator is not None:
+            await self.aggregator.close()
+        if self.batcher is not None:
+            await self.batcher.close()
+        if self.admission is not None:
+            # left in the hub, where the cache snapshot keeps them across restarts
+            await self.admission.flush()
+        if self.egress is not None:
+            await self.egress.close()
+        await self.pool.close()
+
+
+def run(config: Config) -> None:
+    """Run the sidecar until SIGTERM or SIGINT."""
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    app = App(config)
+    stopped = asyncio.Event()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, stopped.set)
+    loop.run_until_complete(app.start())
+    loop.run_until_complete(stopped.wait())
+    loop.run_until_complete(app.stop())
+    loop.close()
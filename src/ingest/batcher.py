@@ -0,0 +1,182 @@
+# Copyright 2022 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""Coalesce small pushes into large ones, so that the hub parses fewer request bodies.
+
+Pushes are merged family by family into the current batch, which is sent to the hub once it
+holds `max_bytes` of pushes or is `max_age` seconds old, whichever comes first. A client is only
+answered once the hub has accepted the batch holding its push, with the hub's response, so a push
+answered with a 2xx is in the hub as if it had been pushed directly.
+
+So that one client cannot fail the pushes of others, a push with a malformed sample or an unknown
+type is answered with a 400 rather than batched, and if the hub still rejects a batch with a
+4xx, its pushes are sent again one by one, each client getting the answer to its own push.
+"""
+
+import asyncio
+import logging
+import time
+from typing import Dict, List, Optional, Set
+
+from .exposition import CONTENT_TYPE, Family, render, validate
+from .metrics import Counter, Histogram, Registry
+from .protocol import ProtocolError, Request, Response, text_response
+from .upstream import UpstreamPool
+
+logger = logging.getLogger(__name__)
+
+SIZE_BUCKETS = [1024 * 4**i for i in range(8)]
+PUSHES_BUCKETS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000]
+DURATION_BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5]
+
+
+def batchable(request: Request) -> bool:
+    """Whether a push is in the text format the batcher merges, rather than protobuf or gzip."""
+    content_type = request.header("Content-Type", "text/plain") or "text/plain"
+    return content_type.startswith("text/plain") and request.header("Content-Encoding") is None
+
+
+class Batch:
+    """Pushes merged into one body, and the clients waiting for the hub to accept it."""
+
+    def __init__(self):
+        self.families: Dict[str, Family] = {}
+        self.size = 0
+        self.pushes: List[List[Family]] = []
+        self.waiters: List[asyncio.Future] = []
+
+    def accepts(self, families: List[Family]) -> bool:
+        """Whether the families can be merged into the batch, i.e. their types do not differ."""
+        for family in families:
+            batched = self.families.get(family.name)
+            if batched and None not in (batched.type, family.type) and batched.type != family.type:
+                return False
+        return True
+
+    def add(self, families: List[Family], size: int) -> asyncio.Future:
+        """Merge pushed families into the batch, and return the future answer to the push."""
+        for family in families:
+            batched = self.families.get(family.name)
+            if batched is None:
+                # a copy, as the families of the push are kept to send them alone if need be
+                batched = self.families[family.name] = Family(family.name)
+            batched.help = batched.help if batched.help is not None else family.help
+            batched.type = batched.type if batched.type is not None else family.type
+            batched.samples += family.samples
+        self.pushes.append(families)
+        self.size += size
+        waiter = asyncio.get_event_loop().create_future()
+        self.waiters.append(waiter)
+        return waiter
+
+
+class Batcher:
+    """Merges pushes into batches, and sends them to the hub."""
+
+    def __init__(self, pool: UpstreamPool, max_bytes: int, max_age: float, registry: Registry):
+        """Constructor for Batcher.
+
+        Args:
+            pool: connections to the hub.
+            max_bytes: size of the pushes making a batch full.
+            max_age: seconds after its first push a batch is sent, even if not full.
+            registry: where the batch metrics are added.
+        """
+        self._pool = pool
+        self._max_bytes = max_bytes
+        self._max_age = max_age
+        self._batch: Optional[Batch] = None
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._flushes: Set[asyncio.Future] = set()
+        self.batch_bytes = registry.add(
+            Histogram(
+                "ingest_batch_size_bytes", "Size of the batches sent to the hub.", SIZE_BUCKETS
+            )
+        )
+        self.batch_pushes = registry.add(
+            Histogram(
+                "ingest_batch_pushes", "Number of pushes merged into a batch.", PUSHES_BUCKETS
+            )
+        )
+        self.flush_seconds = registry.add(
+            Histogram(
+                "ingest_batch_flush_duration_seconds",
+                "Time taken by the hub to accept a batch.",
+                DURATION_BUCKETS,
+            )
+        )
+        self.flush_failures = 0
+        registry.add(
+            Counter(
+                "ingest_batch_flush_failures_total",
+                "Batches the hub did not accept.",
+                lambda: self.flush_failures,
+            )
+        )
+
+    async def push(self, families: List[Family], size: int) -> Response:
+        """Add the families of a push of `size` bytes to the current batch.
+
+        Returns:
+            the answer of the hub to the batch, once it is sent, or to the push alone if the hub
+            rejected the batch; a 400 if the push is malformed.
+        """
+        try:
+            validate(families)
+        except ValueError as e:
+            return text_response(400, "{}\n".format(e))
+        if self._batch is not None and not self._batch.accepts(families):
+            self._flush()
+        if self._batch is None:
+            self._batch = Batch()
+            self._timer = asyncio.get_event_loop().call_later(self._max_age, self._flush)
+        waiter = self._batch.add(families, size)
+        if self._batch.size >= self._max_bytes:
+            self._flush()
+        return await waiter
+
+    async def close(self) -> None:
+        """Send the current batch, and wait for the batches being sent."""
+        if self._batch is not None:
+            self._flush()
+        if self._flushes:
+            await asyncio.wait(self._flushes)
+
+    def _flush(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._batch = self._batch, None
+        if batch is None:
+            return
+        flush = asyncio.ensure_future(self._send(batch))
+        self._flushes.add(flush)
+        flush.add_done_callback(self._flushes.discard)
+
+    async def _send(self, batch: Batch) -> None:
+        body = render(batch.families.values()).encode("utf-8")
+        start = time.monotonic()
+        response = await self._request(body)
+        self.flush_seconds.observe(time.monotonic() - start)
+        self.batch_bytes.observe(len(body))
+        self.batch_pushes.observe(len(batch.waiters))
+        responses = [response] * len(batch.waiters)
+        if response.status >= 300:
+            self.flush_failures += 1
+            logger.warning(
+                "Hub answered a batch of %d pushes with %d", len(batch.waiters), response.status
+            )
+        if 400 <= response.status < 500 and response.status != 429 and len(batch.pushes) > 1:
+            responses = await asyncio.gather(
+                *(self._request(render(push).encode("utf-8")) for push in batch.pushes)
+            )
+        for waiter, response in zip(batch.waiters, responses):
+            if not waiter.done():
+                waiter.set_result(response)
+
+    async def _request(self, body: bytes) -> Response:
+        request = Request("POST", "/metrics", "HTTP/1.1", [("Content-Type", CONTENT_TYPE)], body)
+        try:
+            return await self._pool.request(request)
+        except ProtocolError as e:
+            return text_response(e.status, "{}\n".format(e))
@@ -0,0 +1,65 @@
+# Copyright 2022 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""Settings of the ingest sidecar, as written by the charm."""
+
+import json
+import logging
+from typing import Any, Mapping
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    # public push and scrape port, and the hub behind it
+    "listen_host": "0.0.0.0",
+    "listen_port": 9091,
+    "backlog": 4096,
+    "hub_host": "127.0.0.1",
+    "hub_port": 9091,
+    "hub_connections": 8,
+    "hub_timeout": 30.0,
+    # a scrape of the hub answers with its whole cache, so this is well above max_body_bytes
+    "hub_max_response_bytes": 1024 * 1024 * 1024,
+    # client connections
+    "max_connections": 4096,
+    "max_pipeline": 16,
+    "max_body_bytes": 16 * 1024 * 1024,
+    "idle_timeout": 30.0,
+    # merging pushes into batches, flushed when full or old enough
+    "batch_pushes": False,
+    "batch_max_bytes": 1024 * 1024,
+    "batch_max_age": 0.05,
+    # aggregation rules, see `ingest.aggregation`
+    "aggregation_rules": [],
+    # draining the hub to remote-write endpoints, rather than waiting for scrapes
+    "remote_write_urls": [],
+    "remote_write_interval": 1.0,
+    "remote_write_shards": 4,
+    "remote_write_capacity": 10000,
+    "remote_write_max_samples": 1000,
+    "remote_write_timeout": 30.0,
+    "remote_write_labels": {},
+    # holding pushed series within the cache limit by priority, see `ingest.admission`
+    "priority_classes": [],
+    "admission_limit": -1,
+}
+
+
+class Config:
+    """Settings of the ingest sidecar, each an attribute named as in `DEFAULTS`."""
+
+    def __init__(self, **settings: Any):
+        unknown = set(settings) - set(DEFAULTS)
+        if unknown:
+            logger.warning("Ignoring unknown settings: %s", ", ".join(sorted(unknown)))
+        for name, default in DEFAULTS.items():
+            setattr(self, name, settings.get(name, default))
+
+    @classmethod
+    def from_json(cls, text: str) -> "Config":
+        """Settings from a JSON object, with defaults for the settings it does not have."""
+        settings: Mapping[str, Any] = json.loads(text) if text else {}
+        return cls(**settings)
+
+    def to_json(self) -> str:
+        return json.dumps({name: getattr(self, name) for name in DEFAULTS}, sort_keys=True)
@@ -0,0 +1,175 @@
+# Copyright 2022 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""The Prometheus text exposition format, as pushed to the hub, split into metric families.
+
+Samples are kept as the lines they were pushed as, and only parsed when a stage needs their
+labels and value, e.g. to aggregate them. The hub rejects a body declaring the `HELP`
+or `TYPE` of a family twice, so bodies are merged family by family rather than concatenated.
+"""
+
+import math
+from typing import Dict, Iterable, List, Optional, Tuple
+
+CONTENT_TYPE = "text/plain; version=0.0.4"
+# Suffixes of the samples of a histogram or summary family, after the family name
+SAMPLE_SUFFIXES = ("_bucket", "_count", "_sum", "_created")
+TYPES = ("counter", "gauge", "histogram", "summary", "untyped")
+
+
+class Family:
+    """The samples of a metric family, with its `HELP` and `TYPE` if declared."""
+
+    __slots__ = ("name", "help", "type", "samples")
+
+    def __init__(self, name: str, help: Optional[str] = None, type: Optional[str] = None):
+        self.name = name
+        self.help = help
+        self.type = type
+        self.samples: List[str] = []
+
+    def lines(self) -> List[str]:
+        lines = []
+        if self.help is not None:
+            lines.append("# HELP {} {}".format(self.name, self.help))
+        if self.type is not None:
+            lines.append("# TYPE {} {}".format(self.name, self.type))
+        return lines + self.samples
+
+
+def sample_name(line: str) -> str:
+    """The metric name of a sample line."""
+    for index, char in enumerate(line):
+        if char in "{ \t":
+            return line[:index]
+    return line
+
+
+def _family_of(name: str, current: Optional[Family]) -> Optional[Family]:
+    """The family a sample belongs to if it is the current one, e.g. for `x_bucket` of `x`."""
+    if current is None or not name.startswith(current.name):
+        return None
+    suffix = name.replace(current.name, "", 1)
+    if suffix == "" or (current.type in ("histogram", "summary") and suffix in SAMPLE_SUFFIXES):
+        return current
+    return None
+
+
+def parse(text: str) -> List[Family]:
+    """Split an exposition into its families, in the order they first appear.
+
+    Comments other than `HELP` and `TYPE`, and blank lines, are dropped.
+    """
+    families: Dict[str, Family] = {}
+    current: Optional[Family] = None
+    for line in text.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        if line.startswith("#"):
+            parts = line.split(None, 3)
+            if len(parts) < 3 or parts[1] not in ("HELP", "TYPE"):
+                continue
+            current = families.setdefault(parts[2], Family(parts[2]))
+            value = parts[3] if len(parts) > 3 else ""
+            if parts[1] == "HELP":
+                current.help = value
+            else:
+                current.type = value
+            continue
+        name = sample_name(line)
+        family = _family_of(name, current)
+        if family is None:
+            family = current = families.setdefault(name, Family(name))
+        family.samples.append(line)
+    return list(families.values())
+
+
+def render(families: Iterable[Family]) -> str:
+    """The exposition of the families."""
+    return "".join(line + "\n" for family in families for line in family.lines())
+
+
+def _label_value(line: str, start: int) -> Tuple[str, int]:
+    """The unescaped label value quoted at `start`, and the index after its closing quote."""
+    chars = []
+    index = start + 1
+    while index < len(line):
+        char = line[index]
+        if char == '"':
+            return "".join(chars), index + 1
+        if char == "\\" and index + 1 < len(line):
+            index += 1
+            char = {"n": "\n"}.get(line[index], line[index])
+        chars.append(char)
+        index += 1
+    raise ValueError("unterminated label value")
+
+
+def _labels(line: str, start: int) -> Tuple[Dict[str, str], int]:
+    """The labels in braces at `start`, and the index after the closing brace."""
+    labels = {}
+    index = start + 1
+    while True:
+        while index < len(line) and line[index] in " \t,":
+            index += 1
+        if index < len(line) and line[index] == "}":
+            return labels, index + 1
+        equals = line.find("=", index)
+        if equals < 0:
+            raise ValueError("malformed labels")
+        name = line[index:equals].strip()
+        quote = line.find('"', equals)
+        if not name or quote < 0 or line[equals:quote].strip() != "=":
+            raise ValueError("malformed labels")
+        labels[name], index = _label_value(line, quote)
+
+
+def parse_sample(line: str) -> Tuple[str, Dict[str, str], float, Optional[int]]:
+    """The metric name, labels, value and timestamp in milliseconds, if any, of a sample line.
+
+    Raises:
+        ValueError: if the line is not a valid sample.
+    """
+    name = sample_name(line)
+    labels: Dict[str, str] = {}
+    index = len(name)
+    if line.startswith("{", index):
+        labels, index = _labels(line, index)
+    fields = line[index:].split()
+    if not name or not 1 <= len(fields) <= 2:
+        raise ValueError("malformed sample")
+    timestamp = int(fields[1]) if len(fields) == 2 else None
+    return name, labels, float(fields[0]), timestamp
+
+
+def validate(families: Iterable[Family]) -> None:
+    """Check the types and samples of families, as the hub would before accepting them.
+
+    Raises:
+        ValueError: if a family has an unknown type, or a sample is malformed.
+    """
+    for family in families:
+        if family.type is not None and family.type not in TYPES:
+            raise ValueError("{} has unknown type {}".format(family.name, family.type))
+        for line in family.samples:
+            try:
+                parse_sample(line)
+            except ValueError as e:
+                raise ValueError("{}: {}".format(e, line[:200]))
+
+
+def format_sample(name: str, labels: Iterable[Tuple[str, str]], value: float) -> str:
+    """A sample line, without the labels whose value is empty."""
+    pairs = ",".join(
+        '{}="{}"'.format(k, v.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"'))
+        for k, v in labels
+        if v
+    )
+    if math.isnan(value):
+        text = "NaN"
+    elif math.isinf(value):
+        text = "+Inf" if value > 0 else "-Inf"
+    else:
+        text = repr(float(value))
+    return "{}{} {}".format(name, "{" + pairs + "}" if pairs else "", text)
@@ -0,0 +1,139 @@
+# Copyright 2022 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""Accept client connections and answer their requests in order, several at a time.
+
+Clients may keep connections open and pipeline requests on them: the next request of a
+connection is read while earlier ones are still being answered, up to `max_pipeline` per
+connection. Connections beyond `max_connections` are answered with a 503 and closed, rather
+than being left in the accept queue.
+"""
+
+import asyncio
+import logging
+from typing import Awaitable, Callable, Optional
+
+from .protocol import ProtocolError, Request, Response, read_request, text_response
+
+logger = logging.getLogger(__name__)
+
+Handler = Callable[[Request], Awaitable[Response]]
+
+
+class Frontend:
+    """The public HTTP endpoint of the sidecar."""
+
+    def __init__(
+        self,
+        handler: Handler,
+        max_connections: int,
+        max_pipeline: int,
+        max_body_bytes: int,
+        idle_timeout: float,
+    ):
+        """Constructor for Frontend.
+
+        Args:
+            handler: coroutine answering a request.
+            max_connections: largest number of client connections open at once.
+            max_pipeline: largest number of requests of a connection answered at once.
+            max_body_bytes: largest request body accepted.
+            idle_timeout: seconds a connection is kept open without a request.
+        """
+        self._handler = handler
+        self._max_connections = max_connections
+        self._max_pipeline = max_pipeline
+        self._max_body_bytes = max_body_bytes
+        self._idle_timeout = idle_timeout
+        self._server: Optional[asyncio.AbstractServer] = None
+        self.connections = 0
+        self.connections_accepted = 0
+        self.connections_rejected = 0
+        self.requests = 0
+
+    async def start(self, host: str, port: int, backlog: int) -> None:
+        """Start accepting connections."""
+        self._server = await asyncio.start_server(self._serve, host, port, backlog=backlog)
+
+    @property
+    def port(self) -> int:
+        """Port connections are accepted on, e.g. when started on port 0."""
+        assert self._server is not None
+        return self._server.sockets[0].getsockname()[1]
+
+    async def stop(self) -> None:
+        """Stop accepting connections."""
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        if self.connections >= self._max_connections:
+            self.connections_rejected += 1
+            writer.write(text_response(503, "too many connections\n").serialize(False))
+            writer.close()
+            return
+
+        self.connections += 1
+        self.connections_accepted += 1
+        # responses to write, in the order of the requests
+        pending: asyncio.Queue = asyncio.Queue(self._max_pipeline)
+        responder = asyncio.ensure_future(self._write_responses(pending, writer))
+        try:
+            await self._read_requests(reader, writer, pending)
+        finally:
+            # the responder consumes the queue until it gets None, so this cannot block forever
+            await pending.put(None)
+            await responder
+            writer.close()
+            self.connections -= 1
+
+    async def _read_requests(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, pending: asyncio.Queue
+    ) -> None:
+        while not writer.is_closing():
+            try:
+                request = await asyncio.wait_for(
+                    read_request(reader, self._max_body_bytes), self._idle_timeout
+                )
+            except (asyncio.TimeoutError, ConnectionError):
+                return
+            except ProtocolError as e:
+                response = asyncio.get_event_loop().create_future()
+                response.set_result(text_response(e.status, "{}\n".format(e)))
+                await pending.put((response, False))
+                return
+            if request is None:
+                return
+            self.requests += 1
+            await pending.put((asyncio.ensure_future(self._respond(request)), request.keep_alive))
+            if not request.keep_alive:
+                return
+
+    async def _respond(self, request: Request) -> Response:
+        try:
+            return await self._handler(request)
+        except ProtocolError as e:
+            return text_response(e.status, "{}\n".format(e))
+        except Exception:
+            logger.exception("Failed to handle %s %s", request.method, request.target)
+            return text_response(502, "internal error\n")
+
+    @staticmethod
+    async def _write_responses(pending: asyncio.Queue, writer: asyncio.StreamWriter) -> None:
+        """Write the responses of a connection in order, until None is queued."""
+        while True:
+            item = await pending.get()
+            if item is None:
+                return
+            response, keep_alive = item
+            response = await response
+            if writer.is_closing():
+                continue
+            try:
+                writer.write(response.serialize(keep_alive))
+                await writer.drain()
+            except ConnectionError:
+                writer.close()
+            if not keep_alive:
+                writer.close()
@@ -0,0 +1,85 @@
+# Copyright 2022 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""Metrics of the sidecar itself, served apart from the hub's on `/ingest/metrics`."""
+
+import bisect
+from typing import Callable, List, Optional, Sequence
+
+
+class Histogram:
+    """Observations counted in cumulative buckets, as a Prometheus histogram."""
+
+    def __init__(self, name: str, help: str, buckets: Sequence[float]):
+        self.name = name
+        self.help = help
+        self.buckets = sorted(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    @property
+    def count(self) -> int:
+        return sum(self.counts)
+
+    def lines(self) -> List[str]:
+        lines = ["# HELP {} {}".format(self.name, self.help)]
+        lines.append("# TYPE {} histogram".format(self.name))
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            lines.append('{}_bucket{{le="{}"}} {}'.format(self.name, bound, cumulative))
+        lines.append('{}_bucket{{le="+Inf"}} {}'.format(self.name, self.count))
+        lines.append("{}_sum {}".format(self.name, self.sum))
+        lines.append("{}_count {}".format(self.name, self.count))
+        return lines
+
+
+class Counter:
+    """A counter read from the stage counting it, when the metrics are rendered.
+
+    With a `label`, `read` returns the value of each series by the value of that label.
+    """
+
+    type = "counter"
+
+    def __init__(self, name: str, help: str, read: Callable, label: Optional[str] = None):
+        self.name = name
+        self.help = help
+        self.read = read
+        self.label = label
+
+    def lines(self) -> List[str]:
+        lines = [
+            "# HELP {} {}".format(self.name, self.help),
+            "# TYPE {} {}".format(self.name, self.type),
+        ]
+        if self.label is None:
+            return lines + ["{} {}".format(self.name, self.read())]
+        for label_value, value in self.read().items():
+            lines.append('{}{{{}="{}"}} {}'.format(self.name, self.label, label_value, value))
+        return lines
+
+
+class Gauge(Counter):
+    """A gauge read from the stage measuring it, when the metrics are rendered."""
+
+    type = "gauge"
+
+
+class Registry:
+    """The metrics of the sidecar."""
+
+    def __init__(self):
+        self.metrics: list = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def exposition(self) -> bytes:
+        """The metrics in the Prometheus text exposition format."""
+        return "".join(line + "\n" for m in self.metrics for line in m.lines()).encode()
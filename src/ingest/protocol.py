@@ -0,0 +1,249 @@
+# Copyright 2022 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""Just enough HTTP/1.1 to proxy pushes and scrapes between clients and the hub.
+
+Bodies are always read whole, whether sent with a `Content-Length` or chunked, and always
+written with a `Content-Length`, so that a request can be forwarded over any connection and
+a response is never interleaved with another on a pipelined connection.
+"""
+
+import asyncio
+from typing import List, Optional, Tuple
+
+MAX_LINE_BYTES = 8192
+MAX_HEADERS = 100
+REASONS = {
+    200: "OK",
+    202: "Accepted",
+    400: "Bad Request",
+    404: "Not Found",
+    413: "Payload Too Large",
+    429: "Too Many Requests",
+    502: "Bad Gateway",
+    503: "Service Unavailable",
+}
+# Headers describing a connection or a body encoding, which are not forwarded as they are
+HOP_BY_HOP_HEADERS = {
+    "connection",
+    "keep-alive",
+    "proxy-connection",
+    "transfer-encoding",
+    "content-length",
+    "te",
+    "trailer",
+    "upgrade",
+}
+
+Headers = List[Tuple[str, str]]
+
+
+class ProtocolError(Exception):
+    """Raised when a peer does not speak HTTP/1.x as expected."""
+
+    def __init__(self, message: str, status: int = 400):
+        super().__init__(message)
+        self.status = status
+
+
+class Request:
+    """An HTTP request, with its whole body."""
+
+    def __init__(
+        self, method: str, target: str, version: str, headers: Headers, body: bytes = b""
+    ):
+        self.method = method
+        self.target = target
+        self.version = version
+        self.headers = headers
+        self.body = body
+
+    @property
+    def path(self) -> str:
+        return self.target.split("?", 1)[0]
+
+    @property
+    def keep_alive(self) -> bool:
+        """Whether the client wants the connection kept open after the response."""
+        return _keep_alive(self.version, self.headers)
+
+    def header(self, name: str, default: Optional[str] = None) -> Optional[str]:
+        return _header(self.headers, name, default)
+
+    def serialize(self) -> bytes:
+        """The request as sent to the hub over a persistent connection."""
+        lines = ["{} {} HTTP/1.1".format(self.method, self.target)]
+        lines += ["{}: {}".format(k, v) for k, v in _end_to_end(self.headers)]
+        lines += ["Content-Length: {}".format(len(self.body)), "", ""]
+        return "\r\n".join(lines).encode("latin-1") + self.body
+
+
+class Response:
+    """An HTTP response, with its whole body."""
+
+    def __init__(self, status: int, headers: Optional[Headers] = None, body: bytes = b""):
+        self.status = status
+        self.headers = headers or []
+        self.body = body
+
+    @property
+    def keep_alive(self) -> bool:
+        return _keep_alive("HTTP/1.1", self.headers)
+
+    def header(self, name: str, default: Optional[str] = None) -> Optional[str]:
+        return _header(self.headers, name, default)
+
+    def serialize(self, keep_alive: bool = True) -> bytes:
+        """The response as sent to a client."""
+        lines = ["HTTP/1.1 {} {}".format(self.status, REASONS.get(self.status, "Unknown"))]
+        lines += ["{}: {}".format(k, v) for k, v in _end_to_end(self.headers)]
+        lines.append("Content-Length: {}".format(len(self.body)))
+        if not keep_alive:
+            lines.append("Connection: close")
+        lines += ["", ""]
+        return "\r\n".join(lines).encode("latin-1") + self.body
+
+
+def text_response(status: int, text: str) -> Response:
+    """A plain text response, e.g. for errors."""
+    return Response(status, [("Content-Type", "text/plain")], text.encode("utf-8"))
+
+
+async def read_request(reader: asyncio.StreamReader, max_body_bytes: int) -> Optional[Request]:
+    """Read the next request of a connection.
+
+    Args:
+        reader: the client connection.
+        max_body_bytes: largest body accepted.
+
+    Returns:
+        the request, or None if the client closed the connection between requests.
+
+    Raises:
+        ProtocolError: if the request is malformed or too large.
+    """
+    line = await _read_line(reader)
+    while line == b"\r\n":  # tolerated between pipelined requests
+        line = await _read_line(reader)
+    if not line:
+        return None
+    try:
+        method, target, version = line.decode("latin-1").split()
+    except ValueError:
+        raise ProtocolError("malformed request line")
+    if not version.startswith("HTTP/1."):
+        raise ProtocolError("unsupported HTTP version {}".format(version))
+    headers = await _read_headers(reader)
+    body = await _read_body(reader, headers, max_body_bytes)
+    return Request(method, target, version, headers, body)
+
+
+async def read_response(reader: asyncio.StreamReader, max_body_bytes: int) -> Response:
+    """Read the response to a request sent on a connection.
+
+    Args:
+        reader: the hub connection.
+        max_body_bytes: largest body accepted.
+
+    Raises:
+        ProtocolError: if the response is malformed or the connection was closed.
+    """
+    line = await _read_line(reader)
+    if not line:
+        raise ProtocolError("connection closed", status=502)
+    try:
+        status = int(line.split()[1])
+    except (IndexError, ValueError):
+        raise ProtocolError("malformed status line", status=502)
+    headers = await _read_headers(reader)
+    body = await _read_body(reader, headers, max_body_bytes)
+    return Response(status, headers, body)
+
+
+async def _read_line(reader: asyncio.StreamReader) -> bytes:
+    try:
+        line = await reader.readuntil(b"\n")
+    except asyncio.IncompleteReadError as e:
+        if e.partial:
+            raise ProtocolError("connection closed mid-line")
+        return b""
+    except asyncio.LimitOverrunError:
+        raise ProtocolError("line too long")
+    if len(line) > MAX_LINE_BYTES:
+        raise ProtocolError("line too long")
+    return line
+
+
+async def _read_headers(reader: asyncio.StreamReader) -> Headers:
+    headers = []
+    while True:
+        line = await _read_line(reader)
+        if not line:
+            raise ProtocolError("connection closed in headers")
+        if line in (b"\r\n", b"\n"):
+            return headers
+        name, sep, value = line.decode("latin-1").partition(":")
+        if not sep or len(headers) >= MAX_HEADERS:
+            raise ProtocolError("malformed or too many headers")
+        headers.append((name.strip(), value.strip()))
+
+
+async def _read_body(reader: asyncio.StreamReader, headers: Headers, max_body_bytes: int) -> bytes:
+    if "chunked" in (_header(headers, "Transfer-Encoding") or "").lower():
+        return await _read_chunked(reader, max_body_bytes)
+    length = _header(headers, "Content-Length")
+    if length is None:
+        return b""
+    try:
+        size = int(length)
+    except ValueError:
+        raise ProtocolError("malformed Content-Length")
+    if size > max_body_bytes:
+        raise ProtocolError("body too large", status=413)
+    try:
+        return await reader.readexactly(size)
+    except asyncio.IncompleteReadError:
+        raise ProtocolError("connection closed in body")
+
+
+async def _read_chunked(reader: asyncio.StreamReader, max_body_bytes: int) -> bytes:
+    chunks = []
+    total = 0
+    while True:
+        line = await _read_line(reader)
+        try:
+            size = int(line.split(b";", 1)[0], 16)
+        except ValueError:
+            raise ProtocolError("malformed chunk size")
+        if size == 0:
+            # trailers, if any, end with an empty line
+            while await _read_line(reader) not in (b"\r\n", b"\n", b""):
+                pass
+            return b"".join(chunks)
+        total += size
+        if total > max_body_bytes:
+            raise ProtocolError("body too large", status=413)
+        try:
+            chunks.append(await reader.readexactly(size))
+            await reader.readexactly(2)
+        except asyncio.IncompleteReadError:
+            raise ProtocolError("connection closed in body")
+
+
+def _header(headers: Headers, name: str, default: Optional[str] = None) -> Optional[str]:
+    name = name.lower()
+    for key, value in headers:
+        if key.lower() == name:
+            return value
+    return default
+
+
+def _keep_alive(version: str, headers: Headers) -> bool:
+    connection = (_header(headers, "Connection") or "").lower()
+    if version == "HTTP/1.0":
+        return connection == "keep-alive"
+    return connection != "close"
+
+
+def _end_to_end(headers: Headers) -> Headers:
+    return [(k, v) for k, v in headers if k.lower() not in HOP_BY_HOP_HEADERS]
@@ -0,0 +1,373 @@
+# Copyright 2022 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""Drain the hub on a schedule, and send its samples to Prometheus with remote-write.
+
+Rather than waiting for Prometheus to scrape the hub, the egress stage scrapes it itself every
+`interval` seconds, which empties the hub cache, and sends the samples to each remote-write
+endpoint as snappy-compressed protobuf `WriteRequest`s.
+
+Each endpoint spreads series over `shards` queues by their labels, so that the samples of a
+series are sent in order, and each shard sends one request at a time over its own connection.
+A request failing with a connection error, a 5xx or a 429 is retried with an exponential
+backoff; other failures are dropped. Queues hold at most `capacity` samples: while an endpoint
+is down, the oldest samples are dropped rather than the sidecar running out of memory.
+"""
+
+import asyncio
+import collections
+import functools
+import logging
+import ssl
+import struct
+import time
+import urllib.parse
+from typing import Deque, Dict, List, Optional, Sequence, Tuple
+
+from . import snappy
+from .admission import Admission
+from .exposition import CONTENT_TYPE, parse, parse_sample
+from .metrics import Counter, Gauge, Histogram, Registry
+from .protocol import ProtocolError, Request, read_response
+from .upstream import UpstreamPool
+
+logger = logging.getLogger(__name__)
+
+MIN_BACKOFF = 0.03
+MAX_BACKOFF = 5.0
+# seconds given to the queues to be sent when stopping, within the kill delay of Pebble
+CLOSE_TIMEOUT = 3.0
+LATENCY_BUCKETS = [0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+HEADERS = [
+    ("Content-Encoding", "snappy"),
+    ("Content-Type", "application/x-protobuf"),
+    ("User-Agent", "prometheus-edge-hub-ingest"),
+    ("X-Prometheus-Remote-Write-Version", "0.1.0"),
+]
+
+Labels = Tuple[Tuple[str, str], ...]
+# labels, value, timestamp in milliseconds, and when it was drained from the hub
+Sample = Tuple[Labels, float, int, float]
+
+
+def _field(number: int, payload: bytes) -> bytes:
+    """A length-delimited protobuf field."""
+    return snappy.varint(number << 3 | 2) + snappy.varint(len(payload)) + payload
+
+
+_double = struct.Struct("<d").pack
+
+
+@functools.lru_cache(maxsize=1 << 16)
+def _label(name: str, value: str) -> bytes:
+    # label pairs repeat across series and drains, so their encoding is cached
+    return _field(1, _field(1, name.encode()) + _field(2, value.encode()))
+
+
+def encode_write_request(samples: Sequence[Sample]) -> bytes:
+    """The protobuf `prometheus.WriteRequest` of samples, one time series per sample."""
+    out = bytearray()
+    varint = snappy.varint
+    for labels, value, timestamp, _ in samples:
+        series = b"".join([_label(name, label_value) for name, label_value in labels])
+        sample = b"\x09" + _double(value) + b"\x10" + varint(timestamp)
+        # a sample is always shorter than 128 bytes, so its length is a one byte varint
+        series += b"\x12" + bytes((len(sample),)) + sample
+        out += b"\x0a" + varint(len(series)) + series
+    return bytes(out)
+
+
+class RetryableError(Exception):
+    """Raised when a request may succeed if sent again."""
+
+
+class Endpoint:
+    """A remote-write endpoint, and the shards sending samples to it."""
+
+    def __init__(self, url: str, shards: int, capacity: int, max_samples: int, timeout: float):
+        """Constructor for Endpoint.
+
+        Args:
+            url: remote-write URL, over http or https.
+            shards: number of queues, each sending one request at a time.
+            capacity: largest number of samples queued by a shard.
+            max_samples: largest number of samples sent in a request.
+            timeout: seconds to wait for the endpoint to answer a request.
+        """
+        self.url = url
+        parts = urllib.parse.urlsplit(url)
+        if parts.scheme not in ("http", "https") or not parts.hostname:
+            raise ValueError("invalid remote-write URL: {}".format(url))
+        self._host = parts.hostname
+        self._ssl = ssl.create_default_context() if parts.scheme == "https" else None
+        self._port = parts.port or (443 if self._ssl else 80)
+        self._target = urllib.parse.urlunsplit(("", "", parts.path or "/", parts.query, ""))
+        self._headers = HEADERS + [("Host", parts.netloc)]
+        self._capacity = capacity
+        self._max_samples = max_samples
+        self._timeout = timeout
+        self._queues: List[Deque[Sample]] = [collections.deque() for _ in range(shards)]
+        self._wakeups = [asyncio.Event() for _ in range(shards)]
+        self._tasks: List[asyncio.Future] = []
+        self._closed = False
+        self._sending = 0
+        self.sent = 0
+        self.dropped = 0
+        self.failed = 0
+        self.retries = 0
+        self.latency: Optional[Histogram] = None
+
+    @property
+    def pending(self) -> int:
+        """Samples queued or being sent."""
+        return self._sending + sum(len(queue) for queue in self._queues)
+
+    def enqueue(self, samples: Sequence[Sample]) -> None:
+        """Queue samples, dropping the oldest ones of a full shard."""
+        shards = len(self._queues)
+        for sample in samples:
+            shard = hash(sample[0]) % shards
+            queue = self._queues[shard]
+            if len(queue) >= self._capacity:
+                queue.popleft()
+                self.dropped += 1
+            queue.append(sample)
+            self._wakeups[shard].set()
+
+    def start(self) -> None:
+        self._tasks = [
+            asyncio.ensure_future(self._run(shard)) for shard in range(len(self._queues))
+        ]
+
+    async def close(self) -> None:
+        # the shards are also flagged, as before Python 3.12 `asyncio.wait_for` may swallow
+        # a cancellation coming as the endpoint answers
+        self._closed = True
+        for wakeup in self._wakeups:
+            wakeup.set()
+        for task in self._tasks:
+            task.cancel()
+        if self._tasks:
+            await asyncio.wait(self._tasks, timeout=CLOSE_TIMEOUT)
+
+    async def _run(self, shard: int) -> None:
+        queue, wakeup = self._queues[shard], self._wakeups[shard]
+        connection = None
+        try:
+            while not self._closed:
+                await wakeup.wait()
+                wakeup.clear()
+                while queue and not self._closed:
+                    batch = [queue.popleft() for _ in range(min(len(queue), self._max_samples))]
+                    self._sending += len(batch)
+                    try:
+                        connection = await self._send_with_retries(connection, batch)
+                    finally:
+                        self._sending -= len(batch)
+        finally:
+            if connection is not None:
+                connection[1].close()
+
+    async def _send_with_retries(self, connection, batch: List[Sample]):
+        body = snappy.compress(encode_write_request(batch))
+        backoff = MIN_BACKOFF
+        while not self._closed:
+            try:
+                connection = await self._send(connection, body)
+            except RetryableError as e:
+                connection = None
+                self.retries += 1
+                logger.debug("Retrying remote-write to %s in %.2fs: %s", self.url, backoff, e)
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, MAX_BACKOFF)
+                continue
+            except ProtocolError as e:
+                self.failed += len(batch)
+                logger.warning("Dropping %d samples for %s: %s", len(batch), self.url, e)
+                return connection
+            self.sent += len(batch)
+            if self.latency is not None:
+                now = time.monotonic()
+                for sample in batch:
+                    self.latency.observe(now - sample[3])
+            return connection
+        self.failed += len(batch)
+        return connection
+
+    async def _send(self, connection, body: bytes):
+        """Send a request, over the connection given if any, and return the connection to reuse.
+
+        Raises:
+            RetryableError: if the request failed, but may succeed if sent again.
+            ProtocolError: if the endpoint rejected the request.
+        """
+        request = Request("POST", self._target, "HTTP/1.1", self._headers, body)
+        try:
+            if connection is None:
+                connection = await asyncio.wait_for(
+                    asyncio.open_connection(self._host, self._port, ssl=self._ssl), self._timeout
+                )
+            reader, writer = connection
+            writer.write(request.serialize())
+            await writer.drain()
+            response = await asyncio.wait_for(read_response(reader, 1 << 20), self._timeout)
+        except (OSError, ProtocolError, asyncio.TimeoutError) as e:
+            if connection is not None:
+                connection[1].close()
+            raise RetryableError(str(e) or type(e).__name__)
+        if not response.keep_alive:
+            connection[1].close()
+            connection = None
+        if response.status == 429 or response.status >= 500:
+            raise RetryableError("status {}".format(response.status))
+        if response.status >= 300:
+            raise ProtocolError(
+                "status {}: {}".format(
+                    response.status, response.body[:200].decode("utf-8", "replace")
+                )
+            )
+        return connection
+
+
+class Egress:
+    """Drains the hub every `interval` seconds, and queues its samples for each endpoint."""
+
+    def __init__(
+        self,
+        pool: UpstreamPool,
+        endpoints: List[Endpoint],
+        interval: float,
+        labels: Dict[str, str],
+        registry: Registry,
+        admission: Optional[Admission] = None,
+    ):
+        """Constructor for Egress.
+
+        Args:
+            pool: connections to the hub.
+            endpoints: where the samples are sent.
+            interval: seconds between two drains of the hub.
+            labels: added to the samples not having them, e.g. the Juju topology.
+            registry: where the egress metrics are added.
+            admission: holding the samples pushed since the last drain, if any.
+        """
+        self._pool = pool
+        self._admission = admission
+        self.endpoints = endpoints
+        self._interval = interval
+        self._labels = labels
+        self._task: Optional[asyncio.Future] = None
+        self._stopping: Optional[asyncio.Event] = None
+        self.drain_seconds = registry.add(
+            Histogram(
+                "ingest_remote_write_drain_duration_seconds",
+                "Time taken to drain the hub.",
+                LATENCY_BUCKETS,
+            )
+        )
+        latency = registry.add(
+            Histogram(
+                "ingest_remote_write_latency_seconds",
+                "Time from draining samples from the hub to their remote-write.",
+                LATENCY_BUCKETS,
+            )
+        )
+        for endpoint in endpoints:
+            endpoint.latency = latency
+        self.drained = 0
+        for name, help, read in (
+            ("drained_samples", "Samples drained from the hub.", lambda: self.drained),
+            ("sent_samples", "Samples sent.", lambda: self._total("sent")),
+            (
+                "dropped_samples",
+                "Samples dropped from full queues.",
+                lambda: self._total("dropped"),
+            ),
+            ("failed_samples", "Samples rejected by endpoints.", lambda: self._total("failed")),
+            ("retries", "Requests sent again.", lambda: self._total("retries")),
+        ):
+            registry.add(Counter("ingest_remote_write_{}_total".format(name), help, read))
+        registry.add(
+            Gauge(
+                "ingest_remote_write_pending_samples",
+                "Samples queued.",
+                lambda: self._total("pending"),
+            )
+        )
+
+    def _total(self, attribute: str) -> int:
+        return sum(getattr(endpoint, attribute) for endpoint in self.endpoints)
+
+    def start(self) -> None:
+        for endpoint in self.endpoints:
+            endpoint.start()
+        self._stopping = asyncio.Event()
+        self._task = asyncio.ensure_future(self._run())
+
+    async def close(self) -> None:
+        """Drain the hub one last time, and give the queues `CLOSE_TIMEOUT` seconds to be sent."""
+        if self._task is not None and self._stopping is not None:
+            # stopped rather than cancelled, see `Endpoint.close`; a drain is bounded by the
+            # timeout of the pool
+            self._stopping.set()
+            await self._task
+            # the samples pushed since the last drain, which a hub restarted empty would lose
+            try:
+                await self.drain()
+            except ProtocolError as e:
+                logger.warning("Failed to drain the hub when stopping: %s", e)
+        deadline = time.monotonic() + CLOSE_TIMEOUT
+        while self._total("pending") and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        for endpoint in self.endpoints:
+            await endpoint.close()
+
+    async def _run(self) -> None:
+        assert self._stopping is not None
+        while not self._stopping.is_set():
+            start = time.monotonic()
+            try:
+                await self.drain()
+            except ProtocolError as e:
+                logger.warning("Failed to drain the hub: %s", e)
+            delay = max(0.0, self._interval - (time.monotonic() - start))
+            try:
+                await asyncio.wait_for(self._stopping.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+    async def drain(self) -> None:
+        """Scrape the hub, which empties it, and queue the samples for each endpoint."""
+        start = time.monotonic()
+        if self._admission is not None:
+            await self._admission.flush()
+        response = await self._pool.request(
+            Request("GET", "/metrics", "HTTP/1.1", [("Accept", CONTENT_TYPE)])
+        )
+        if response.status != 200:
+            raise ProtocolError("hub answered with {}".format(response.status), 502)
+        samples = self.samples(response.body.decode("utf-8", "replace"), start)
+        self.drain_seconds.observe(time.monotonic() - start)
+        self.drained += len(samples)
+        for endpoint in self.endpoints:
+            endpoint.enqueue(samples)
+
+    def samples(self, text: str, drained: float) -> List[Sample]:
+        """The samples of a scrape of the hub, with the egress labels and sorted labels."""
+        now = int(time.time() * 1000)
+        samples = []
+        for family in parse(text):
+            for line in family.samples:
+                try:
+                    name, labels, value, timestamp = parse_sample(line)
+                except ValueError:
+                    logger.debug("Skipping malformed sample: %s", line)
+                    continue
+                labels["__name__"] = name
+                for label, label_value in self._labels.items():
+                    labels.setdefault(label, label_value)
+                sorted_labels = tuple(sorted((k, v) for k, v in labels.items() if v))
+                samples.append(
+                    (sorted_labels, value, now if timestamp is None else timestamp, drained)
+                )
+        return samples
@@ -0,0 +1,101 @@
+# Copyright 2022 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""Snappy compression, in the block format remote-write receivers expect, in pure Python.
+
+Input is compressed in blocks of 64 KiB, as by the reference implementation. Repeated sequences
+of 4 bytes or more are found with a table of the last position of each sequence, and written as
+copies of the earlier occurrence, the rest as literals. Like the reference implementation, the
+search skips ahead faster while no match is found, so that incompressible input stays cheap.
+"""
+
+BLOCK_SIZE = 1 << 16
+MIN_MATCH = 4
+MAX_COPY = 64
+
+
+def varint(value: int) -> bytes:
+    """Unsigned little-endian base 128 encoding, as used by snappy and protobuf."""
+    out = bytearray()
+    while value >= 0x80:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def _emit_literal(out: bytearray, block: bytes, start: int, end: int) -> None:
+    length = end - start
+    if length == 0:
+        return
+    if length <= 60:
+        out.append((length - 1) << 2)
+    else:
+        size = ((length - 1).bit_length() + 7) // 8
+        out.append((59 + size) << 2)
+        out += (length - 1).to_bytes(size, "little")
+    out += block[start:end]
+
+
+def _emit_copy(out: bytearray, offset: int, length: int) -> None:
+    # copies of up to 64 bytes, split so that the last one is at least 4 bytes long
+    while length > 0:
+        if length >= MAX_COPY + MIN_MATCH:
+            chunk = MAX_COPY
+        elif length > MAX_COPY:
+            chunk = length - MIN_MATCH
+        else:
+            chunk = length
+        if chunk < 12 and offset < 2048:
+            out.append(0x01 | ((chunk - 4) << 2) | ((offset >> 8) << 5))
+            out.append(offset & 0xFF)
+        else:
+            out.append(0x02 | ((chunk - 1) << 2))
+            out += offset.to_bytes(2, "little")
+        length -= chunk
+
+
+def _match_length(block: bytes, candidate: int, position: int) -> int:
+    end = len(block)
+    # compare 8 bytes at a time first, as slices compare faster than bytes one by one
+    start, stop = candidate + MIN_MATCH, position + MIN_MATCH
+    while stop + 8 <= end:
+        start_end, stop_end = start + 8, stop + 8
+        if block[start:start_end] != block[stop:stop_end]:
+            break
+        start, stop = start_end, stop_end
+    while stop < end and block[start] == block[stop]:
+        start, stop = start + 1, stop + 1
+    return stop - position
+
+
+def _compress_block(block: bytes, out: bytearray) -> None:
+    table = {}
+    position = literal_start = 0
+    skip = 32
+    limit = len(block) - MIN_MATCH
+    while position <= limit:
+        key_end = position + MIN_MATCH
+        key = block[position:key_end]
+        candidate = table.get(key)
+        table[key] = position
+        if candidate is None:
+            position += skip >> 5
+            skip += 1
+            continue
+        skip = 32
+        length = _match_length(block, candidate, position)
+        _emit_literal(out, block, literal_start, position)
+        _emit_copy(out, position - candidate, length)
+        position += length
+        literal_start = position
+    _emit_literal(out, block, literal_start, len(block))
+
+
+def compress(data: bytes) -> bytes:
+    """The snappy block format compression of `data`."""
+    out = bytearray(varint(len(data)))
+    for start in range(0, len(data), BLOCK_SIZE):
+        end = start + BLOCK_SIZE
+        _compress_block(data[start:end], out)
+    return bytes(out)
@@ -0,0 +1,96 @@
+# Copyright 2022 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""A small pool of persistent connections to the hub."""
+
+import asyncio
+import logging
+from typing import List, Optional, Tuple
+
+from .protocol import ProtocolError, Request, Response, read_response
+
+logger = logging.getLogger(__name__)
+
+Connection = Tuple[asyncio.StreamReader, asyncio.StreamWriter]
+
+
+class UpstreamPool:
+    """Sends requests to the hub over at most `size` keep-alive connections.
+
+    A request waits for a free connection, so the pool also bounds the concurrency the hub
+    sees. Connections are opened on demand and reused until the hub closes them.
+
+    Requests are never sent twice: a scrape drains the hub, and a push may have been accepted
+    even if its response was lost, so a request failing after being written fails. Idle
+    connections the hub has closed are discarded before they are reused instead.
+    """
+
+    def __init__(self, host: str, port: int, size: int, max_response_bytes: int, timeout: float):
+        """Constructor for UpstreamPool.
+
+        Args:
+            host: hub address.
+            port: hub HTTP port.
+            size: largest number of connections to the hub.
+            max_response_bytes: largest response body accepted from the hub, which holds a
+                whole drain of its cache when scraped.
+            timeout: seconds to wait for the hub to answer a request.
+        """
+        self._host = host
+        self._port = port
+        self._max_response_bytes = max_response_bytes
+        self._timeout = timeout
+        self._slots = asyncio.Semaphore(size)
+        self._idle: List[Connection] = []
+        self.connections_opened = 0
+        self.requests = 0
+
+    async def request(self, request: Request) -> Response:
+        """Send a request to the hub and return its response.
+
+        Raises:
+            ProtocolError: with status 502 if the hub could not be reached or did not answer.
+        """
+        async with self._slots:
+            try:
+                return await self._send(self._reusable_connection(), request)
+            except (OSError, ProtocolError, asyncio.TimeoutError) as e:
+                raise ProtocolError("hub unavailable: {}".format(e), status=502)
+
+    def _reusable_connection(self) -> Optional[Connection]:
+        """An idle connection still open, if any, closing those the hub has closed."""
+        while self._idle:
+            reader, writer = self._idle.pop()
+            if not reader.at_eof() and not writer.is_closing():
+                return reader, writer
+            writer.close()
+        return None
+
+    async def close(self) -> None:
+        """Close the idle connections."""
+        while self._idle:
+            _, writer = self._idle.pop()
+            writer.close()
+
+    async def _send(self, connection: Optional[Connection], request: Request) -> Response:
+        if connection is None:
+            connection = await asyncio.wait_for(
+                asyncio.open_connection(self._host, self._port), self._timeout
+            )
+            self.connections_opened += 1
+        reader, writer = connection
+        try:
+            writer.write(request.serialize())
+            await writer.drain()
+            response = await asyncio.wait_for(
+                read_response(reader, self._max_response_bytes), self._timeout
+            )
+        except BaseException:
+            writer.close()
+            raise
+        self.requests += 1
+        if response.keep_alive:
+            self._idle.append(connection)
+        else:
+            writer.close()
+        return response
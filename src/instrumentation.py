@@ -0,0 +1,191 @@
+# Copyright 2022 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""Instrument the charm's own hooks and push the results into the co-located hub.
+
+Each hook records its wall time, the count and latency of the hook tool, Pebble and Kubernetes
+API calls it makes, and the size of the relation data it writes. When the hook commits, these
+are pushed to the hub in the Prometheus text exposition format, so that they are scraped along
+with the pushed metrics through the existing `metrics-endpoint` job.
+
+Only the charm's own objects are instrumented, never their classes: the Pebble client of each
+container, the lightkube clients created through `kubernetes_client`, and the model backend of
+the charm, whose `_run` runs every hook tool and `update_relation_data` every relation data
+write. ops has no public hook for either before its tracing support.
+"""
+
+import functools
+import logging
+import os
+import time
+import urllib.error
+import urllib.request
+from typing import TYPE_CHECKING, Callable, Dict, List, Tuple, Union
+
+from ops.charm import CharmBase
+from ops.framework import Object
+from ops.model import Application, Container, Unit
+
+if TYPE_CHECKING:
+    from lightkube import Client
+
+logger = logging.getLogger(__name__)
+
+PUSH_TIMEOUT = 1
+CONTENT_TYPE = "text/plain; version=0.0.4"
+PEBBLE_CALLS = (
+    "add_layer",
+    "exec",
+    "get_checks",
+    "get_plan",
+    "get_services",
+    "get_system_info",
+    "list_files",
+    "make_dir",
+    "pull",
+    "push",
+    "remove_path",
+    "replan_services",
+    "restart_services",
+    "start_services",
+    "stop_services",
+)
+KUBERNETES_CALLS = ("apply", "create", "delete", "get", "list", "patch", "replace")
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class Instrumentation(Object):
+    """Records where the time of a hook goes and pushes it to the hub on commit."""
+
+    def __init__(self, charm: CharmBase, containers: List[Container], hub_url: str):
+        """Constructor for Instrumentation.
+
+        Args:
+            charm: the charm that is instantiating this object.
+            containers: the workload containers whose Pebble calls are recorded.
+            hub_url: base URL of the hub HTTP API, as reachable from the charm.
+        """
+        super().__init__(charm, "instrumentation")
+        self._charm = charm
+        self._metrics_url = f"{hub_url}/metrics"
+        # the hook started before the charm was instantiated, this is the closest we get
+        self._started = time.monotonic()
+        self._hook = os.path.basename(os.environ.get("JUJU_DISPATCH_PATH", "")) or "unknown"
+        self._calls: Dict[Tuple[str, str], List[float]] = {}
+        self._relation_data: Dict[Tuple[int, str], int] = {}
+
+        for container in containers:
+            self._instrument_pebble(container)
+        self._instrument_backend()
+
+        self.framework.observe(self.framework.on.commit, self._on_commit)
+
+    def record_call(self, api: str, call: str, start: float) -> None:
+        """Records a call to `api` that started at `start`, as given by `time.monotonic`."""
+        entry = self._calls.setdefault((api, call), [0, 0.0])
+        entry[0] += 1
+        entry[1] += time.monotonic() - start
+
+    def kubernetes_client(self) -> "Client":
+        """Returns a new lightkube client whose calls are recorded."""
+        from lightkube import Client
+
+        client = Client()
+        for name in KUBERNETES_CALLS:
+            method = getattr(client, name, None)
+            if method is not None:
+                setattr(client, name, self._timed("kubernetes", name, method))
+        return client
+
+    def _timed(self, api: str, call: str, method: Callable) -> Callable:
+        @functools.wraps(method)
+        def timed(*args, **kwargs):
+            start = time.monotonic()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                self.record_call(api, call, start)
+
+        return timed
+
+    def _instrument_pebble(self, container: Container) -> None:
+        client = container.pebble
+        for name in PEBBLE_CALLS:
+            method = getattr(client, name, None)
+            if method is not None:
+                setattr(client, name, self._timed("pebble", name, method))
+
+    def _instrument_backend(self) -> None:
+        """Times the hook tools and records the relation data writes of the charm's model."""
+        backend = self.model._backend
+        run = getattr(backend, "_run", None)
+        # the testing backend of the Harness has no hook tools
+        if run is not None:
+
+            @functools.wraps(run)
+            def timed_run(tool: str, *args: str, **kwargs):
+                start = time.monotonic()
+                try:
+                    return run(tool, *args, **kwargs)
+                finally:
+                    self.record_call("juju", tool, start)
+
+            backend._run = timed_run
+        update_relation_data = backend.update_relation_data
+
+        @functools.wraps(update_relation_data)
+        def recorded(relation_id: int, entity: Union[Unit, Application], key: str, value: str):
+            update_relation_data(relation_id, entity, key, value)
+            self._relation_data[(relation_id, key)] = len(value.encode("utf-8"))
+
+        backend.update_relation_data = recorded
+
+    def exposition(self) -> str:
+        """The metrics recorded so far, in the Prometheus text exposition format."""
+        base = f'hook="{_escape(self._hook)}",unit="{_escape(self._charm.unit.name)}"'
+        lines = [
+            "# HELP charm_hook_duration_seconds Wall time of the hook so far.",
+            "# TYPE charm_hook_duration_seconds gauge",
+            f"charm_hook_duration_seconds{{{base}}} {time.monotonic() - self._started:.6f}",
+            "# HELP charm_calls Calls made by the hook, by API.",
+            "# TYPE charm_calls gauge",
+        ]
+        calls = sorted(self._calls.items())
+        for (api, call), (count, _) in calls:
+            lines.append(f'charm_calls{{{base},api="{api}",call="{_escape(call)}"}} {count:.0f}')
+        lines += [
+            "# HELP charm_call_duration_seconds Time spent in calls made by the hook.",
+            "# TYPE charm_call_duration_seconds gauge",
+        ]
+        for (api, call), (_, seconds) in calls:
+            lines.append(
+                "charm_call_duration_seconds"
+                f'{{{base},api="{api}",call="{_escape(call)}"}} {seconds:.6f}'
+            )
+        lines += [
+            "# HELP charm_relation_data_bytes Size of the relation data written by the hook.",
+            "# TYPE charm_relation_data_bytes gauge",
+        ]
+        for (relation_id, key), size in sorted(self._relation_data.items()):
+            lines.append(
+                "charm_relation_data_bytes"
+                f'{{{base},relation_id="{relation_id}",key="{_escape(key)}"}} {size}'
+            )
+        return "\n".join(lines) + "\n"
+
+    def _on_commit(self, _) -> None:
+        request = urllib.request.Request(
+            self._metrics_url,
+            data=self.exposition().encode("utf-8"),
+            method="POST",
+            headers={"Content-Type": CONTENT_TYPE},
+        )
+        try:
+            with urllib.request.urlopen(request, timeout=PUSH_TIMEOUT):
+                pass
+        except (urllib.error.URLError, OSError) as e:
+            # the hub is not running in every hook, e.g. before pebble-ready
+            logger.debug("Failed to push hook metrics to the hub: %s", e)
@@ -0,0 +1,153 @@
+# Copyright 2022 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""Restart the workload of one unit at a time, in the order granted by the leader.
+
+Units needing a restart set a new `restart_requested` nonce in their peer unit data. The leader
+sets `restart_granted` in the peer application data to a single unit with a pending request.
+That unit restarts its workload and, once the workload is ready again, acknowledges the request
+by copying the nonce into `restart_done`. Only then is the next unit granted its restart.
+
+A unit whose workload is not ready yet when its restart completes defers the event it was
+handling, so that readiness is checked again at the start of its next hook.
+"""
+
+import logging
+import uuid
+from typing import Callable, Optional
+
+from ops.charm import CharmBase
+from ops.framework import EventBase, Object, StoredState
+from ops.model import Relation, RelationDataContent
+
+logger = logging.getLogger(__name__)
+
+
+def _is_pending(unit_data: RelationDataContent) -> bool:
+    return unit_data.get("restart_requested", "") != unit_data.get("restart_done", "")
+
+
+def _unit_number(unit_name: str) -> int:
+    return int(unit_name.split("/")[-1])
+
+
+class RollingRestart(Object):
+    """Coordinates workload restarts across the units of the application."""
+
+    _stored = StoredState()
+
+    def __init__(
+        self,
+        charm: CharmBase,
+        relation_name: str,
+        restart: Callable[[], None],
+        is_ready: Callable[[], bool],
+    ):
+        """Constructor for RollingRestart.
+
+        Args:
+            charm: the charm that is instantiating this object.
+            relation_name: name of the peer relation used for coordination.
+            restart: callback restarting the workload of this unit.
+            is_ready: callback telling whether the workload of this unit is ready to serve.
+        """
+        super().__init__(charm, relation_name)
+        self._charm = charm
+        self._relation_name = relation_name
+        self._restart = restart
+        self._is_ready = is_ready
+        self._stored.set_default(restarted="")
+
+        events = self._charm.on[relation_name]
+        for event in (
+            events.relation_changed,
+            events.relation_departed,
+            self._charm.on.leader_elected,
+            self._charm.on.update_status,
+        ):
+            self.framework.observe(event, self._on_state_changed)
+
+    @property
+    def _relation(self) -> Optional[Relation]:
+        return self.model.get_relation(self._relation_name)
+
+    @property
+    def pending(self) -> bool:
+        """Whether this unit has requested a restart that has not completed yet."""
+        relation = self._relation
+        return relation is not None and _is_pending(relation.data[self._charm.unit])
+
+    def request(self) -> None:
+        """Requests a restart of this unit's workload.
+
+        Without other units to coordinate with, the workload is restarted straight away.
+        Otherwise it is restarted once granted, see `resume`.
+        """
+        relation = self._relation
+        if relation is None or not relation.units:
+            self._restart()
+            return
+        relation.data[self._charm.unit]["restart_requested"] = uuid.uuid4().hex
+
+    def resume(self) -> bool:
+        """Moves the rolling restart along from this unit.
+
+        The leader grants the next restart, and this unit restarts if granted and acknowledges
+        its restart once its workload is ready.
+
+        Returns:
+            whether this unit has restarted but its workload is not ready yet, in which case
+            the caller should check again later, e.g. by deferring its event.
+        """
+        relation = self._relation
+        if relation is None:
+            return False
+        if self._charm.unit.is_leader():
+            self._grant_next(relation)
+        not_ready = self._restart_if_granted(relation)
+        # the leader does not get notified of changes to its own unit data
+        if self._charm.unit.is_leader():
+            self._grant_next(relation)
+        return not_ready
+
+    def _on_state_changed(self, event: EventBase) -> None:
+        if self.resume():
+            event.defer()
+
+    def _grant_next(self, relation: Relation) -> None:
+        """Grants the restart to the next unit once the current one has completed its own."""
+        units = {unit.name: relation.data[unit] for unit in relation.units}
+        units[self._charm.unit.name] = relation.data[self._charm.unit]
+        app_data = relation.data[self._charm.app]
+        granted = app_data.get("restart_granted", "")
+        if granted in units and _is_pending(units[granted]):
+            return
+        waiting = sorted(
+            (name for name, data in units.items() if _is_pending(data)), key=_unit_number
+        )
+        next_unit = waiting[0] if waiting else ""
+        if next_unit != granted:
+            app_data["restart_granted"] = next_unit
+            if next_unit:
+                logger.info("Granted rolling restart to %s", next_unit)
+
+    def _restart_if_granted(self, relation: Relation) -> bool:
+        """Restarts this unit if granted, and acknowledges the restart once ready.
+
+        Returns:
+            whether the workload has restarted but is not ready yet.
+        """
+        unit_data = relation.data[self._charm.unit]
+        if relation.data[self._charm.app].get("restart_granted") != self._charm.unit.name:
+            return False
+        if not _is_pending(unit_data):
+            return False
+        requested = unit_data["restart_requested"]
+        if self._stored.restarted != requested:
+            self._restart()
+            self._stored.restarted = requested
+        if not self._is_ready():
+            logger.info("Workload not ready yet, the rolling restart resumes on a later hook")
+            return True
+        unit_data["restart_done"] = requested
+        return False
@@ -0,0 +1,187 @@
+# Copyright 2022 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""Hook latency benchmarks for the charm and the libraries it uses.
+
+Run with `tox -e benchmark`, which writes the results to `benchmark.json`.
+"""
+
+from unittest.mock import MagicMock, patch
+
+import pytest
+from charms.prometheus_k8s.v0.prometheus_scrape import (
+    MetricsEndpointConsumer,
+    _inject_label_matchers,
+)
+from ops.charm import CharmBase
+from ops.testing import Harness
+
+from charm import PrometheusEdgeHubCharm
+
+SIZES = [1, 10, 100, 1000]
+ROUNDS = 5
+
+CONSUMER_METADATA = """
+name: prometheus-k8s
+requires:
+  metrics-endpoint:
+    interface: prometheus_scrape
+"""
+
+ALERT_RULE = """
+alert: HubTargetMissing{index}
+expr: up{{job="prometheus-edge-hub"}} == 0
+for: 5m
+labels:
+  severity: critical
+annotations:
+  summary: Prometheus Edge Hub target {index} is missing
+"""
+
+SCRAPE_METADATA = (
+    '{"model": "edge", "model_uuid": "f2c1b2a8-0e0f-4b5f-9c1a-3d2f0c4b5a6e", '
+    '"application": "provider-{index}", "unit": "provider-{index}/0", '
+    '"charm_name": "prometheus-edge-hub"}'
+)
+SCRAPE_JOBS = '[{"metrics_path": "/metrics", "static_configs": [{"targets": ["*:9091"]}]}]'
+ALERT_RULES = (
+    '{"groups": [{"name": "provider_{index}_alerts", "rules": [{"alert": "HubDown", '
+    '"expr": "up < 1", "for": "0m", "labels": {"juju_model": "edge", '
+    '"juju_model_uuid": "f2c1b2a8-0e0f-4b5f-9c1a-3d2f0c4b5a6e", '
+    '"juju_application": "provider-{index}"}}]}]}'
+)
+
+
+class ConsumerCharm(CharmBase):
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.metrics_consumer = MetricsEndpointConsumer(self)
+
+
+def run(benchmark, size, func):
+    benchmark.extra_info["size"] = size
+    return benchmark.pedantic(func, rounds=ROUNDS, iterations=1, warmup_rounds=1)
+
+
+def hub_harness() -> Harness:
+    with patch("charm.KubernetesServicePatch", lambda x, y, **kwargs: None):
+        harness = Harness(PrometheusEdgeHubCharm)
+        harness.add_relation("replicas", "prometheus-edge-hub")
+        harness.begin()
+    harness.set_leader(True)
+    harness.set_can_connect("prometheus-edge-hub", True)
+    return harness
+
+
+@pytest.fixture
+def rules_dir(tmp_path, request):
+    for index in range(request.param):
+        (tmp_path / f"rule_{index}.rule").write_text(ALERT_RULE.format(index=index))
+    return tmp_path
+
+
+@pytest.mark.parametrize("size", SIZES)
+def test_configure(benchmark, size):
+    harness = hub_harness()
+    for index in range(size):
+        relation_id = harness.add_relation("metrics-endpoint", f"prometheus-{index}")
+        harness.add_relation_unit(relation_id, f"prometheus-{index}/0")
+    event = MagicMock()
+
+    run(benchmark, size, lambda: harness.charm._configure(event))
+
+    harness.cleanup()
+
+
+@pytest.mark.parametrize("rules_dir", SIZES, indirect=True)
+def test_set_scrape_job_spec(benchmark, rules_dir):
+    size = len(list(rules_dir.iterdir()))
+    harness = hub_harness()
+    harness.charm.metrics_endpoint_provider._alert_rules_path = str(rules_dir)
+    relation_id = harness.add_relation("metrics-endpoint", "prometheus-k8s")
+    harness.add_relation_unit(relation_id, "prometheus-k8s/0")
+
+    run(
+        benchmark, size, lambda: harness.charm.metrics_endpoint_provider._set_scrape_job_spec(None)
+    )
+
+    harness.cleanup()
+
+
+def consumer_jobs_harness(size: int) -> Harness:
+    harness = Harness(ConsumerCharm, meta=CONSUMER_METADATA)
+    harness.begin()
+    relation_id = harness.add_relation("metrics-endpoint", "provider-0")
+    harness.update_relation_data(
+        relation_id,
+        "provider-0",
+        {"scrape_metadata": SCRAPE_METADATA.replace("{index}", "0"), "scrape_jobs": SCRAPE_JOBS},
+    )
+    for index in range(size):
+        unit_name = f"provider-0/{index}"
+        harness.add_relation_unit(relation_id, unit_name)
+        harness.update_relation_data(
+            relation_id,
+            unit_name,
+            {
+                "prometheus_scrape_unit_name": unit_name,
+                "prometheus_scrape_unit_address": f"provider-0-{index}.provider-0-endpoints",
+            },
+        )
+    return harness
+
+
+def consumer_alerts_harness(size: int) -> Harness:
+    harness = Harness(ConsumerCharm, meta=CONSUMER_METADATA)
+    harness.begin()
+    for index in range(size):
+        app_name = f"provider-{index}"
+        relation_id = harness.add_relation("metrics-endpoint", app_name)
+        harness.add_relation_unit(relation_id, f"{app_name}/0")
+        harness.update_relation_data(
+            relation_id,
+            app_name,
+            {
+                "scrape_metadata": SCRAPE_METADATA.replace("{index}", str(index)),
+                "scrape_jobs": SCRAPE_JOBS,
+                "alert_rules": ALERT_RULES.replace("{index}", str(index)),
+            },
+        )
+    return harness
+
+
+def run_cold(benchmark, size, new_harness, func):
+    """Benchmarks `func` on the consumer of a fresh harness each round.
+
+    The consumer memoizes jobs and alerts in its stored state, and rule expressions in the
+    process, so that a harness reused across rounds would only measure the warm memo. Each
+    round starts as a new hook process would, with none of them.
+    """
+    harnesses = []
+
+    def setup():
+        _inject_label_matchers.cache_clear()
+        harness = new_harness(size)
+        harnesses.append(harness)
+        return (harness.charm.metrics_consumer,), {}
+
+    benchmark.extra_info["size"] = size
+    try:
+        return benchmark.pedantic(func, setup=setup, rounds=ROUNDS)
+    finally:
+        for harness in harnesses:
+            harness.cleanup()
+
+
+@pytest.mark.parametrize("size", SIZES)
+def test_consumer_jobs(benchmark, size):
+    jobs = run_cold(benchmark, size, consumer_jobs_harness, lambda consumer: consumer.jobs())
+
+    assert len(jobs[0]["static_configs"]) == size
+
+
+@pytest.mark.parametrize("size", SIZES)
+def test_consumer_alerts(benchmark, size):
+    alerts = run_cold(benchmark, size, consumer_alerts_harness, lambda consumer: consumer.alerts())
+
+    assert len(alerts) == size
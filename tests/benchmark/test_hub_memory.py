@@ -0,0 +1,176 @@
+# Copyright 2022 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""Resident memory of the hub for growing numbers of cached series.
+
+The hub is run from the workload image named by `PROMETHEUS_EDGE_HUB_IMAGE`, as the CI benchmark
+job does with the image in metadata.yaml, or else from `PROMETHEUS_EDGE_HUB_BINARY` or the PATH;
+the benchmark is skipped without either. Series are pushed in the text
+format, and the RSS of the hub, as counted against the cgroup memory limit, is read from /proc
+before and after. The memory per series and the base memory are recorded in the `extra_info` of
+each benchmark, and checked against the constants the charm derives its cache limit from.
+
+The high-water mark of the hub memory under a steady push load is also measured for the two
+ways the hub is emptied: drained by the ingest sidecar every `remote_write_interval`, or
+scraped by Prometheus. Draining is a scrape of the hub either way, see
+`ingest.remote_write.Egress.drain`.
+"""
+
+import os
+import shutil
+import socket
+import subprocess
+import time
+import urllib.request
+from typing import Iterator, List, NamedTuple
+
+import pytest
+
+from charm import HUB_BASE_MEMORY_BYTES, SERIES_MEMORY_BYTES
+
+SERIES = [10000, 100000, 1000000]
+PUSH_SERIES = 10000
+# remote_write_interval by default, and the scrape interval of Prometheus by default
+DRAIN_INTERVALS = [1.0, 15.0]
+# a steady push load of new series, for long enough to span a few scrape intervals
+PUSH_INTERVAL = 0.1
+LOAD_SECONDS = 45
+# time given to the Go runtime to settle after the pushes
+SETTLE_SECONDS = 2
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_port(port: int) -> None:
+    deadline = time.monotonic() + 10
+    while True:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.05)
+
+
+def proc_status_bytes(pid: int, field: str) -> int:
+    with open(f"/proc/{pid}/status") as status:
+        for line in status:
+            if line.startswith(f"{field}:"):
+                return int(line.split()[1]) * 1024
+    raise RuntimeError(f"no {field} for {pid}")
+
+
+def rss_bytes(pid: int) -> int:
+    return proc_status_bytes(pid, "VmRSS")
+
+
+def drain(port: int) -> None:
+    with urllib.request.urlopen(f"http://127.0.0.1:{port}/metrics", timeout=30) as response:
+        assert response.status == 200, response.status
+        response.read()
+
+
+def push(port: int, start: int, count: int) -> None:
+    body = "".join(
+        f'edge_device_temperature{{device="{n}",site="site-{n % 100}"}} 21.5\n'
+        for n in range(start, start + count)
+    )
+    request = urllib.request.Request(
+        f"http://127.0.0.1:{port}/metrics",
+        data=body.encode("utf-8"),
+        method="POST",
+        headers={"Content-Type": "text/plain; version=0.0.4"},
+    )
+    with urllib.request.urlopen(request, timeout=30) as response:
+        assert response.status == 200, response.status
+
+
+class Hub(NamedTuple):
+    pid: int
+    port: int
+
+
+def run_image(image: str, args: List[str]) -> Iterator[int]:
+    command = ["docker", "run", "--detach", "--rm", "--network=host"]
+    command += ["--entrypoint=prometheus-edge-hub", image] + args
+    run = subprocess.run(command, check=True, capture_output=True, text=True)
+    container = run.stdout.strip()
+    try:
+        inspect = ["docker", "inspect", "--format={{.State.Pid}}", container]
+        yield int(subprocess.run(inspect, check=True, capture_output=True, text=True).stdout)
+    finally:
+        subprocess.run(["docker", "stop", container], check=True, capture_output=True)
+
+
+def run_binary(binary: str, args: List[str]) -> Iterator[int]:
+    process = subprocess.Popen([binary] + args)
+    try:
+        yield process.pid
+    finally:
+        process.terminate()
+        process.wait()
+
+
+@pytest.fixture
+def hub() -> Iterator[Hub]:
+    port = free_port()
+    args = [f"-port={port}", f"-grpc-port={free_port()}"]
+    image = os.environ.get("PROMETHEUS_EDGE_HUB_IMAGE")
+    binary = os.environ.get("PROMETHEUS_EDGE_HUB_BINARY") or shutil.which("prometheus-edge-hub")
+    if image:
+        pids = run_image(image, args)
+    elif binary:
+        pids = run_binary(binary, args)
+    else:
+        pytest.skip("neither a prometheus-edge-hub image nor binary is given")
+    for pid in pids:
+        wait_for_port(port)
+        yield Hub(pid, port)
+
+
+@pytest.mark.parametrize("series", SERIES)
+def test_hub_memory_per_series(benchmark, hub, series):
+    time.sleep(SETTLE_SECONDS)
+    base = rss_bytes(hub.pid)
+
+    def push_all():
+        for start in range(0, series, PUSH_SERIES):
+            push(hub.port, start, min(PUSH_SERIES, series - start))
+
+    benchmark.pedantic(push_all, rounds=1, iterations=1)
+    time.sleep(SETTLE_SECONDS)
+    per_series = (rss_bytes(hub.pid) - base) / series
+
+    benchmark.extra_info.update(base_bytes=base, bytes_per_series=per_series)
+    assert base <= HUB_BASE_MEMORY_BYTES
+    assert per_series <= SERIES_MEMORY_BYTES
+
+
+@pytest.mark.parametrize("drain_interval", DRAIN_INTERVALS)
+def test_hub_memory_high_water_mark(benchmark, hub, drain_interval):
+    time.sleep(SETTLE_SECONDS)
+    base = proc_status_bytes(hub.pid, "VmHWM")
+
+    def load():
+        start = time.monotonic()
+        next_drain = start + drain_interval
+        pushed = 0
+        while time.monotonic() - start < LOAD_SECONDS:
+            push(hub.port, pushed, PUSH_SERIES)
+            pushed += PUSH_SERIES
+            if time.monotonic() >= next_drain:
+                drain(hub.port)
+                next_drain += drain_interval
+            time.sleep(PUSH_INTERVAL)
+
+    benchmark.pedantic(load, rounds=1, iterations=1)
+    high_water_mark = proc_status_bytes(hub.pid, "VmHWM")
+
+    benchmark.extra_info.update(base_bytes=base, high_water_mark_bytes=high_water_mark)
+    series_held = PUSH_SERIES * drain_interval / PUSH_INTERVAL
+    assert high_water_mark <= HUB_BASE_MEMORY_BYTES + series_held * SERIES_MEMORY_BYTES
@@ -0,0 +1,99 @@
+# Copyright 2022 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""Per-hook import time profiles of the charm.
+
+Each hook runs in a fresh interpreter under `python -X importtime`, as Juju runs them. Only the
+modules imported by the charm and its hook handlers are accounted for, not those of the harness.
+"""
+
+import os
+import subprocess
+import sys
+import textwrap
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+import pytest
+
+ROOT = Path(__file__).parents[2]
+MARKER = "-- charm --"
+TOP_MODULES = 10
+
+HOOKS = {
+    "install": "harness.charm.on.install.emit()",
+    "config_changed": "harness.update_config({})",
+    "metrics_endpoint_relation_joined": textwrap.dedent("""
+        relation_id = harness.add_relation("metrics-endpoint", "prometheus-k8s")
+        harness.add_relation_unit(relation_id, "prometheus-k8s/0")
+        """),
+    "update_status": "harness.charm.on.update_status.emit()",
+}
+
+SCRIPT = """
+import sys
+from unittest.mock import PropertyMock, patch
+
+from ops.testing import Harness
+
+sys.stderr.write("{marker}\\n")
+sys.stderr.flush()
+from charm import KubernetesServicePatch, PrometheusEdgeHubCharm
+
+# outside of Kubernetes, there is no service account to read the namespace from
+patch.object(KubernetesServicePatch, "_namespace", PropertyMock(return_value="edge")).start()
+harness = Harness(PrometheusEdgeHubCharm)
+harness.add_relation("replicas", "prometheus-edge-hub")
+# leader-elected runs as a hook of its own
+harness.set_leader(True)
+harness.begin()
+{hook}
+"""
+
+
+def profile_hook(hook: str) -> List[Tuple[str, int]]:
+    """Runs a hook in a fresh interpreter and returns the self import time of each module."""
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([str(ROOT / "lib"), str(ROOT / "src")]))
+    script = SCRIPT.format(marker=MARKER, hook=HOOKS[hook])
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", script],
+        cwd=ROOT,
+        env=env,
+        stderr=subprocess.PIPE,
+        check=True,
+        text=True,
+    )
+    _, _, profile = result.stderr.partition(MARKER)
+    modules = []
+    for line in profile.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, _, name = line.split(":", 1)[1].split("|")
+        modules.append((name.strip(), int(self_us)))
+    return modules
+
+
+def top_level_packages(modules: List[Tuple[str, int]]) -> Dict[str, int]:
+    packages: Dict[str, int] = {}
+    for name, self_us in modules:
+        package = name.split(".")[0]
+        packages[package] = packages.get(package, 0) + self_us
+    return packages
+
+
+@pytest.mark.parametrize("hook", HOOKS)
+def test_import_time(benchmark, hook):
+    modules = benchmark.pedantic(profile_hook, args=(hook,), rounds=1, iterations=1)
+
+    packages = top_level_packages(modules)
+    benchmark.extra_info["import_time_us"] = sum(packages.values())
+    benchmark.extra_info["packages"] = dict(
+        sorted(packages.items(), key=lambda item: item[1], reverse=True)[:TOP_MODULES]
+    )
+
+
+@pytest.mark.parametrize("hook", ["metrics_endpoint_relation_joined", "update_status"])
+def test_hooks_not_patching_the_service_do_not_import_lightkube(hook):
+    packages = top_level_packages(profile_hook(hook))
+
+    assert "lightkube" not in packages
@@ -0,0 +1,263 @@
+# Copyright 2022 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""Push throughput and latency of the ingest sidecar, against pushing directly to the hub.
+
+A local load generator opens a new connection for every push, as edge devices do. The hub is
+modelled by a server which sets up one connection at a time, at a fixed cost, like a hub whose
+accept queue is the bottleneck under bursts. The hub and the sidecar run in their own processes,
+so that they do not share the event loop of the load generator. Throughput and p99 latency are
+recorded in the `extra_info` of each benchmark.
+
+The cost of aggregating a push is benchmarked for growing numbers of aggregation rules, the
+cost of encoding and compressing a remote-write request for growing numbers of samples, and the
+cost of admitting a push into a full store, evicting series, for growing cache limits. The
+memory of a held sample is measured from the RSS of a process holding growing numbers of them.
+"""
+
+import asyncio
+import json
+import multiprocessing
+import os
+import socket
+import subprocess
+import sys
+import time
+from typing import Iterator, List
+
+import pytest
+
+from charm import HELD_SAMPLE_MEMORY_BYTES
+from ingest.admission import Admission, compile_classes
+from ingest.aggregation import Aggregator, compile_rules
+from ingest.exposition import parse
+from ingest.metrics import Registry
+from ingest.protocol import Response, read_request
+from ingest.remote_write import encode_write_request
+from ingest.snappy import compress
+
+CLIENTS = [16, 128]
+RULES = [1, 10, 100, 1000]
+SAMPLES = [100, 1000, 10000]
+LIMITS = [1000, 10000, 100000]
+HELD_SAMPLES = [100000, 1000000]
+PUSHES = 1000
+CONNECTION_COST = 0.001
+BODY = b"".join(b'edge_device_temperature{device="%d"} 21.5\n' % i for i in range(20))
+REQUEST = (
+    b"POST /metrics HTTP/1.1\r\nHost: hub\r\nConnection: close\r\n"
+    b"Content-Length: %d\r\n\r\n%s" % (len(BODY), BODY)
+)
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_port(port: int) -> None:
+    deadline = time.monotonic() + 10
+    while True:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.05)
+
+
+async def serve_hub(port: int) -> None:
+    setup = asyncio.Lock()
+
+    async def serve(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        async with setup:
+            time.sleep(CONNECTION_COST)
+        try:
+            while True:
+                request = await read_request(reader, 1 << 20)
+                if request is None:
+                    return
+                writer.write(Response(200).serialize(request.keep_alive))
+                await writer.drain()
+                if not request.keep_alive:
+                    return
+        except ConnectionError:
+            return
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(serve, "127.0.0.1", port, backlog=128)
+    await server.serve_forever()
+
+
+def run_hub(port: int) -> None:
+    asyncio.run(serve_hub(port))
+
+
+@pytest.fixture(scope="module")
+def hub_port() -> Iterator[int]:
+    port = free_port()
+    process = multiprocessing.Process(target=run_hub, args=(port,), daemon=True)
+    process.start()
+    wait_for_port(port)
+    yield port
+    process.terminate()
+    process.join()
+
+
+@pytest.fixture(scope="module")
+def ingest_port(hub_port) -> Iterator[int]:
+    port = free_port()
+    config = {"listen_host": "127.0.0.1", "listen_port": port, "hub_port": hub_port}
+    process = subprocess.Popen(
+        [sys.executable, "-m", "ingest", "--log-level=WARNING"],
+        env=dict(os.environ, INGEST_CONFIG=json.dumps(config)),
+    )
+    wait_for_port(port)
+    yield port
+    process.terminate()
+    process.wait()
+
+
+async def push(port: int) -> float:
+    start = time.perf_counter()
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    writer.write(REQUEST)
+    await writer.drain()
+    status = await reader.readline()
+    await reader.read()
+    writer.close()
+    assert status.split()[1] == b"200", status
+    return time.perf_counter() - start
+
+
+async def load(port: int, clients: int) -> List[float]:
+    """Push `PUSHES` times from `clients` concurrent clients, and return the latencies."""
+    latencies: List[float] = []
+
+    async def client(count: int) -> None:
+        for _ in range(count):
+            latencies.append(await push(port))
+
+    await asyncio.gather(*(client(PUSHES // clients) for _ in range(clients)))
+    return latencies
+
+
+def run(benchmark, port: int, clients: int) -> None:
+    results: List[List[float]] = []
+    benchmark.pedantic(
+        lambda: results.append(asyncio.run(load(port, clients))), rounds=3, iterations=1
+    )
+    latencies = sorted(latency for result in results for latency in result)
+    benchmark.extra_info["clients"] = clients
+    # no stats are collected with --benchmark-disable
+    if benchmark.stats is not None:
+        benchmark.extra_info["pushes_per_second"] = len(latencies) / benchmark.stats.stats.total
+    benchmark.extra_info["p99_seconds"] = latencies[int(len(latencies) * 0.99)]
+
+
+@pytest.mark.parametrize("clients", CLIENTS)
+def test_push_direct(benchmark, hub_port, clients):
+    run(benchmark, hub_port, clients)
+
+
+@pytest.mark.parametrize("clients", CLIENTS)
+def test_push_via_ingest(benchmark, ingest_port, clients):
+    run(benchmark, ingest_port, clients)
+
+
+@pytest.mark.parametrize("size", RULES)
+def test_aggregate_push(benchmark, size):
+    rules = [{"match": f"device_metric_{index}", "by": ["site"]} for index in range(size)]
+    aggregator = Aggregator(compile_rules(rules), None, Registry())
+    body = "".join(
+        f'{name}{{site="a",device="{device}"}} 1\n'
+        for name in ("device_metric_0", "hub_other")
+        for device in range(50)
+    )
+    benchmark.extra_info["size"] = size
+
+    kept = benchmark(lambda: aggregator.absorb(parse(body)))
+
+    assert [family.name for family in kept] == ["hub_other"]
+
+
+@pytest.mark.parametrize("size", SAMPLES)
+def test_encode_remote_write(benchmark, size):
+    samples = [
+        (
+            (("__name__", "edge_device_temperature"), ("device", str(index)), ("site", "a")),
+            21.5,
+            1600000000000 + index,
+            0.0,
+        )
+        for index in range(size)
+    ]
+    benchmark.extra_info["size"] = size
+
+    body = benchmark(lambda: compress(encode_write_request(samples)))
+
+    benchmark.extra_info["compression_ratio"] = len(encode_write_request(samples)) / len(body)
+
+
+@pytest.mark.parametrize("size", LIMITS)
+def test_admit_push_into_full_store(benchmark, size):
+    classes = [{"name": "critical", "match": {"severity": "critical"}}]
+    admission = Admission(compile_classes(classes), size, None, Registry())
+    admission.push(parse("".join(f'edge_device_bulk{{device="{i}"}} 1\n' for i in range(size))))
+    pushes = iter(range(10**9))
+    benchmark.extra_info["size"] = size
+
+    def push():
+        # new critical series every time, each evicting a bulk series
+        push = next(pushes)
+        body = "".join(
+            f'edge_device_up{{severity="critical",push="{push}",device="{i}"}} 1\n'
+            for i in range(20)
+        )
+        return admission.push(parse(body))
+
+    response = benchmark(push)
+
+    assert response.status == 200
+
+
+def rss_bytes() -> int:
+    with open("/proc/self/status") as status:
+        for line in status:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) * 1024
+    raise RuntimeError("no VmRSS")
+
+
+def hold_samples(size: int, results: "multiprocessing.Queue") -> None:
+    classes = [{"name": "critical", "match": {"severity": "critical"}}]
+    admission = Admission(compile_classes(classes), size, None, Registry())
+    before = rss_bytes()
+    for start in range(0, size, 10000):
+        body = "".join(
+            f'edge_device_temperature{{device="{i}",site="site-{i % 100}"}} 21.5\n'
+            for i in range(start, min(size, start + 10000))
+        )
+        admission.push(parse(body))
+    results.put((rss_bytes() - before) / size)
+
+
+@pytest.mark.parametrize("size", HELD_SAMPLES)
+def test_admission_memory_per_sample(benchmark, size):
+    results: "multiprocessing.Queue" = multiprocessing.Queue()
+
+    def hold():
+        # in its own process, so that the RSS is not that of the test runner
+        process = multiprocessing.Process(target=hold_samples, args=(size, results))
+        process.start()
+        per_sample = results.get()
+        process.join()
+        return per_sample
+
+    per_sample = benchmark.pedantic(hold, rounds=1, iterations=1)
+
+    benchmark.extra_info.update(size=size, bytes_per_sample=per_sample)
+    assert per_sample <= HELD_SAMPLE_MEMORY_BYTES
@@ -0,0 +1,212 @@
+# Copyright 2022 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+"""Fakes of the hub, of its pool and of a remote-write receiver, and client helpers, for the
+ingest tests.
+
+The receiver decodes snappy and protobuf on its own, rather than with the sidecar's encoders.
+"""
+
+import asyncio
+import struct
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from ingest.protocol import ProtocolError, Request, Response, read_request
+
+PUSH = b'hub_test_total{device="a"} 1\n'
+
+
+class UnavailablePool:
+    """An upstream pool whose hub cannot be reached."""
+
+    async def request(self, request: Request) -> Response:
+        await asyncio.sleep(0)
+        raise ProtocolError("hub unavailable", 502)
+
+
+class FakeHub:
+    """Stores pushed bodies and answers scrapes with them, like the hub draining its cache."""
+
+    def __init__(self, delay: float = 0, reject: Optional[bytes] = None):
+        self.delay = delay
+        # pushes holding these bytes are answered with a 400, as the hub does for invalid ones
+        self.reject = reject
+        self.pushes: List[bytes] = []
+        self.connections = 0
+        self.requests = 0
+        self.last_request: Optional[Request] = None
+        self.port = 0
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    async def start(self) -> int:
+        self._server = await asyncio.start_server(self._serve, "127.0.0.1", 0)
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self.port
+
+    async def stop(self) -> None:
+        assert self._server is not None
+        self._server.close()
+        await self._server.wait_closed()
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        self.connections += 1
+        try:
+            while True:
+                request = await read_request(reader, 1 << 24)
+                if request is None:
+                    return
+                self.requests += 1
+                self.last_request = request
+                if self.delay:
+                    await asyncio.sleep(self.delay)
+                if request.method == "POST" and self.reject and self.reject in request.body:
+                    response = Response(400)
+                elif request.method == "POST" and request.path == "/metrics":
+                    self.pushes.append(request.body)
+                    response = Response(200)
+                elif request.method == "GET" and request.path == "/metrics":
+                    body, self.pushes = b"".join(self.pushes), []
+                    response = Response(200, [("Content-Type", "text/plain")], body)
+                else:
+                    response = Response(404)
+                writer.write(response.serialize())
+                await writer.drain()
+        except ConnectionError:
+            return
+        finally:
+            writer.close()
+
+
+def push_request(body: bytes = PUSH, connection: str = "keep-alive") -> bytes:
+    head = "POST /metrics HTTP/1.1\r\nHost: hub\r\nConnection: {}\r\nContent-Length: {}\r\n\r\n"
+    return head.format(connection, len(body)).encode() + body
+
+
+async def read_responses(reader: asyncio.StreamReader, count: int) -> list:
+    responses = []
+    for _ in range(count):
+        status_line = await reader.readline()
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line == b"\r\n":
+                break
+            name, _, value = line.decode().partition(":")
+            headers[name.lower()] = value.strip()
+        body = await reader.readexactly(int(headers["content-length"]))
+        responses.append((int(status_line.split()[1]), headers, body))
+    return responses
+
+
+def snappy_decompress(data: bytes) -> bytes:
+    length, position = read_varint(data, 0)
+    out = bytearray()
+    while position < len(data):
+        tag = data[position]
+        position += 1
+        kind = tag & 0x03
+        if kind == 0:
+            size = tag >> 2
+            if size >= 60:
+                count = size - 59
+                size = int.from_bytes(data[position : position + count], "little")  # noqa: E203
+                position += count
+            end = position + size + 1
+            out += data[position:end]
+            position = end
+            continue
+        if kind == 1:
+            size = ((tag >> 2) & 0x07) + 4
+            offset = ((tag >> 5) << 8) | data[position]
+            position += 1
+        else:
+            count = 2 if kind == 2 else 4
+            size = (tag >> 2) + 1
+            offset = int.from_bytes(data[position : position + count], "little")  # noqa: E203
+            position += count
+        assert 0 < offset <= len(out), "copy before the start of the output"
+        for _ in range(size):
+            out.append(out[-offset])
+    assert len(out) == length, "wrong uncompressed length"
+    return bytes(out)
+
+
+def read_varint(data: bytes, position: int) -> Tuple[int, int]:
+    value = shift = 0
+    while True:
+        byte = data[position]
+        position += 1
+        value |= (byte & 0x7F) << shift
+        shift += 7
+        if byte < 0x80:
+            return value, position
+
+
+def protobuf_fields(data: bytes) -> Iterator[Tuple[int, object]]:
+    """The field numbers and values of a message, for the wire types remote-write uses."""
+    position = 0
+    while position < len(data):
+        key, position = read_varint(data, position)
+        number, wire_type = key >> 3, key & 0x07
+        if wire_type == 0:
+            value, position = read_varint(data, position)
+        elif wire_type == 1:
+            (value,) = struct.unpack_from("<d", data, position)
+            position += 8
+        else:
+            assert wire_type == 2, "unexpected wire type {}".format(wire_type)
+            size, position = read_varint(data, position)
+            value = data[position : position + size]  # noqa: E203
+            position += size
+        yield number, value
+
+
+def decode_write_request(data: bytes) -> List[Tuple[Dict[str, str], List[Tuple[float, int]]]]:
+    """The series of a remote-write request, as labels and (value, timestamp) samples."""
+    series = []
+    for _, timeseries in protobuf_fields(data):
+        labels, samples = {}, []
+        for number, value in protobuf_fields(timeseries):
+            fields = dict(protobuf_fields(value))
+            if number == 1:
+                labels[fields[1].decode()] = fields[2].decode()
+            else:
+                samples.append((fields.get(1, 0.0), fields.get(2, 0)))
+        series.append((labels, samples))
+    return series
+
+
+class FakeReceiver:
+    """Receives remote-write requests, answering them with the statuses given, then with 204."""
+
+    def __init__(self, statuses: Optional[List[int]] = None):
+        self.statuses = list(statuses or [])
+        self.series: List[Tuple[Dict[str, str], List[Tuple[float, int]]]] = []
+        self.requests: List[Request] = []
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    async def start(self) -> str:
+        self._server = await asyncio.start_server(self._serve, "127.0.0.1", 0)
+        return "http://127.0.0.1:{}/api/v1/write".format(self._server.sockets[0].getsockname()[1])
+
+    async def stop(self) -> None:
+        assert self._server is not None
+        self._server.close()
+        await self._server.wait_closed()
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            while True:
+                request = await read_request(reader, 1 << 24)
+                if request is None:
+                    return
+                self.requests.append(request)
+                status = self.statuses.pop(0) if self.statuses else 204
+                if status == 204:
+                    self.series += decode_write_request(snappy_decompress(request.body))
+                writer.write(Response(status).serialize())
+                await writer.drain()
+        except ConnectionError:
+            return
+        finally:
+            writer.close()
@@ -0,0 +1,68 @@
+# Copyright 2022 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+import os
+import tempfile
+import unittest
+from pathlib import Path
+from unittest.mock import patch
+
+import yaml
+from charms.prometheus_k8s.v0.prometheus_scrape import AlertRules
+
+RULE = """
+alert: HubDown
+expr: up < 1
+"""
+
+
+class TestAlertRules(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.rules_dir = Path(directory.name)
+        (self.rules_dir / "nested").mkdir()
+        (self.rules_dir / "hub.rule").write_text(RULE)
+        (self.rules_dir / "nested" / "other.rules").write_text(RULE.replace("Hub", "Other"))
+        (self.rules_dir / "README.md").write_text("not a rule")
+
+    def load(self, file_index=None, recursive=True) -> AlertRules:
+        alert_rules = AlertRules(file_index=file_index)
+        alert_rules.add_path(str(self.rules_dir), recursive=recursive)
+        return alert_rules
+
+    def test_given_nested_rule_files_when_add_path_then_only_rule_files_are_read(self):
+        self.assertEqual(len(self.load().alert_groups), 2)
+        self.assertEqual(len(self.load(recursive=False).alert_groups), 1)
+
+    def test_given_unchanged_files_when_add_path_with_index_then_files_are_not_parsed(self):
+        first = self.load()
+
+        with patch.object(yaml, "safe_load") as patched_safe_load:
+            second = self.load(file_index=first.file_index)
+
+        patched_safe_load.assert_not_called()
+        self.assertEqual(second.as_dict(), first.as_dict())
+        self.assertEqual(second.file_index, first.file_index)
+
+    def test_given_touched_file_with_same_content_when_add_path_then_file_is_not_parsed(self):
+        first = self.load()
+        rule_file = self.rules_dir / "hub.rule"
+        os.utime(rule_file, ns=(0, 0))
+
+        with patch.object(yaml, "safe_load") as patched_safe_load:
+            second = self.load(file_index=first.file_index)
+
+        patched_safe_load.assert_not_called()
+        self.assertEqual(second.file_index[str(rule_file)]["mtime"], 0)
+
+    def test_given_changed_file_when_add_path_then_only_that_file_is_parsed(self):
+        first = self.load()
+        (self.rules_dir / "hub.rule").write_text(RULE.replace("< 1", "== 0"))
+
+        with patch.object(yaml, "safe_load", wraps=yaml.safe_load) as patched_safe_load:
+            second = self.load(file_index=first.file_index)
+
+        patched_safe_load.assert_called_once()
+        expressions = sorted(g["rules"][0]["expr"] for g in second.as_dict()["groups"])
+        self.assertEqual(expressions, ["up < 1", "up == 0"])
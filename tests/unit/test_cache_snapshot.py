@@ -0,0 +1,123 @@
+# Copyright 2022 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+import gzip
+import io
+import unittest
+import urllib.error
+from unittest.mock import MagicMock, patch
+
+from ops.testing import Harness
+
+from cache_snapshot import CacheSnapshot
+from charm import PrometheusEdgeHubCharm
+
+SNAPSHOT_PATH = "/var/lib/prometheus-edge-hub/cache-snapshot.gz"
+FIRST_FAMILY = (
+    b"# HELP requests_total Requests.\n"
+    b"# TYPE requests_total counter\n"
+    b'requests_total{code="200"} 3 1650000000000\n'
+    b'requests_total{code="500"} 1 1650000000000\n'
+)
+SECOND_FAMILY = b"# TYPE temperature gauge\ntemperature 21.5 1650000000000\n"
+
+
+def response(body: bytes) -> MagicMock:
+    """Mocks the context manager returned by urlopen."""
+    mocked_response = MagicMock()
+    mocked_response.__enter__.return_value = io.BytesIO(body)
+    return mocked_response
+
+
+class TestCacheSnapshot(unittest.TestCase):
+    @patch("charm.KubernetesServicePatch", lambda x, y, **kwargs: None)
+    def setUp(self):
+        self.harness = Harness(PrometheusEdgeHubCharm)
+        self.addCleanup(self.harness.cleanup)
+        self.harness.begin()
+        self.container = self.harness.model.unit.get_container("prometheus-edge-hub")
+        self.harness.set_can_connect(self.container, True)
+        self.snapshot = CacheSnapshot(self.container, SNAPSHOT_PATH, "http://localhost:9091")
+
+    def snapshot_content(self) -> bytes:
+        return gzip.decompress(self.container.pull(SNAPSHOT_PATH, encoding=None).read())
+
+    @patch("urllib.request.urlopen")
+    def test_given_cache_content_when_save_then_cache_is_drained_into_compressed_snapshot(
+        self, patched_urlopen
+    ):
+        patched_urlopen.return_value = response(FIRST_FAMILY)
+
+        self.assertTrue(self.snapshot.save())
+
+        patched_urlopen.assert_called_once_with("http://localhost:9091/metrics", timeout=30)
+        self.assertEqual(self.snapshot_content(), FIRST_FAMILY)
+
+    @patch("urllib.request.urlopen")
+    def test_given_snapshot_not_replayed_when_save_then_cache_is_appended_to_snapshot(
+        self, patched_urlopen
+    ):
+        patched_urlopen.side_effect = [response(FIRST_FAMILY), response(SECOND_FAMILY)]
+
+        self.snapshot.save()
+        self.snapshot.save()
+
+        self.assertEqual(self.snapshot_content(), FIRST_FAMILY + SECOND_FAMILY)
+
+    @patch("urllib.request.urlopen")
+    def test_given_hub_unreachable_when_save_then_no_snapshot_is_written(self, patched_urlopen):
+        patched_urlopen.side_effect = urllib.error.URLError("connection refused")
+
+        self.assertFalse(self.snapshot.save())
+
+        self.assertFalse(self.snapshot.exists)
+
+    @patch("cache_snapshot.CHUNK_BYTES", 1)
+    @patch("urllib.request.urlopen")
+    def test_given_snapshot_when_restore_then_whole_families_are_pushed_and_snapshot_removed(
+        self, patched_urlopen
+    ):
+        self.container.push(
+            SNAPSHOT_PATH, gzip.compress(FIRST_FAMILY + SECOND_FAMILY), make_dirs=True
+        )
+        patched_urlopen.return_value = response(b"")
+
+        self.assertTrue(self.snapshot.restore())
+
+        requests = [call.args[0] for call in patched_urlopen.call_args_list]
+        self.assertEqual([request.data for request in requests], [FIRST_FAMILY, SECOND_FAMILY])
+        self.assertEqual({request.method for request in requests}, {"POST"})
+        self.assertFalse(self.snapshot.exists)
+
+    @patch("urllib.request.urlopen")
+    def test_given_hub_fails_when_restore_then_snapshot_is_kept(self, patched_urlopen):
+        self.container.push(SNAPSHOT_PATH, gzip.compress(FIRST_FAMILY), make_dirs=True)
+        patched_urlopen.side_effect = urllib.error.URLError("connection refused")
+
+        self.assertFalse(self.snapshot.restore())
+
+        self.assertTrue(self.snapshot.exists)
+
+    @patch("cache_snapshot.CHUNK_BYTES", 1)
+    @patch("urllib.request.urlopen")
+    def test_given_replay_cut_short_when_restore_again_then_it_resumes_after_the_pushed_chunks(
+        self, patched_urlopen
+    ):
+        self.container.push(
+            SNAPSHOT_PATH, gzip.compress(FIRST_FAMILY + SECOND_FAMILY), make_dirs=True
+        )
+        patched_urlopen.side_effect = [
+            response(b""),
+            urllib.error.URLError("connection refused"),
+        ]
+        self.assertFalse(self.snapshot.restore())
+
+        patched_urlopen.side_effect = None
+        patched_urlopen.return_value = response(b"")
+        self.assertTrue(self.snapshot.restore())
+
+        requests = [call.args[0] for call in patched_urlopen.call_args_list]
+        self.assertEqual(
+            [request.data for request in requests], [FIRST_FAMILY, SECOND_FAMILY, SECOND_FAMILY]
+        )
+        self.assertFalse(self.container.exists(f"{SNAPSHOT_PATH}.offset"))
@@ -1,10 +1,13 @@
 # Copyright 2021 Canonical Ltd.
 # See LICENSE file for licensing details.
 
+import json
 import typing
 import unittest
-from unittest.mock import patch
+from unittest.mock import PropertyMock, patch
 
+from ops.model import ActiveStatus, BlockedStatus, Container, WaitingStatus
+from ops.pebble import CheckInfo, CheckLevel, CheckStatus
 from ops.testing import Harness
 
 import charm
@@ -12,13 +15,30 @@ from charm import PrometheusEdgeHubCharm
 
 MINIMAL_CONFIG: typing.Mapping = {}
 GRPC_PORT = charm.PROMETHEUS_EDGE_HUB_GRPC_PORT
+READY_CHECKS = {
+    name: CheckInfo(name, level=CheckLevel.READY, status=CheckStatus.UP)
+    for name in ("prometheus-edge-hub-http", "prometheus-edge-hub-grpc")
+}
+SERVICE_HEALTH_CONFIG: typing.Mapping = {
+    "backoff-delay": "1s",
+    "backoff-limit": "10s",
+    "on-check-failure": {
+        "prometheus-edge-hub-http": "restart",
+        "prometheus-edge-hub-grpc": "restart",
+    },
+}
 
 
 class TestCharm(unittest.TestCase):
-    @patch("charm.KubernetesServicePatch", lambda x, y: None)
+    @patch("charm.KubernetesServicePatch", lambda x, y, **kwargs: None)
     def setUp(self):
         self.harness = Harness(PrometheusEdgeHubCharm)
         self.addCleanup(self.harness.cleanup)
+        # no hub listens in unit tests, so restarts do not wait for it
+        hub_ready_timeout = patch("charm.HUB_READY_TIMEOUT", 0)
+        hub_ready_timeout.start()
+        self.addCleanup(hub_ready_timeout.stop)
+        self.peer_relation_id = self.harness.add_relation("replicas", "prometheus-edge-hub")
         self.harness.begin()
         self._container = self.harness.model.unit.get_container("prometheus-edge-hub")
 
@@ -37,6 +57,7 @@ class TestCharm(unittest.TestCase):
                     "override": "replace",
                     "summary": "prometheus-edge-hub",
                     "startup": "enabled",
+                    **SERVICE_HEALTH_CONFIG,
                     "command": f"prometheus-edge-hub -grpc-port={GRPC_PORT}",
                 },
             },
@@ -57,6 +78,7 @@ class TestCharm(unittest.TestCase):
                     "override": "replace",
                     "summary": "prometheus-edge-hub",
                     "startup": "enabled",
+                    **SERVICE_HEALTH_CONFIG,
                     "command": f"prometheus-edge-hub "
                     f"-grpc-port={GRPC_PORT} "
                     f"-limit={config['metrics_count_limit']}",
@@ -79,6 +101,7 @@ class TestCharm(unittest.TestCase):
                     "override": "replace",
                     "summary": "prometheus-edge-hub",
                     "startup": "enabled",
+                    **SERVICE_HEALTH_CONFIG,
                     "command": f"prometheus-edge-hub -grpc-port={GRPC_PORT}",
                 },
             },
@@ -99,6 +122,7 @@ class TestCharm(unittest.TestCase):
                     "override": "replace",
                     "summary": "prometheus-edge-hub",
                     "startup": "enabled",
+                    **SERVICE_HEALTH_CONFIG,
                     "command": f"prometheus-edge-hub -grpc-port={GRPC_PORT}",
                 },
             },
@@ -120,6 +144,7 @@ class TestCharm(unittest.TestCase):
                     "override": "replace",
                     "summary": "prometheus-edge-hub",
                     "startup": "enabled",
+                    **SERVICE_HEALTH_CONFIG,
                     "command": f"prometheus-edge-hub -grpc-port={GRPC_PORT}",
                 },
             },
@@ -130,6 +155,7 @@ class TestCharm(unittest.TestCase):
                     "override": "replace",
                     "summary": "prometheus-edge-hub",
                     "startup": "enabled",
+                    **SERVICE_HEALTH_CONFIG,
                     "command": f"prometheus-edge-hub -grpc-port={GRPC_PORT}"
                     f" -limit={config['metrics_count_limit']}",
                 },
@@ -143,6 +169,8 @@ class TestCharm(unittest.TestCase):
         self.assertEqual(initial_plan, expected_initial_plan)
         self.assertEqual(updated_plan, expected_final_plan)
 
+    @patch("charm.PrometheusEdgeHubCharm._hub_ports_open", PropertyMock(return_value=True))
+    @patch("ops.model.Container.get_checks", lambda *args, **kwargs: READY_CHECKS)
     def test_given_prometheus_edge_hub_service_running_when_metrics_endpoint_relation_joined_event_emitted_then_active_key_in_relation_data_is_set_to_true(  # noqa: E501
         self,
     ):
@@ -168,3 +196,720 @@ class TestCharm(unittest.TestCase):
             self.harness.get_relation_data(relation_id, "prometheus-edge-hub/0"),
             {"active": "False"},
         )
+
+    def test_given_default_scrape_mode_when_metrics_endpoint_relation_created_then_service_target_is_published(  # noqa: E501
+        self,
+    ):
+        self.harness.set_leader(True)
+        relation_id = self.harness.add_relation("metrics-endpoint", "prometheus-k8s")
+        self.harness.add_relation_unit(relation_id, "prometheus-k8s/0")
+
+        scrape_jobs = json.loads(
+            self.harness.get_relation_data(relation_id, "prometheus-edge-hub")["scrape_jobs"]
+        )
+        self.assertEqual(
+            scrape_jobs[0]["static_configs"], [{"targets": ["prometheus-edge-hub:9091"]}]
+        )
+
+    def test_given_unit_scrape_mode_when_config_changed_then_wildcard_target_is_published(self):
+        self.harness.set_leader(True)
+        relation_id = self.harness.add_relation("metrics-endpoint", "prometheus-k8s")
+        self.harness.add_relation_unit(relation_id, "prometheus-k8s/0")
+
+        self.harness.update_config({"scrape_mode": "unit"})
+
+        scrape_jobs = json.loads(
+            self.harness.get_relation_data(relation_id, "prometheus-edge-hub")["scrape_jobs"]
+        )
+        self.assertEqual(scrape_jobs[0]["static_configs"], [{"targets": ["*:9091"]}])
+
+    def test_given_ingest_frontend_enabled_when_config_changed_then_ingest_metrics_job_is_published(  # noqa: E501
+        self,
+    ):
+        self.harness.set_leader(True)
+        relation_id = self.harness.add_relation("metrics-endpoint", "prometheus-k8s")
+        self.harness.add_relation_unit(relation_id, "prometheus-k8s/0")
+
+        self.harness.update_config({"ingest_frontend": True})
+
+        scrape_jobs = json.loads(
+            self.harness.get_relation_data(relation_id, "prometheus-edge-hub")["scrape_jobs"]
+        )
+        self.assertEqual(len(scrape_jobs), 2)
+        self.assertEqual(scrape_jobs[1]["metrics_path"], "/ingest/metrics")
+        self.assertEqual(scrape_jobs[1]["static_configs"], [{"targets": ["*:9091"]}])
+
+    def test_given_invalid_scrape_mode_when_config_changed_then_status_is_blocked(self):
+        self.harness.set_can_connect(container=self._container, val=True)
+
+        self.harness.update_config({"scrape_mode": "pod"})
+
+        self.assertEqual(self.harness.charm.unit.status, BlockedStatus("Invalid scrape_mode: pod"))
+
+    @patch("socket.getfqdn", lambda: "prometheus-edge-hub-0.prometheus-edge-hub-endpoints")
+    def test_given_leader_when_push_endpoint_relation_joined_then_unit_endpoints_and_hash_ring_are_published(  # noqa: E501
+        self,
+    ):
+        self.harness.set_leader(True)
+        relation_id = self.harness.add_relation("push-endpoint", "pusher")
+        self.harness.add_relation_unit(relation_id, "pusher/0")
+
+        self.assertEqual(
+            json.loads(
+                self.harness.get_relation_data(relation_id, "prometheus-edge-hub/0")[
+                    "push_endpoint"
+                ]
+            ),
+            {
+                "unit": "prometheus-edge-hub/0",
+                "http": "http://prometheus-edge-hub-0.prometheus-edge-hub-endpoints:9091",
+                "grpc": f"prometheus-edge-hub-0.prometheus-edge-hub-endpoints:{GRPC_PORT}",
+            },
+        )
+        self.assertEqual(
+            json.loads(
+                self.harness.get_relation_data(relation_id, "prometheus-edge-hub")["hash_ring"]
+            ),
+            {"algorithm": "md5", "vnodes": 128},
+        )
+
+    def test_given_auto_metrics_count_limit_and_container_memory_limit_when_config_changed_then_limit_is_derived_from_memory_limit(  # noqa: E501
+        self,
+    ):
+        self.harness.set_can_connect(container=self._container, val=True)
+        self._container.push("/sys/fs/cgroup/memory.max", "536870912\n", make_dirs=True)
+
+        self.harness.update_config({"metrics_count_limit_auto": True})
+
+        updated_plan = self.harness.get_container_pebble_plan("prometheus-edge-hub").to_dict()
+        self.assertEqual(
+            updated_plan["services"]["prometheus-edge-hub"]["command"],
+            f"prometheus-edge-hub -grpc-port={GRPC_PORT} -limit=386662",
+        )
+        self.assertEqual(
+            self.harness.charm.unit.status,
+            ActiveStatus("Cache limit: 386662 series (20% memory headroom)"),
+        )
+
+    def test_given_auto_metrics_count_limit_when_config_changed_then_memory_limit_is_pulled_once(  # noqa: E501
+        self,
+    ):
+        self.harness.set_can_connect(container=self._container, val=True)
+        self._container.push("/sys/fs/cgroup/memory.max", "536870912\n", make_dirs=True)
+
+        with patch(
+            "ops.model.Container.pull", autospec=True, side_effect=Container.pull
+        ) as patched_pull:
+            self.harness.update_config({"metrics_count_limit_auto": True})
+
+        paths = [call.args[1] for call in patched_pull.call_args_list]
+        self.assertEqual(paths.count("/sys/fs/cgroup/memory.max"), 1)
+
+    def test_given_auto_metrics_count_limit_and_explicit_limit_when_config_changed_then_explicit_limit_is_used(  # noqa: E501
+        self,
+    ):
+        self.harness.set_can_connect(container=self._container, val=True)
+        self._container.push("/sys/fs/cgroup/memory.max", "536870912\n", make_dirs=True)
+
+        self.harness.update_config({"metrics_count_limit_auto": True, "metrics_count_limit": 25})
+
+        updated_plan = self.harness.get_container_pebble_plan("prometheus-edge-hub").to_dict()
+        self.assertEqual(
+            updated_plan["services"]["prometheus-edge-hub"]["command"],
+            f"prometheus-edge-hub -grpc-port={GRPC_PORT} -limit=25",
+        )
+
+    def test_given_auto_metrics_count_limit_and_no_container_memory_limit_when_config_changed_then_cache_is_not_limited(  # noqa: E501
+        self,
+    ):
+        self.harness.set_can_connect(container=self._container, val=True)
+        self._container.push("/sys/fs/cgroup/memory.max", "max\n", make_dirs=True)
+
+        self.harness.update_config({"metrics_count_limit_auto": True})
+
+        updated_plan = self.harness.get_container_pebble_plan("prometheus-edge-hub").to_dict()
+        self.assertEqual(
+            updated_plan["services"]["prometheus-edge-hub"]["command"],
+            f"prometheus-edge-hub -grpc-port={GRPC_PORT}",
+        )
+        self.assertEqual(
+            self.harness.charm.unit.status,
+            ActiveStatus("Cache limit: unlimited (no memory limit)"),
+        )
+
+    def test_given_auto_metrics_count_limit_and_memory_limit_below_base_when_config_changed_then_status_is_blocked(  # noqa: E501
+        self,
+    ):
+        self.harness.set_can_connect(container=self._container, val=True)
+        self._container.push("/sys/fs/cgroup/memory.max", "16777216\n", make_dirs=True)
+
+        self.harness.update_config({"metrics_count_limit_auto": True})
+
+        self.assertEqual(
+            self.harness.charm.unit.status,
+            BlockedStatus("Container memory limit too low for metrics_count_limit_auto"),
+        )
+
+    def test_given_pebble_layer_when_checks_inspected_then_http_and_grpc_ports_are_probed(self):
+        checks = self.harness.charm._pebble_layer.to_dict()["checks"]
+
+        self.assertEqual(
+            checks["prometheus-edge-hub-http"]["http"], {"url": "http://localhost:9091/debug"}
+        )
+        self.assertEqual(checks["prometheus-edge-hub-grpc"]["tcp"], {"port": GRPC_PORT})
+        self.assertEqual(
+            {check["level"] for check in checks.values()},
+            {"ready"},
+        )
+
+    def test_given_hub_checks_failing_when_metrics_endpoint_relation_joined_event_emitted_then_active_key_in_relation_data_is_set_to_false(  # noqa: E501
+        self,
+    ):
+        failing_checks = {
+            name: CheckInfo(name, level=CheckLevel.READY, status=CheckStatus.DOWN, failures=1)
+            for name in READY_CHECKS
+        }
+        self.harness.set_can_connect(container=self._container, val=True)
+        self.harness.charm.on.prometheus_edge_hub_pebble_ready.emit(self._container)
+        self.harness.set_leader(True)
+
+        with patch("ops.model.Container.get_checks", return_value=failing_checks):
+            relation_id = self.harness.add_relation("metrics-endpoint", "prometheus-k8s")
+            self.harness.add_relation_unit(relation_id, "prometheus-k8s/0")
+
+        self.assertEqual(
+            self.harness.get_relation_data(relation_id, "prometheus-edge-hub/0")["active"],
+            "False",
+        )
+
+    @patch("charm.PrometheusEdgeHubCharm._hub_ports_open", new_callable=PropertyMock)
+    @patch("ops.model.Container.get_checks", lambda *args, **kwargs: READY_CHECKS)
+    def test_given_hub_checks_passing_when_update_status_then_active_key_is_set_to_true(
+        self, patched_hub_ports_open
+    ):
+        patched_hub_ports_open.return_value = False
+        self.harness.set_can_connect(container=self._container, val=True)
+        self.harness.set_leader(True)
+        relation_id = self.harness.add_relation("metrics-endpoint", "prometheus-k8s")
+        self.harness.charm.on.prometheus_edge_hub_pebble_ready.emit(self._container)
+        self.assertEqual(
+            self.harness.get_relation_data(relation_id, "prometheus-edge-hub/0")["active"],
+            "False",
+        )
+
+        patched_hub_ports_open.return_value = True
+        self.harness.charm.on.update_status.emit()
+
+        self.assertEqual(
+            self.harness.get_relation_data(relation_id, "prometheus-edge-hub/0")["active"],
+            "True",
+        )
+
+    @patch("charm.HUB_READY_TIMEOUT", 10)
+    @patch("charm.PrometheusEdgeHubCharm._hub_ports_open", new_callable=PropertyMock)
+    @patch("ops.model.Container.get_checks", lambda *args, **kwargs: READY_CHECKS)
+    def test_given_hub_ports_opening_after_restart_when_pebble_ready_then_restart_latency_is_recorded_and_active_key_is_set_to_true(  # noqa: E501
+        self, patched_hub_ports_open
+    ):
+        # closed on the first two probes, then open
+        patched_hub_ports_open.side_effect = [False, False, True, True]
+        self.harness.set_can_connect(container=self._container, val=True)
+        self.harness.set_leader(True)
+        relation_id = self.harness.add_relation("metrics-endpoint", "prometheus-k8s")
+
+        self.harness.charm.on.prometheus_edge_hub_pebble_ready.emit(self._container)
+
+        self.assertGreaterEqual(self.harness.charm._stored.restart_latency, 0)
+        self.assertEqual(
+            self.harness.get_relation_data(relation_id, "prometheus-edge-hub/0")["active"],
+            "True",
+        )
+
+    @patch("charm.PrometheusEdgeHubCharm._hub_ports_open", PropertyMock(return_value=False))
+    @patch("ops.model.Container.get_checks", lambda *args, **kwargs: READY_CHECKS)
+    def test_given_hub_checks_up_but_ports_closed_when_metrics_endpoint_relation_joined_then_active_key_is_set_to_false(  # noqa: E501
+        self,
+    ):
+        self.harness.set_can_connect(container=self._container, val=True)
+        self.harness.charm.on.prometheus_edge_hub_pebble_ready.emit(self._container)
+        self.harness.set_leader(True)
+
+        relation_id = self.harness.add_relation("metrics-endpoint", "prometheus-k8s")
+        self.harness.add_relation_unit(relation_id, "prometheus-k8s/0")
+
+        self.assertEqual(
+            self.harness.get_relation_data(relation_id, "prometheus-edge-hub/0")["active"],
+            "False",
+        )
+
+    @patch("charm.PrometheusEdgeHubCharm._hub_ports_open", new_callable=PropertyMock)
+    @patch("ops.model.Container.get_checks", lambda *args, **kwargs: READY_CHECKS)
+    def test_given_leader_with_peers_when_config_changed_then_leader_restarts_and_hands_over_to_next_unit(  # noqa: E501
+        self, patched_hub_ports_open
+    ):
+        patched_hub_ports_open.return_value = True
+        self.harness.set_can_connect(container=self._container, val=True)
+        self.harness.set_leader(True)
+        self.harness.add_relation_unit(self.peer_relation_id, "prometheus-edge-hub/1")
+        self.harness.charm.on.prometheus_edge_hub_pebble_ready.emit(self._container)
+        self.harness.update_relation_data(
+            self.peer_relation_id, "prometheus-edge-hub/1", {"restart_requested": "abc"}
+        )
+        self.assertEqual(
+            self.harness.get_relation_data(self.peer_relation_id, "prometheus-edge-hub"),
+            {"restart_granted": "prometheus-edge-hub/1"},
+        )
+
+        self.harness.update_relation_data(
+            self.peer_relation_id, "prometheus-edge-hub/1", {"restart_done": "abc"}
+        )
+        with patch("ops.model.Container.restart") as patched_restart:
+            self.harness.update_config({"metrics_count_limit": 25})
+
+        patched_restart.assert_called_once_with("prometheus-edge-hub")
+        unit_data = self.harness.get_relation_data(self.peer_relation_id, "prometheus-edge-hub/0")
+        self.assertEqual(unit_data["restart_done"], unit_data["restart_requested"])
+        self.assertEqual(
+            self.harness.get_relation_data(self.peer_relation_id, "prometheus-edge-hub"), {}
+        )
+        self.assertEqual(self.harness.charm.unit.status, ActiveStatus())
+
+    @patch("charm.PrometheusEdgeHubCharm._hub_ports_open", new_callable=PropertyMock)
+    @patch("ops.model.Container.get_checks", lambda *args, **kwargs: READY_CHECKS)
+    def test_given_restart_granted_to_another_unit_when_config_changed_then_restart_waits_for_its_turn(  # noqa: E501
+        self, patched_hub_ports_open
+    ):
+        patched_hub_ports_open.return_value = True
+        self.harness.set_can_connect(container=self._container, val=True)
+        self.harness.add_relation_unit(self.peer_relation_id, "prometheus-edge-hub/1")
+        self.harness.update_relation_data(
+            self.peer_relation_id,
+            "prometheus-edge-hub",
+            {"restart_granted": "prometheus-edge-hub/1"},
+        )
+        self.harness.charm.on.prometheus_edge_hub_pebble_ready.emit(self._container)
+
+        with patch("ops.model.Container.restart") as patched_restart:
+            self.harness.update_config({"metrics_count_limit": 25})
+            patched_restart.assert_not_called()
+            self.assertEqual(
+                self.harness.charm.unit.status, WaitingStatus("Waiting for rolling restart")
+            )
+
+            self.harness.update_relation_data(
+                self.peer_relation_id,
+                "prometheus-edge-hub",
+                {"restart_granted": "prometheus-edge-hub/0"},
+            )
+
+        patched_restart.assert_called_once_with("prometheus-edge-hub")
+        unit_data = self.harness.get_relation_data(self.peer_relation_id, "prometheus-edge-hub/0")
+        self.assertEqual(unit_data["restart_done"], unit_data["restart_requested"])
+
+    @patch("charm.PrometheusEdgeHubCharm._hub_ports_open", new_callable=PropertyMock)
+    @patch("ops.model.Container.get_checks", lambda *args, **kwargs: READY_CHECKS)
+    def test_given_hub_not_ready_after_restart_when_update_status_then_restart_is_acknowledged(  # noqa: E501
+        self, patched_hub_ports_open
+    ):
+        self.harness.set_can_connect(container=self._container, val=True)
+        self.harness.set_leader(True)
+        self.harness.add_relation_unit(self.peer_relation_id, "prometheus-edge-hub/1")
+        self.harness.charm.on.prometheus_edge_hub_pebble_ready.emit(self._container)
+        patched_hub_ports_open.return_value = False
+
+        with patch("ops.model.Container.restart") as patched_restart:
+            self.harness.update_config({"metrics_count_limit": 25})
+            unit_data = self.harness.get_relation_data(
+                self.peer_relation_id, "prometheus-edge-hub/0"
+            )
+            self.assertNotIn("restart_done", unit_data)
+
+            patched_hub_ports_open.return_value = True
+            self.harness.charm.on.update_status.emit()
+
+        patched_restart.assert_called_once_with("prometheus-edge-hub")
+        unit_data = self.harness.get_relation_data(self.peer_relation_id, "prometheus-edge-hub/0")
+        self.assertEqual(unit_data["restart_done"], unit_data["restart_requested"])
+
+    @patch("charm.PrometheusEdgeHubCharm._hub_ports_open", new_callable=PropertyMock)
+    @patch("ops.model.Container.get_checks", lambda *args, **kwargs: READY_CHECKS)
+    def test_given_hub_not_ready_after_restart_when_deferred_config_changed_is_reemitted_then_restart_is_acknowledged(  # noqa: E501
+        self, patched_hub_ports_open
+    ):
+        self.harness.set_can_connect(container=self._container, val=True)
+        self.harness.set_leader(True)
+        self.harness.add_relation_unit(self.peer_relation_id, "prometheus-edge-hub/1")
+        self.harness.charm.on.prometheus_edge_hub_pebble_ready.emit(self._container)
+        patched_hub_ports_open.return_value = False
+        with patch("ops.model.Container.restart"):
+            self.harness.update_config({"metrics_count_limit": 25})
+
+        patched_hub_ports_open.return_value = True
+        self.harness.framework.reemit()
+
+        unit_data = self.harness.get_relation_data(self.peer_relation_id, "prometheus-edge-hub/0")
+        self.assertEqual(unit_data["restart_done"], unit_data["restart_requested"])
+        self.assertEqual(self.harness.charm.unit.status, ActiveStatus())
+
+    @patch("charm.PrometheusEdgeHubCharm._hub_ports_open", PropertyMock(return_value=True))
+    @patch("ops.model.Container.get_checks", lambda *args, **kwargs: READY_CHECKS)
+    def test_given_ingest_running_and_restart_granted_to_another_unit_when_ingest_config_changed_then_ingest_waits_for_its_turn(  # noqa: E501
+        self,
+    ):
+        self.harness.set_can_connect(container=self._container, val=True)
+        self.harness.set_can_connect(container="ingest", val=True)
+        self.harness.charm.on.prometheus_edge_hub_pebble_ready.emit(self._container)
+        self.harness.update_config({"ingest_frontend": True})
+        self.harness.add_relation_unit(self.peer_relation_id, "prometheus-edge-hub/1")
+        self.harness.update_relation_data(
+            self.peer_relation_id,
+            "prometheus-edge-hub",
+            {"restart_granted": "prometheus-edge-hub/1"},
+        )
+
+        with patch("ops.model.Container.restart") as patched_restart:
+            self.harness.update_config({"ingest_batch_pushes": True})
+            ingest_service = self.harness.get_container_pebble_plan("ingest").services["ingest"]
+            settings = json.loads(ingest_service.environment["INGEST_CONFIG"])
+            self.assertFalse(settings["batch_pushes"])
+            self.assertEqual(
+                self.harness.charm.unit.status, WaitingStatus("Waiting for rolling restart")
+            )
+
+            self.harness.update_relation_data(
+                self.peer_relation_id,
+                "prometheus-edge-hub",
+                {"restart_granted": "prometheus-edge-hub/0"},
+            )
+
+        ingest_service = self.harness.get_container_pebble_plan("ingest").services["ingest"]
+        settings = json.loads(ingest_service.environment["INGEST_CONFIG"])
+        self.assertTrue(settings["batch_pushes"])
+        patched_restart.assert_not_called()
+        unit_data = self.harness.get_relation_data(self.peer_relation_id, "prometheus-edge-hub/0")
+        self.assertEqual(unit_data["restart_done"], unit_data["restart_requested"])
+
+    def test_given_restart_pending_when_ingest_container_gets_ready_then_ingest_is_started(
+        self,
+    ):
+        # the hub already left the public push port to the sidecar before the restart request
+        self.harness.set_can_connect(container=self._container, val=True)
+        self.harness.charm.on.prometheus_edge_hub_pebble_ready.emit(self._container)
+        self.harness.update_config({"ingest_frontend": True})
+        self.harness.add_relation_unit(self.peer_relation_id, "prometheus-edge-hub/1")
+        self.harness.update_relation_data(
+            self.peer_relation_id,
+            "prometheus-edge-hub",
+            {"restart_granted": "prometheus-edge-hub/1"},
+        )
+        self.harness.update_config({"metrics_count_limit": 25})
+
+        self.harness.set_can_connect(container="ingest", val=True)
+        self.harness.charm.on.ingest_pebble_ready.emit(self.harness.charm._ingest_container)
+
+        self.assertTrue(self.harness.charm._ingest_container.get_service("ingest").is_running())
+        self.assertEqual(
+            self.harness.charm.unit.status, WaitingStatus("Waiting for rolling restart")
+        )
+
+    @patch("charm.CacheSnapshot.save")
+    def test_given_snapshot_storage_attached_when_stop_then_cache_is_saved(self, patched_save):
+        self.harness.add_storage("cache-snapshot", attach=True)
+        self.harness.set_can_connect(container=self._container, val=True)
+        self.harness.charm.on.prometheus_edge_hub_pebble_ready.emit(self._container)
+
+        self.harness.charm.on.stop.emit()
+
+        patched_save.assert_called_once_with()
+
+    @patch("charm.CacheSnapshot.save")
+    def test_given_no_snapshot_storage_when_stop_then_cache_is_not_saved(self, patched_save):
+        self.harness.set_can_connect(container=self._container, val=True)
+        self.harness.charm.on.prometheus_edge_hub_pebble_ready.emit(self._container)
+
+        self.harness.charm.on.stop.emit()
+
+        patched_save.assert_not_called()
+
+    @patch("charm.CacheSnapshot.restore")
+    @patch("charm.CacheSnapshot.save")
+    def test_given_snapshot_storage_attached_when_hub_restarted_then_cache_is_saved_and_replayed(
+        self, patched_save, patched_restore
+    ):
+        self.harness.add_storage("cache-snapshot", attach=True)
+        self.harness.set_can_connect(container=self._container, val=True)
+        self.harness.charm.on.prometheus_edge_hub_pebble_ready.emit(self._container)
+
+        self.harness.update_config({"metrics_count_limit": 25})
+
+        patched_save.assert_called_once_with()
+        patched_restore.assert_called_with()
+
+    @patch("charm.CacheSnapshot.restore")
+    def test_given_snapshot_replay_fails_when_deferred_config_changed_is_reemitted_then_replay_is_retried(  # noqa: E501
+        self, patched_restore
+    ):
+        self.harness.add_storage("cache-snapshot", attach=True)
+        self.harness.set_can_connect(container=self._container, val=True)
+        self.harness.charm.on.prometheus_edge_hub_pebble_ready.emit(self._container)
+        patched_restore.return_value = False
+        self.harness.update_config({"metrics_count_limit": 25})
+        patched_restore.reset_mock(return_value=True)
+        patched_restore.return_value = True
+
+        self.harness.framework.reemit()
+
+        patched_restore.assert_called_once_with()
+
+    def test_given_ingest_frontend_enabled_when_config_changed_then_hub_moves_to_internal_port_and_ingest_runs(  # noqa: E501
+        self,
+    ):
+        self.harness.set_can_connect(container=self._container, val=True)
+        self.harness.set_can_connect(container="ingest", val=True)
+        self.harness.charm.on.prometheus_edge_hub_pebble_ready.emit(self._container)
+
+        self.harness.update_config({"ingest_frontend": True})
+
+        hub_plan = self.harness.get_container_pebble_plan("prometheus-edge-hub").to_dict()
+        self.assertEqual(
+            hub_plan["services"]["prometheus-edge-hub"]["command"],
+            f"prometheus-edge-hub -grpc-port={GRPC_PORT} -port=9093",
+        )
+        ingest_service = self.harness.get_container_pebble_plan("ingest").services["ingest"]
+        self.assertEqual(ingest_service.command, "python3 -m ingest")
+        settings = json.loads(ingest_service.environment["INGEST_CONFIG"])
+        self.assertEqual((settings["listen_port"], settings["hub_port"]), (9091, 9093))
+        self.assertTrue(self.harness.charm._ingest_container.get_service("ingest").is_running())
+        self.assertTrue(
+            self.harness.charm._ingest_container.exists("/opt/ingest/ingest/__main__.py")
+        )
+        self.assertEqual(self.harness.charm.unit.status, ActiveStatus())
+
+    def test_given_ingest_frontend_enabled_when_disabled_then_ingest_is_stopped_and_hub_takes_public_port_back(  # noqa: E501
+        self,
+    ):
+        self.harness.set_can_connect(container=self._container, val=True)
+        self.harness.set_can_connect(container="ingest", val=True)
+        self.harness.charm.on.prometheus_edge_hub_pebble_ready.emit(self._container)
+        self.harness.update_config({"ingest_frontend": True})
+
+        self.harness.update_config({"ingest_frontend": False})
+
+        hub_plan = self.harness.get_container_pebble_plan("prometheus-edge-hub").to_dict()
+        self.assertEqual(
+            hub_plan["services"]["prometheus-edge-hub"]["command"],
+            f"prometheus-edge-hub -grpc-port={GRPC_PORT}",
+        )
+        self.assertEqual(
+            self.harness.get_container_pebble_plan("ingest").services["ingest"].startup,
+            "disabled",
+        )
+        self.assertFalse(self.harness.charm._ingest_container.get_service("ingest").is_running())
+
+    def test_given_ingest_frontend_enabled_and_ingest_container_not_ready_when_config_changed_then_status_is_waiting(  # noqa: E501
+        self,
+    ):
+        self.harness.set_can_connect(container=self._container, val=True)
+        self.harness.charm.on.prometheus_edge_hub_pebble_ready.emit(self._container)
+
+        self.harness.update_config({"ingest_frontend": True})
+
+        self.assertEqual(
+            self.harness.charm.unit.status, WaitingStatus("Waiting for ingest container")
+        )
+
+    def test_given_batching_enabled_when_config_changed_then_ingest_runs_with_batching(self):
+        self.harness.set_can_connect(container=self._container, val=True)
+        self.harness.set_can_connect(container="ingest", val=True)
+        self.harness.charm.on.prometheus_edge_hub_pebble_ready.emit(self._container)
+
+        self.harness.update_config({"ingest_batch_pushes": True, "ingest_batch_max_age": 0.2})
+
+        ingest_service = self.harness.get_container_pebble_plan("ingest").services["ingest"]
+        settings = json.loads(ingest_service.environment["INGEST_CONFIG"])
+        self.assertEqual((settings["batch_pushes"], settings["batch_max_age"]), (True, 0.2))
+        self.assertTrue(self.harness.charm._ingest_container.get_service("ingest").is_running())
+
+    def test_given_aggregation_rules_when_config_changed_then_ingest_runs_with_them(self):
+        self.harness.set_can_connect(container=self._container, val=True)
+        self.harness.set_can_connect(container="ingest", val=True)
+        self.harness.charm.on.prometheus_edge_hub_pebble_ready.emit(self._container)
+
+        self.harness.update_config(
+            {"ingest_aggregation_rules": "- match: device_bytes_total\n  by: [site]\n"}
+        )
+
+        ingest_service = self.harness.get_container_pebble_plan("ingest").services["ingest"]
+        settings = json.loads(ingest_service.environment["INGEST_CONFIG"])
+        self.assertEqual(
+            settings["aggregation_rules"], [{"match": "device_bytes_total", "by": ["site"]}]
+        )
+        self.assertEqual(self.harness.charm.unit.status, ActiveStatus())
+
+    def test_given_invalid_aggregation_rules_when_config_changed_then_status_is_blocked(self):
+        self.harness.set_can_connect(container=self._container, val=True)
+
+        self.harness.update_config({"ingest_aggregation_rules": "- match: x\n  op: avg\n"})
+
+        self.assertEqual(
+            self.harness.charm.unit.status,
+            BlockedStatus("Invalid ingest_aggregation_rules: x: op must be one of sum, max, last"),
+        )
+
+    def test_given_remote_write_relation_when_url_published_then_ingest_drains_hub_to_it(self):
+        self.harness.set_can_connect(container=self._container, val=True)
+        self.harness.set_can_connect(container="ingest", val=True)
+        self.harness.charm.on.prometheus_edge_hub_pebble_ready.emit(self._container)
+        relation_id = self.harness.add_relation("receive-remote-write", "prometheus-k8s")
+        self.harness.add_relation_unit(relation_id, "prometheus-k8s/0")
+
+        self.harness.update_relation_data(
+            relation_id,
+            "prometheus-k8s/0",
+            {"remote_write": json.dumps({"url": "http://prometheus:9090/api/v1/write"})},
+        )
+
+        ingest_service = self.harness.get_container_pebble_plan("ingest").services["ingest"]
+        settings = json.loads(ingest_service.environment["INGEST_CONFIG"])
+        self.assertEqual(settings["remote_write_urls"], ["http://prometheus:9090/api/v1/write"])
+        self.assertEqual(settings["remote_write_labels"]["juju_charm"], "prometheus-edge-hub")
+        self.assertTrue(self.harness.charm._ingest_container.get_service("ingest").is_running())
+        hub_plan = self.harness.get_container_pebble_plan("prometheus-edge-hub").to_dict()
+        self.assertTrue(
+            hub_plan["services"]["prometheus-edge-hub"]["command"].endswith("-port=9093")
+        )
+
+    @patch("ops.model.Container.get_checks", lambda *args, **kwargs: READY_CHECKS)
+    def test_given_remote_write_relation_when_url_published_then_only_ingest_metrics_job_is_published(  # noqa: E501
+        self,
+    ):
+        self.harness.set_leader(True)
+        self.harness.set_can_connect(container=self._container, val=True)
+        self.harness.set_can_connect(container="ingest", val=True)
+        self.harness.charm.on.prometheus_edge_hub_pebble_ready.emit(self._container)
+        metrics_relation_id = self.harness.add_relation("metrics-endpoint", "prometheus-k8s")
+        self.harness.add_relation_unit(metrics_relation_id, "prometheus-k8s/0")
+        relation_id = self.harness.add_relation("receive-remote-write", "prometheus-k8s")
+        self.harness.add_relation_unit(relation_id, "prometheus-k8s/0")
+
+        self.harness.update_relation_data(
+            relation_id,
+            "prometheus-k8s/0",
+            {"remote_write": json.dumps({"url": "http://prometheus:9090/api/v1/write"})},
+        )
+
+        scrape_jobs = json.loads(
+            self.harness.get_relation_data(metrics_relation_id, "prometheus-edge-hub")[
+                "scrape_jobs"
+            ]
+        )
+        self.assertEqual([job["metrics_path"] for job in scrape_jobs], ["/ingest/metrics"])
+        self.assertEqual(
+            self.harness.charm.unit.status,
+            ActiveStatus("Hub drained to remote-write, not scraped"),
+        )
+
+    def test_given_remote_write_relation_when_removed_then_ingest_is_stopped(self):
+        self.harness.set_can_connect(container=self._container, val=True)
+        self.harness.set_can_connect(container="ingest", val=True)
+        self.harness.charm.on.prometheus_edge_hub_pebble_ready.emit(self._container)
+        relation_id = self.harness.add_relation("receive-remote-write", "prometheus-k8s")
+        self.harness.add_relation_unit(relation_id, "prometheus-k8s/0")
+        self.harness.update_relation_data(
+            relation_id,
+            "prometheus-k8s/0",
+            {"remote_write": json.dumps({"url": "http://prometheus:9090/api/v1/write"})},
+        )
+
+        self.harness.remove_relation(relation_id)
+
+        self.assertFalse(self.harness.charm._ingest_container.get_service("ingest").is_running())
+
+    def test_given_priority_classes_and_cache_limit_when_config_changed_then_ingest_keeps_the_limit(  # noqa: E501
+        self,
+    ):
+        self.harness.set_can_connect(container=self._container, val=True)
+        self.harness.set_can_connect(container="ingest", val=True)
+        self.harness.charm.on.prometheus_edge_hub_pebble_ready.emit(self._container)
+
+        self.harness.update_config(
+            {
+                "metrics_count_limit": 1000,
+                "ingest_priority_classes": "- name: critical\n  match: {severity: critical}\n",
+            }
+        )
+
+        ingest_service = self.harness.get_container_pebble_plan("ingest").services["ingest"]
+        settings = json.loads(ingest_service.environment["INGEST_CONFIG"])
+        self.assertEqual(
+            settings["priority_classes"], [{"name": "critical", "match": {"severity": "critical"}}]
+        )
+        self.assertEqual(settings["admission_limit"], 1000)
+        hub_plan = self.harness.get_container_pebble_plan("prometheus-edge-hub").to_dict()
+        self.assertEqual(
+            hub_plan["services"]["prometheus-edge-hub"]["command"],
+            f"prometheus-edge-hub -grpc-port={GRPC_PORT} -port=9093 -limit=1250",
+        )
+        self.assertEqual(self.harness.charm.unit.status, ActiveStatus())
+
+    def test_given_priority_classes_and_derived_cache_limit_when_config_changed_then_backstop_is_reserved_within_it(  # noqa: E501
+        self,
+    ):
+        self.harness.set_can_connect(container=self._container, val=True)
+        self.harness.set_can_connect(container="ingest", val=True)
+        self._container.push("/sys/fs/cgroup/memory.max", "536870912\n", make_dirs=True)
+        self.harness.charm.on.prometheus_edge_hub_pebble_ready.emit(self._container)
+
+        self.harness.update_config(
+            {
+                "metrics_count_limit_auto": True,
+                "ingest_priority_classes": "- name: critical\n  match: {severity: critical}\n",
+            }
+        )
+
+        ingest_service = self.harness.get_container_pebble_plan("ingest").services["ingest"]
+        settings = json.loads(ingest_service.environment["INGEST_CONFIG"])
+        self.assertEqual(settings["admission_limit"], 386662 * 100 // 125)
+        hub_plan = self.harness.get_container_pebble_plan("prometheus-edge-hub").to_dict()
+        self.assertEqual(
+            hub_plan["services"]["prometheus-edge-hub"]["command"],
+            f"prometheus-edge-hub -grpc-port={GRPC_PORT} -port=9093 -limit=386662",
+        )
+
+    def test_given_priority_classes_and_ingest_memory_limit_when_config_changed_then_held_samples_fit_in_it(  # noqa: E501
+        self,
+    ):
+        self.harness.set_can_connect(container=self._container, val=True)
+        self.harness.set_can_connect(container="ingest", val=True)
+        ingest_container = self.harness.model.unit.get_container("ingest")
+        ingest_container.push("/sys/fs/cgroup/memory.max", "67108864\n", make_dirs=True)
+        self.harness.charm.on.prometheus_edge_hub_pebble_ready.emit(self._container)
+
+        self.harness.update_config(
+            {
+                "metrics_count_limit": 100000,
+                "ingest_priority_classes": "- name: critical\n  match: {severity: critical}\n",
+            }
+        )
+
+        ingest_service = self.harness.get_container_pebble_plan("ingest").services["ingest"]
+        settings = json.loads(ingest_service.environment["INGEST_CONFIG"])
+        # (64 MiB * 80% - 32 MiB) / 1536 bytes
+        self.assertEqual(settings["admission_limit"], 13107)
+
+    def test_given_priority_classes_without_cache_limit_when_config_changed_then_status_is_blocked(  # noqa: E501
+        self,
+    ):
+        self.harness.set_can_connect(container=self._container, val=True)
+
+        self.harness.update_config(
+            {"ingest_priority_classes": "- name: critical\n  match: {severity: critical}\n"}
+        )
+
+        self.assertEqual(
+            self.harness.charm.unit.status,
+            BlockedStatus(
+                "Invalid ingest_priority_classes: "
+                "the cache is not limited, see metrics_count_limit"
+            ),
+        )
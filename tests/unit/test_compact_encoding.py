@@ -0,0 +1,92 @@
+# Copyright 2022 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+import json
+import unittest
+from unittest.mock import patch
+
+from charms.prometheus_k8s.v0.prometheus_scrape import (
+    COMPACT_ENCODING,
+    _decoded_relation_data,
+    _encoded_relation_data,
+    _set_encoded_relation_data,
+)
+
+LABELS = {
+    "juju_model": "edge",
+    "juju_model_uuid": "f2c1b2a8-0e0f-4b5f-9c1a-3d2f0c4b5a6e",
+    "juju_application": "node",
+    "juju_charm": "node-exporter",
+}
+RELABEL_CONFIGS = [
+    {
+        "source_labels": ["juju_model", "juju_model_uuid", "juju_application", "juju_unit"],
+        "separator": "_",
+        "target_label": "instance",
+        "regex": "(.*)",
+    }
+]
+
+
+def scrape_jobs(units: int) -> str:
+    return json.dumps(
+        [
+            {
+                "job_name": "juju_edge_f2c1b2a_node_prometheus_scrape",
+                "relabel_configs": RELABEL_CONFIGS,
+                "static_configs": [
+                    {
+                        "targets": ["10.1.{}.{}:9100".format(unit // 256, unit % 256)],
+                        "labels": dict(LABELS, juju_unit="node/{}".format(unit)),
+                    }
+                    for unit in range(units)
+                ],
+            }
+        ]
+    )
+
+
+class TestCompactEncoding(unittest.TestCase):
+    def test_given_consumer_without_compact_encoding_when_encoded_then_value_is_plain_json(self):
+        text = scrape_jobs(100)
+
+        self.assertEqual(_encoded_relation_data("scrape_jobs", text, []), {"scrape_jobs": text})
+
+    def test_given_many_units_when_encoded_then_value_is_smaller_and_decodes_to_the_same(self):
+        text = scrape_jobs(1000)
+
+        data = _encoded_relation_data("scrape_jobs", text, [COMPACT_ENCODING])
+
+        self.assertLess(len(data["scrape_jobs"]), len(text) / 5)
+        decoded = _decoded_relation_data(data)
+        self.assertEqual(json.loads(decoded["scrape_jobs"]), json.loads(text))
+
+    @patch("charms.prometheus_k8s.v0.prometheus_scrape._COMPACT_CHUNK_SIZE", 1000)
+    def test_given_large_value_when_encoded_then_it_is_chunked_and_decodes_to_the_same(self):
+        text = scrape_jobs(1000)
+
+        data = _encoded_relation_data("scrape_jobs", text, [COMPACT_ENCODING])
+
+        self.assertGreater(len(data), 2)
+        self.assertTrue(all(len(value) <= 1000 for value in data.values()))
+        self.assertEqual(
+            _decoded_relation_data(data), {"scrape_jobs": json.dumps(json.loads(text))}
+        )
+
+    @patch("charms.prometheus_k8s.v0.prometheus_scrape._COMPACT_CHUNK_SIZE", 1000)
+    def test_given_chunked_value_when_smaller_value_set_then_stale_chunks_are_removed(self):
+        databag = {}
+        _set_encoded_relation_data(databag, "scrape_jobs", scrape_jobs(1000), [COMPACT_ENCODING])
+
+        _set_encoded_relation_data(databag, "scrape_jobs", scrape_jobs(1), [COMPACT_ENCODING])
+
+        self.assertEqual(list(databag), ["scrape_jobs"])
+        self.assertEqual(
+            json.loads(_decoded_relation_data(databag)["scrape_jobs"]), json.loads(scrape_jobs(1))
+        )
+
+    def test_given_corrupt_value_when_decoded_then_it_is_left_out(self):
+        data = {"scrape_jobs": COMPACT_ENCODING + ":z:bm90IHpsaWI=", "scrape_metadata": "{}"}
+
+        with self.assertLogs(level="ERROR"):
+            self.assertEqual(_decoded_relation_data(data), {"scrape_metadata": "{}"})
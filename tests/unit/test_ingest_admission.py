@@ -0,0 +1,171 @@
+# Copyright 2022 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+import asyncio
+import unittest
+
+from ingest_fakes import FakeHub, UnavailablePool, push_request, read_responses
+
+from ingest.admission import Admission, compile_classes
+from ingest.app import App
+from ingest.config import Config
+from ingest.exposition import parse
+from ingest.metrics import Registry
+from ingest.protocol import ProtocolError
+
+CLASSES = [
+    {"name": "critical", "match": {"severity": "critical"}},
+    {"name": "bulk", "match": {"__name__": "batch_.*"}},
+]
+
+
+class TestPriorityClasses(unittest.TestCase):
+    def test_given_classes_when_compiled_then_patterns_match_whole_label_values(self):
+        critical, bulk = compile_classes(CLASSES)
+
+        self.assertTrue(critical.matches({"severity": "critical"}))
+        self.assertFalse(critical.matches({"severity": "critical-ish"}))
+        self.assertFalse(critical.matches({}))
+        self.assertTrue(bulk.matches({"__name__": "batch_rows_total"}))
+
+    def test_given_invalid_classes_when_compiled_then_value_error_is_raised(self):
+        for classes in (
+            {"name": "x", "match": {"a": "b"}},
+            [{"name": "x"}],
+            [{"name": "x", "match": {"a": "("}}],
+            [{"name": "x", "match": {"a-b": "c"}}],
+            [{"name": "default", "match": {"a": "b"}}],
+            [{"name": "x", "match": {"a": "b"}, "typo": 1}],
+            [{"name": "x", "match": {"a": "b"}}, {"name": "x", "match": {"a": "c"}}],
+        ):
+            with self.subTest(classes=classes):
+                with self.assertRaises(ValueError):
+                    compile_classes(classes)
+
+
+class TestAdmission(unittest.TestCase):
+    def setUp(self):
+        self.registry = Registry()
+        self.admission = Admission(compile_classes(CLASSES), 4, None, self.registry)
+
+    def push(self, text: str) -> int:
+        return self.admission.push(parse(text)).status
+
+    def held(self) -> list:
+        return [list(held) for held in self.admission._held]
+
+    def test_given_full_store_when_higher_class_pushes_then_oldest_lowest_series_are_evicted(self):
+        self.assertEqual(self.push("batch_a 1\nbatch_b 1\nx 1\n"), 200)
+
+        self.push('alert{severity="critical",n="1"} 1\nalert{severity="critical",n="2"} 1\n')
+        self.push('alert{severity="critical",n="3"} 1\n')
+
+        alerts = [("alert", (("n", str(n)), ("severity", "critical"))) for n in (1, 2, 3)]
+        self.assertEqual(self.held(), [alerts, [("batch_b", ())], []])
+        self.assertIn('ingest_admission_evicted_series_total{class="bulk"} 1', self.exposition())
+        self.assertIn(
+            'ingest_admission_evicted_series_total{class="default"} 1', self.exposition()
+        )
+
+    def test_given_store_full_of_higher_class_when_lower_class_pushes_then_it_is_rejected(self):
+        self.push("".join('alert{{severity="critical",n="{}"}} 1\n'.format(n) for n in range(4)))
+
+        response = self.admission.push(parse("x 1\nbatch_a 1\n"))
+
+        self.assertEqual(response.status, 429)
+        self.assertEqual(response.body, b"Cache full, rejected samples: 1 bulk, 1 default\n")
+        self.assertEqual(self.admission.size, 4)
+        self.assertIn('ingest_admission_held_samples{class="critical"} 4', self.exposition())
+
+    def test_given_histogram_when_evicted_then_all_its_samples_are_evicted(self):
+        self.push(
+            "# TYPE h histogram\n"
+            'h_bucket{le="1"} 1\nh_bucket{le="+Inf"} 2\nh_sum 3\nh_count 2\n'
+        )
+
+        self.push('alert{severity="critical"} 1\n')
+
+        self.assertEqual(self.held(), [[("alert", (("severity", "critical"),))], [], []])
+        self.assertEqual(self.admission.size, 1)
+
+    def test_given_held_sample_when_pushed_again_then_it_is_replaced(self):
+        self.push("x 1\n")
+
+        self.push("x 2\n")
+
+        self.assertEqual(self.admission.size, 1)
+        self.assertEqual(self.admission._held[2][("x", ())], {("x", ()): "x 2"})
+
+    def test_given_family_held_as_counter_when_pushed_as_gauge_then_push_is_refused(self):
+        self.push("# TYPE x counter\nx 1\n")
+
+        with self.assertRaises(ProtocolError):
+            self.push("# TYPE x gauge\nx 1\ny 1\n")
+        self.assertEqual(self.admission.size, 1)
+
+    def test_given_hub_unavailable_when_flushed_then_samples_are_held_again(self):
+        self.admission._pool = UnavailablePool()
+        self.push("x 1\ny 1\n")
+        self.push("y 2\n")
+
+        asyncio.run(self.flush_while_pushing("y 3\n"))
+
+        self.assertEqual(self.held(), [[], [], [("y", ()), ("x", ())]])
+        self.assertEqual(self.admission._held[2][("y", ())], {("y", ()): "y 3"})
+        self.assertEqual(self.admission.flush_failures, 1)
+
+    async def flush_while_pushing(self, text: str) -> None:
+        flush = asyncio.ensure_future(self.admission.flush())
+        await asyncio.sleep(0)
+        self.push(text)
+        await flush
+
+    def exposition(self) -> str:
+        return self.registry.exposition().decode()
+
+
+class TestIngestAdmission(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.hub = FakeHub()
+        hub_port = await self.hub.start()
+        self.addAsyncCleanup(self.hub.stop)
+        self.app = App(
+            Config(
+                listen_host="127.0.0.1",
+                listen_port=0,
+                hub_port=hub_port,
+                priority_classes=CLASSES,
+                admission_limit=2,
+            )
+        )
+        await self.app.start()
+        self.addAsyncCleanup(self.app.stop)
+
+    async def request(self, request: bytes) -> tuple:
+        reader, writer = await asyncio.open_connection("127.0.0.1", self.app.frontend.port)
+        self.addCleanup(writer.close)
+        writer.write(request)
+        return (await read_responses(reader, 1))[0]
+
+    async def test_given_noisy_client_when_critical_series_pushed_then_they_reach_the_scrape(
+        self,
+    ):
+        noisy = await self.request(push_request(b"".join(b"x%d 1\n" % n for n in range(10))))
+        critical = await self.request(push_request(b'alert{severity="critical"} 1\n'))
+
+        self.assertEqual((noisy[0], critical[0]), (200, 200))
+        self.assertEqual(self.hub.pushes, [])
+        scrape = await self.request(b"GET /metrics HTTP/1.1\r\nHost: hub\r\n\r\n")
+        self.assertEqual(scrape[0], 200)
+        self.assertEqual(scrape[2], b'alert{severity="critical"} 1\nx9 1\n')
+        metrics = await self.request(b"GET /ingest/metrics HTTP/1.1\r\n\r\n")
+        self.assertIn(b'ingest_admission_evicted_series_total{class="default"} 9', metrics[2])
+        self.assertEqual(self.app.admission.size, 0)
+
+    async def test_given_compressed_push_when_classes_are_set_then_it_is_refused(self):
+        response = await self.request(
+            b"POST /metrics HTTP/1.1\r\nContent-Encoding: gzip\r\nContent-Length: 1\r\n\r\nx"
+        )
+
+        self.assertEqual(response[0], 415)
+        self.assertEqual(self.hub.pushes, [])
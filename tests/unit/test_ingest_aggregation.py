@@ -0,0 +1,165 @@
+# Copyright 2022 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+import asyncio
+import time
+import unittest
+
+from ingest_fakes import FakeHub, UnavailablePool, push_request, read_responses
+
+from ingest.aggregation import Aggregator, compile_rules
+from ingest.app import App
+from ingest.config import Config
+from ingest.exposition import parse, render
+from ingest.metrics import Registry
+from ingest.protocol import ProtocolError
+
+PUSH = """# TYPE device_bytes_total counter
+device_bytes_total{{site="{site}",device="{device}"}} {value}
+# TYPE device_temperature gauge
+device_temperature{{site="{site}",device="{device}"}} {value}
+# TYPE device_latency_seconds histogram
+device_latency_seconds_bucket{{le="+Inf"}} 1
+device_latency_seconds_sum {value}
+device_latency_seconds_count 1
+"""
+
+
+def push(site: str, device: str, value: float) -> str:
+    return PUSH.format(site=site, device=device, value=value)
+
+
+class TestAggregationRules(unittest.TestCase):
+    def test_given_rules_when_compiled_then_they_are_indexed_by_metric_with_defaults(self):
+        index = compile_rules(
+            [
+                {"match": "device_bytes_total", "by": ["site"]},
+                {"match": "device_bytes_total", "op": "max", "as": "device_bytes:max"},
+            ]
+        )
+
+        self.assertEqual(list(index), ["device_bytes_total"])
+        rules = index["device_bytes_total"]
+        self.assertEqual(
+            [(r.name, r.op, r.interval) for r in rules],
+            [("site:device_bytes_total:sum", "sum", 60.0), ("device_bytes:max", "max", 60.0)],
+        )
+
+    def test_given_invalid_rules_when_compiled_then_value_error_is_raised(self):
+        for rules in (
+            {"match": "x"},
+            [{"match": "x", "op": "avg"}],
+            [{"match": "x", "by": "site"}],
+            [{"match": "x", "interval": 0}],
+            [{"match": "x{a=1}"}],
+            [{"match": "x", "typo": 1}],
+            [{"match": "x"}, {"match": "y", "as": "x:sum"}],
+        ):
+            with self.subTest(rules=rules):
+                with self.assertRaises(ValueError):
+                    compile_rules(rules)
+
+
+class TestAggregator(unittest.TestCase):
+    def setUp(self):
+        rules = [
+            {"match": "device_bytes_total", "by": ["site"]},
+            {"match": "device_temperature", "by": ["site"], "op": "max"},
+            {"match": "device_temperature", "op": "last"},
+            {"match": "device_latency_seconds"},
+        ]
+        self.aggregator = Aggregator(compile_rules(rules), None, Registry())
+
+    def drain(self) -> str:
+        drained = ((a, a.drain(0)) for a in self.aggregator._aggregates)
+        return render(a.family(groups) for a, groups in drained if groups)
+
+    def test_given_pushes_when_absorbed_then_groups_hold_the_aggregates_of_the_bucket(self):
+        for site, device, value in [("a", "1", 5), ("a", "2", 3), ("b", "3", 4), ("a", "1", 7)]:
+            kept = self.aggregator.absorb(parse(push(site, device, value)))
+            self.assertEqual([f.name for f in kept], ["device_latency_seconds"])
+
+        self.assertEqual(
+            self.drain(),
+            "# HELP site:device_bytes_total:sum sum of device_bytes_total by site.\n"
+            "# TYPE site:device_bytes_total:sum counter\n"
+            'site:device_bytes_total:sum{site="a"} 10.0\n'
+            'site:device_bytes_total:sum{site="b"} 4.0\n'
+            "# HELP site:device_temperature:max max of device_temperature by site.\n"
+            "# TYPE site:device_temperature:max gauge\n"
+            'site:device_temperature:max{site="a"} 7.0\n'
+            'site:device_temperature:max{site="b"} 4.0\n'
+            "# HELP device_temperature:last last of device_temperature by nothing.\n"
+            "# TYPE device_temperature:last gauge\n"
+            "device_temperature:last 7.0\n",
+        )
+        self.assertEqual(self.drain(), "")
+        self.assertEqual(self.aggregator.samples, 8)
+
+    def test_given_counter_aggregated_when_pushed_as_gauge_then_push_is_refused(self):
+        self.aggregator.absorb(parse(push("a", "1", 5)))
+
+        with self.assertRaises(ProtocolError):
+            self.aggregator.absorb(
+                parse(
+                    '# TYPE device_bytes_total gauge\ndevice_temperature{site="a"} 9\n'
+                    'device_bytes_total{site="a",device="2"} 1\n'
+                )
+            )
+        self.assertEqual(self.aggregator.samples, 2)
+
+    def test_given_hub_unavailable_when_sent_then_aggregates_are_merged_into_next_bucket(self):
+        self.aggregator._pool = UnavailablePool()
+        self.aggregator.absorb(parse(push("a", "1", 5) + push("a", "2", 3)))
+
+        asyncio.run(self.aggregator._send(self.aggregator._aggregates, 0))
+        self.aggregator.absorb(parse(push("a", "1", 6)))
+
+        self.assertEqual(self.aggregator.flush_failures, 1)
+        self.assertIn('site:device_bytes_total:sum{site="a"} 9.0\n', self.drain())
+
+    def test_given_unparsable_sample_when_absorbed_then_it_is_passed_on(self):
+        kept = self.aggregator.absorb(parse('device_bytes_total{site="a} 1\ndevice_bytes_total 2'))
+
+        self.assertEqual(render(kept), 'device_bytes_total{site="a} 1\n')
+        self.assertEqual(self.aggregator.samples, 1)
+
+
+class TestIngestAggregation(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.hub = FakeHub()
+        hub_port = await self.hub.start()
+        self.addAsyncCleanup(self.hub.stop)
+        rules = [{"match": "device_bytes_total", "by": ["site"], "interval": 0.5}]
+        self.app = App(
+            Config(
+                listen_host="127.0.0.1",
+                listen_port=0,
+                hub_port=hub_port,
+                aggregation_rules=rules,
+            )
+        )
+        await self.app.start()
+        self.addAsyncCleanup(self.app.stop)
+
+    async def push(self, body: str) -> int:
+        reader, writer = await asyncio.open_connection("127.0.0.1", self.app.frontend.port)
+        self.addCleanup(writer.close)
+        writer.write(push_request(body.encode()))
+        return (await read_responses(reader, 1))[0][0]
+
+    async def test_given_rule_when_devices_push_then_hub_gets_other_samples_and_then_the_sum(
+        self,
+    ):
+        # start at the beginning of a bucket, so that both pushes are in it
+        await asyncio.sleep(0.51 - time.time() % 0.5)
+        statuses = [
+            await self.push('device_bytes_total{site="a",device="1"} 5\nhub_up 1\n'),
+            await self.push('device_bytes_total{site="a",device="2"} 3\n'),
+        ]
+
+        self.assertEqual(statuses, [200, 200])
+        self.assertEqual(self.hub.pushes, [b"hub_up 1\n"])
+        await asyncio.sleep(0.6)
+        self.assertIn(b'site:device_bytes_total:sum{site="a"} 8.0\n', self.hub.pushes[-1])
+        self.assertEqual(self.app.aggregator.series, 1)
@@ -0,0 +1,120 @@
+# Copyright 2022 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+import asyncio
+import unittest
+
+from ingest_fakes import FakeHub, push_request, read_responses
+
+from ingest.app import App
+from ingest.config import Config
+
+COUNTER = '# HELP hub_test_total Pushes.\n# TYPE hub_test_total counter\nhub_test_total{{device="{}"}} 1\n'  # noqa: E501
+
+
+class TestIngestBatcher(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.hub = FakeHub()
+        self.hub_port = await self.hub.start()
+        self.addAsyncCleanup(self.hub.stop)
+
+    async def start(self, **settings):
+        self.app = App(
+            Config(
+                listen_host="127.0.0.1",
+                listen_port=0,
+                hub_port=self.hub_port,
+                batch_pushes=True,
+                **settings,
+            )
+        )
+        await self.app.start()
+        self.addAsyncCleanup(self.app.stop)
+
+    async def push(self, body: bytes) -> int:
+        reader, writer = await asyncio.open_connection("127.0.0.1", self.app.frontend.port)
+        self.addCleanup(writer.close)
+        writer.write(push_request(body, connection="close"))
+        return (await read_responses(reader, 1))[0][0]
+
+    async def test_given_concurrent_pushes_when_batch_is_old_enough_then_hub_gets_one_push(self):
+        await self.start(batch_max_age=0.2)
+
+        statuses = await asyncio.gather(
+            *(self.push(COUNTER.format(device).encode()) for device in range(10))
+        )
+
+        self.assertEqual(statuses, [200] * 10)
+        self.assertEqual(len(self.hub.pushes), 1)
+        body = self.hub.pushes[0].decode()
+        self.assertEqual(body.count("# TYPE hub_test_total counter"), 1)
+        self.assertEqual(body.count("hub_test_total{device="), 10)
+
+    async def test_given_batch_full_when_pushing_then_it_is_sent_before_it_is_old_enough(self):
+        await self.start(batch_max_age=60, batch_max_bytes=170)
+
+        statuses = await asyncio.wait_for(
+            asyncio.gather(*(self.push(COUNTER.format(device).encode()) for device in range(4))),
+            5,
+        )
+
+        self.assertEqual(statuses, [200] * 4)
+        self.assertEqual(len(self.hub.pushes), 2)
+
+    async def test_given_conflicting_types_when_pushing_then_they_are_sent_in_separate_batches(
+        self,
+    ):
+        await self.start(batch_max_age=0.2)
+
+        await asyncio.gather(
+            self.push(b"# TYPE hub_x counter\nhub_x 1\n"),
+            self.push(b"# TYPE hub_x gauge\nhub_x 2\n"),
+        )
+
+        self.assertEqual(len(self.hub.pushes), 2)
+
+    async def test_given_malformed_push_when_batched_then_only_its_client_gets_400(self):
+        await self.start(batch_max_age=0.2)
+
+        statuses = await asyncio.gather(self.push(b"hub_a 1\n"), self.push(b'hub_b{x="} 1\n'))
+
+        self.assertEqual(statuses, [200, 400])
+        self.assertEqual(self.hub.pushes, [b"hub_a 1\n"])
+
+    async def test_given_hub_rejecting_batch_when_sent_then_pushes_are_sent_one_by_one(self):
+        self.hub.reject = b"hub_bad"
+        await self.start(batch_max_age=0.2)
+
+        statuses = await asyncio.gather(
+            self.push(b"hub_a 1\n"), self.push(b"hub_bad 1\n"), self.push(b"hub_c 1\n")
+        )
+
+        self.assertEqual(statuses, [200, 400, 200])
+        self.assertEqual(sorted(self.hub.pushes), [b"hub_a 1\n", b"hub_c 1\n"])
+
+    async def test_given_hub_down_when_batch_is_sent_then_its_clients_get_502(self):
+        await self.start(batch_max_age=0.1)
+        await self.hub.stop()
+
+        statuses = await asyncio.gather(self.push(b"hub_a 1\n"), self.push(b"hub_b 1\n"))
+
+        self.assertEqual(statuses, [502, 502])
+        self.assertEqual(self.app.batcher.flush_failures, 1)
+
+    async def test_given_batches_sent_when_hub_is_scraped_then_only_its_samples_are_answered(
+        self,
+    ):
+        await self.start(batch_max_age=0.05)
+        await asyncio.gather(self.push(b"hub_a 1\n"), self.push(b"hub_b 1\n"))
+        reader, writer = await asyncio.open_connection("127.0.0.1", self.app.frontend.port)
+        self.addCleanup(writer.close)
+
+        writer.write(b"GET /metrics HTTP/1.1\r\n\r\n")
+        ((status, _, body),) = await read_responses(reader, 1)
+        writer.write(b"GET /ingest/metrics HTTP/1.1\r\n\r\n")
+        ((_, _, metrics),) = await read_responses(reader, 1)
+
+        self.assertEqual((status, body), (200, b"hub_a 1\nhub_b 1\n"))
+        self.assertIn(b"ingest_batch_pushes_count 1\n", metrics)
+        # the batch and the scrape
+        self.assertIn(b"ingest_hub_requests_total 2\n", metrics)
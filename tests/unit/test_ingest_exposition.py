@@ -0,0 +1,61 @@
+# Copyright 2022 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+import unittest
+
+from ingest.exposition import format_sample, parse, parse_sample, render, validate
+
+HISTOGRAM = """# HELP hub_latency_seconds Push latency.
+# TYPE hub_latency_seconds histogram
+hub_latency_seconds_bucket{le="0.1"} 1
+hub_latency_seconds_bucket{le="+Inf"} 2
+hub_latency_seconds_sum 0.3
+hub_latency_seconds_count 2
+# a comment
+hub_latency_seconds_total 7
+
+hub_up 1
+"""
+
+
+class TestExposition(unittest.TestCase):
+    def test_given_histogram_when_parsed_then_its_samples_are_one_family(self):
+        families = parse(HISTOGRAM)
+
+        self.assertEqual(
+            [(f.name, f.type, len(f.samples)) for f in families],
+            [
+                ("hub_latency_seconds", "histogram", 4),
+                ("hub_latency_seconds_total", None, 1),
+                ("hub_up", None, 1),
+            ],
+        )
+
+    def test_given_families_when_rendered_then_they_parse_back_the_same(self):
+        families = parse(HISTOGRAM)
+
+        self.assertEqual(render(parse(render(families))), render(families))
+        self.assertNotIn("# a comment", render(families))
+
+    def test_given_sample_lines_when_parsed_then_labels_are_unescaped(self):
+        self.assertEqual(
+            parse_sample('hub_x{a="1",b="q\\"uo\\\\te",} 2.5 1000'),
+            ("hub_x", {"a": "1", "b": 'q"uo\\te'}, 2.5, 1000),
+        )
+        self.assertEqual(parse_sample("hub_x NaN")[0], "hub_x")
+        for line in ("hub_x{a=1} 1", 'hub_x{a="1" 1', "hub_x", "hub_x 1 2 3", "hub_x 1 now"):
+            with self.subTest(line=line):
+                with self.assertRaises(ValueError):
+                    parse_sample(line)
+
+    def test_given_labels_when_sample_formatted_then_it_parses_back(self):
+        line = format_sample("hub_x", [("a", 'q"\n'), ("b", "")], float("inf"))
+
+        self.assertEqual(parse_sample(line), ("hub_x", {"a": 'q"\n'}, float("inf"), None))
+
+    def test_given_families_when_validated_then_malformed_samples_and_types_are_refused(self):
+        validate(parse(HISTOGRAM))
+        for text in ('hub_x{a="1} 1\n', "# TYPE hub_x countr\nhub_x 1\n", "hub_x one\n"):
+            with self.subTest(text=text):
+                with self.assertRaises(ValueError):
+                    validate(parse(text))
@@ -0,0 +1,163 @@
+# Copyright 2022 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+import asyncio
+import unittest
+
+from ingest_fakes import FakeHub, push_request, read_responses
+
+from ingest.app import App
+from ingest.config import Config
+from ingest.protocol import Response, read_request
+
+
+class TestIngestFrontend(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.hub = FakeHub()
+        hub_port = await self.hub.start()
+        self.addAsyncCleanup(self.hub.stop)
+        self.app = App(
+            Config(
+                listen_host="127.0.0.1",
+                listen_port=0,
+                hub_port=hub_port,
+                hub_connections=2,
+                max_connections=4,
+            )
+        )
+        await self.app.start()
+        self.addAsyncCleanup(self.app.stop)
+
+    async def connect(self):
+        reader, writer = await asyncio.open_connection("127.0.0.1", self.app.frontend.port)
+        self.addCleanup(writer.close)
+        return reader, writer
+
+    async def test_given_pipelined_pushes_when_sent_at_once_then_responses_come_in_order(self):
+        reader, writer = await self.connect()
+
+        writer.write(
+            push_request(b"a 1\n") + push_request(b"b 2\n") + b"GET /nope HTTP/1.1\r\n\r\n"
+        )
+        responses = await read_responses(reader, 3)
+
+        self.assertEqual([status for status, _, _ in responses], [200, 200, 404])
+        self.assertEqual(sorted(self.hub.pushes), [b"a 1\n", b"b 2\n"])
+
+    async def test_given_many_short_lived_clients_when_pushing_then_hub_connections_are_reused(
+        self,
+    ):
+        for _ in range(20):
+            reader, writer = await self.connect()
+            writer.write(push_request(connection="close"))
+            self.assertEqual((await read_responses(reader, 1))[0][0], 200)
+            self.assertEqual(await reader.read(), b"")
+
+        self.assertEqual(len(self.hub.pushes), 20)
+        self.assertLessEqual(self.hub.connections, 2)
+
+    async def test_given_chunked_push_when_forwarded_then_hub_gets_the_whole_body(self):
+        reader, writer = await self.connect()
+
+        writer.write(
+            b"POST /metrics HTTP/1.1\r\nTransfer-Encoding: chunked\r\n\r\n"
+            b"5\r\nhub_a\r\n4\r\n 1\n\n\r\n0\r\n\r\n"
+        )
+        await read_responses(reader, 1)
+
+        self.assertEqual(self.hub.pushes, [b"hub_a 1\n\n"])
+
+    async def test_given_max_connections_open_when_another_client_connects_then_it_gets_503(
+        self,
+    ):
+        for _ in range(4):
+            reader, writer = await self.connect()
+            writer.write(push_request())
+            await read_responses(reader, 1)
+
+        reader, writer = await self.connect()
+        status, headers, _ = (await read_responses(reader, 1))[0]
+
+        self.assertEqual(status, 503)
+        self.assertEqual(headers["connection"], "close")
+        self.assertEqual(self.app.frontend.connections_rejected, 1)
+
+    async def test_given_hub_down_when_pushing_then_client_gets_502(self):
+        await self.hub.stop()
+        reader, writer = await self.connect()
+
+        writer.write(push_request())
+
+        self.assertEqual((await read_responses(reader, 1))[0][0], 502)
+
+    async def test_given_malformed_request_when_read_then_client_gets_400_and_is_closed(self):
+        reader, writer = await self.connect()
+
+        writer.write(b"garbage\r\n\r\n")
+
+        self.assertEqual((await read_responses(reader, 1))[0][0], 400)
+        self.assertEqual(await reader.read(), b"")
+
+    async def test_given_hub_cache_larger_than_max_body_bytes_when_scraped_then_it_is_all_returned(  # noqa: E501
+        self,
+    ):
+        app = App(
+            Config(
+                listen_host="127.0.0.1",
+                listen_port=0,
+                hub_port=self.hub.port,
+                max_body_bytes=1000,
+            )
+        )
+        await app.start()
+        self.addAsyncCleanup(app.stop)
+        reader, writer = await asyncio.open_connection("127.0.0.1", app.frontend.port)
+        self.addCleanup(writer.close)
+        pushes = [
+            b'hub_test_total{device="%d",padding="%s"} 1\n' % (n, b"x" * 50) for n in range(20)
+        ]
+
+        writer.write(b"".join(push_request(body) for body in pushes))
+        await read_responses(reader, 20)
+        writer.write(b"GET /metrics HTTP/1.1\r\n\r\n")
+        status, _, body = (await read_responses(reader, 1))[0]
+
+        self.assertEqual(status, 200)
+        self.assertGreater(len(body), 1000)
+        lines = body.splitlines(keepends=True)
+        self.assertEqual(sorted(line for line in lines if b"padding" in line), sorted(pushes))
+
+    async def test_given_hub_dropping_connection_when_scraped_then_scrape_is_not_sent_again(self):
+        scrapes = []
+
+        async def drop(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+            # answer pushes, so that the scrape is sent over a reused connection, and drop scrapes
+            while True:
+                request = await read_request(reader, 1 << 20)
+                if request is None or request.method == "GET":
+                    scrapes.append(request)
+                    writer.close()
+                    return
+                writer.write(Response(200).serialize())
+
+        server = await asyncio.start_server(drop, "127.0.0.1", 0)
+        self.addAsyncCleanup(server.wait_closed)
+        self.addCleanup(server.close)
+        app = App(
+            Config(
+                listen_host="127.0.0.1",
+                listen_port=0,
+                hub_port=server.sockets[0].getsockname()[1],
+            )
+        )
+        await app.start()
+        self.addAsyncCleanup(app.stop)
+        reader, writer = await asyncio.open_connection("127.0.0.1", app.frontend.port)
+        self.addCleanup(writer.close)
+
+        writer.write(push_request())
+        await read_responses(reader, 1)
+        writer.write(b"GET /metrics HTTP/1.1\r\n\r\n")
+
+        self.assertEqual((await read_responses(reader, 1))[0][0], 502)
+        self.assertEqual(len(scrapes), 1)
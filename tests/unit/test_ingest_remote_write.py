@@ -0,0 +1,149 @@
+# Copyright 2022 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+import asyncio
+import os
+import unittest
+
+from ingest_fakes import (
+    FakeHub,
+    FakeReceiver,
+    decode_write_request,
+    push_request,
+    read_responses,
+    snappy_decompress,
+)
+
+from ingest import snappy
+from ingest.app import App
+from ingest.config import Config
+from ingest.remote_write import encode_write_request
+
+TOPOLOGY = {"juju_model": "edge", "juju_application": "hub"}
+
+
+async def eventually(condition, timeout: float = 5) -> None:
+    loop = asyncio.get_event_loop()
+    deadline = loop.time() + timeout
+    while not condition():
+        if loop.time() > deadline:
+            raise AssertionError("condition not met in {}s".format(timeout))
+        await asyncio.sleep(0.01)
+
+
+class TestEncoding(unittest.TestCase):
+    def test_given_data_when_snappy_compressed_then_it_decompresses_back(self):
+        text = b"".join(b'hub_x{device="%d"} %d\n' % (i, i * 7) for i in range(5000))
+        for data in (b"", b"x", os.urandom(70000), text, bytes(200000)):
+            with self.subTest(size=len(data)):
+                self.assertEqual(snappy_decompress(snappy.compress(data)), data)
+        self.assertLess(len(snappy.compress(text)), len(text) / 2)
+
+    def test_given_samples_when_encoded_then_receiver_decodes_them(self):
+        samples = [
+            ((("__name__", "hub_x"), ("device", "é")), 1.5, 1600000000000, 0.0),
+            ((("__name__", "hub_y"),), float("inf"), 1, 0.0),
+        ]
+
+        self.assertEqual(
+            decode_write_request(encode_write_request(samples)),
+            [
+                ({"__name__": "hub_x", "device": "é"}, [(1.5, 1600000000000)]),
+                ({"__name__": "hub_y"}, [(float("inf"), 1)]),
+            ],
+        )
+
+
+class TestIngestRemoteWrite(unittest.IsolatedAsyncioTestCase):
+    async def start(self, receiver: FakeReceiver, **settings):
+        self.hub = FakeHub()
+        hub_port = await self.hub.start()
+        self.addAsyncCleanup(self.hub.stop)
+        self.receiver = receiver
+        url = await receiver.start()
+        self.addAsyncCleanup(receiver.stop)
+        self.app = App(
+            Config(
+                listen_host="127.0.0.1",
+                listen_port=0,
+                hub_port=hub_port,
+                remote_write_urls=[url],
+                remote_write_labels=TOPOLOGY,
+                **{"remote_write_interval": 0.02, **settings},
+            )
+        )
+        await self.app.start()
+        self.addAsyncCleanup(self.app.stop)
+
+    async def request(self, data: bytes):
+        reader, writer = await asyncio.open_connection("127.0.0.1", self.app.frontend.port)
+        self.addCleanup(writer.close)
+        writer.write(data)
+        return (await read_responses(reader, 1))[0]
+
+    async def test_given_push_when_hub_is_drained_then_receiver_gets_its_samples(self):
+        await self.start(FakeReceiver())
+
+        await self.request(push_request(b'hub_x{device="a"} 1\nhub_y 2 1600000000000\n'))
+        await eventually(lambda: len(self.receiver.series) == 2)
+
+        series = {
+            labels["__name__"]: (labels, samples) for labels, samples in self.receiver.series
+        }
+        self.assertEqual(series["hub_x"][0], {"__name__": "hub_x", "device": "a", **TOPOLOGY})
+        self.assertEqual(series["hub_y"][1], [(2.0, 1600000000000)])
+        request = self.receiver.requests[0]
+        self.assertEqual(request.header("Content-Encoding"), "snappy")
+        self.assertEqual(self.hub.pushes, [])
+
+    async def test_given_egress_when_scraped_then_hub_is_drained_to_remote_write(self):
+        await self.start(FakeReceiver(), remote_write_interval=60)
+        await self.request(push_request(b"hub_x 1\n"))
+
+        _, _, body = await self.request(b"GET /metrics HTTP/1.1\r\n\r\n")
+        await eventually(lambda: self.app.egress._total("sent") == 1)
+        _, _, metrics = await self.request(b"GET /ingest/metrics HTTP/1.1\r\n\r\n")
+
+        self.assertEqual(body, b"")
+        self.assertIn(b"ingest_remote_write_sent_samples_total 1\n", metrics)
+        self.assertEqual(self.hub.last_request.method, "GET")
+
+    async def test_given_egress_when_stopped_then_hub_is_drained_one_last_time(self):
+        await self.start(FakeReceiver(), remote_write_interval=60)
+        await self.request(push_request(b"hub_x 1\n"))
+
+        await self.app.stop()
+
+        self.assertEqual(len(self.receiver.series), 1)
+        self.assertEqual(self.receiver.series[0][0]["__name__"], "hub_x")
+
+    async def test_given_receiver_failing_when_sending_then_samples_are_retried(self):
+        await self.start(FakeReceiver([503, 429]))
+
+        await self.request(push_request(b"hub_x 1\n"))
+        await eventually(lambda: len(self.receiver.series) == 1)
+
+        self.assertEqual(self.app.egress._total("retries"), 2)
+
+    async def test_given_receiver_rejecting_when_sending_then_samples_are_not_retried(self):
+        await self.start(FakeReceiver([400]))
+
+        await self.request(push_request(b"hub_x 1\n"))
+        await eventually(lambda: self.app.egress._total("failed") == 1)
+        await self.request(push_request(b"hub_y 1\n"))
+        await eventually(lambda: len(self.receiver.series) == 1)
+
+        self.assertEqual(self.receiver.series[0][0]["__name__"], "hub_y")
+        self.assertEqual(self.app.egress._total("retries"), 0)
+
+    async def test_given_receiver_down_when_queues_are_full_then_oldest_samples_are_dropped(self):
+        await self.start(
+            FakeReceiver([503] * 1000), remote_write_shards=1, remote_write_capacity=3
+        )
+
+        for index in range(6):
+            await self.request(push_request(b"hub_x %d\n" % index))
+            await eventually(lambda: self.hub.pushes == [])
+
+        await eventually(lambda: self.app.egress._total("dropped") >= 2)
+        self.assertLessEqual(self.app.egress._total("pending"), 4)
@@ -0,0 +1,89 @@
+# Copyright 2022 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+import unittest
+from unittest.mock import MagicMock, patch
+
+from ops.testing import Harness
+
+from charm import PrometheusEdgeHubCharm
+
+
+class TestInstrumentation(unittest.TestCase):
+    @patch("charm.KubernetesServicePatch", lambda x, y, **kwargs: None)
+    def setUp(self):
+        self.harness = Harness(PrometheusEdgeHubCharm)
+        self.addCleanup(self.harness.cleanup)
+        hub_ready_timeout = patch("charm.HUB_READY_TIMEOUT", 0)
+        hub_ready_timeout.start()
+        self.addCleanup(hub_ready_timeout.stop)
+        self.harness.add_relation("replicas", "prometheus-edge-hub")
+        self.harness.begin()
+        self.harness.set_leader(True)
+        self.harness.set_can_connect("prometheus-edge-hub", True)
+        self.instrumentation = self.harness.charm._instrumentation
+
+    def test_given_hook_calls_pebble_when_exposition_then_calls_are_counted_by_api(self):
+        self.harness.charm.on.config_changed.emit()
+
+        exposition = self.instrumentation.exposition()
+
+        self.assertIn(
+            'charm_calls{hook="unknown",unit="prometheus-edge-hub/0",'
+            'api="pebble",call="add_layer"} 1',
+            exposition,
+        )
+        self.assertIn('api="pebble",call="get_plan"}', exposition)
+        self.assertIn("# TYPE charm_calls gauge\n", exposition)
+        self.assertIn("# TYPE charm_call_duration_seconds gauge\n", exposition)
+        self.assertIn("charm_hook_duration_seconds{", exposition)
+
+    def test_given_hook_writes_relation_data_when_exposition_then_payload_size_is_reported(
+        self,
+    ):
+        relation_id = self.harness.add_relation("metrics-endpoint", "prometheus-k8s")
+        self.harness.add_relation_unit(relation_id, "prometheus-k8s/0")
+        scrape_jobs = self.harness.get_relation_data(relation_id, "prometheus-edge-hub")[
+            "scrape_jobs"
+        ]
+
+        exposition = self.instrumentation.exposition()
+
+        self.assertIn(
+            f'relation_id="{relation_id}",key="scrape_jobs"}} {len(scrape_jobs)}', exposition
+        )
+
+    @patch("urllib.request.urlopen")
+    def test_given_hook_when_commit_then_metrics_are_pushed_to_the_hub(self, patched_urlopen):
+        self.harness.charm.on.config_changed.emit()
+
+        self.harness.framework.commit()
+
+        request = patched_urlopen.call_args.args[0]
+        self.assertEqual(request.full_url, "http://localhost:9091/metrics")
+        self.assertEqual(request.get_method(), "POST")
+        self.assertIn('api="pebble",call="add_layer"} 1', request.data.decode())
+
+    @patch("charm.KubernetesServicePatch", lambda x, y, **kwargs: None)
+    def test_given_hook_runs_hook_tools_when_exposition_then_calls_are_counted_by_tool(self):
+        harness = Harness(PrometheusEdgeHubCharm)
+        self.addCleanup(harness.cleanup)
+        harness._backend._run = MagicMock(return_value="")
+        harness.begin()
+
+        harness.charm.model._backend._run("status-get", "--format=json")
+        harness.charm.model._backend._run("status-get", "--format=json")
+
+        self.assertIn(
+            'api="juju",call="status-get"} 2', harness.charm._instrumentation.exposition()
+        )
+
+    @patch("lightkube.Client")
+    def test_given_kubernetes_client_when_called_then_calls_are_counted(self, patched_client):
+        get = patched_client.return_value.get
+        client = self.instrumentation.kubernetes_client()
+
+        client.get("Service", "prometheus-edge-hub")
+
+        get.assert_called_once_with("Service", "prometheus-edge-hub")
+        self.assertIn('api="kubernetes",call="get"} 1', self.instrumentation.exposition())
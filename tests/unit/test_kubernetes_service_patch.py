@@ -0,0 +1,87 @@
+# Copyright 2022 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+import unittest
+from unittest.mock import MagicMock, PropertyMock, patch
+
+from charms.observability_libs.v1.kubernetes_service_patch import KubernetesServicePatch
+from lightkube.models.core_v1 import ServicePort
+from ops.charm import CharmBase
+from ops.testing import Harness
+
+METADATA = """
+name: service-patch-tester
+"""
+
+
+class ServicePatchCharm(CharmBase):
+    new_client = None
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.port = 9091
+        self.service_patcher = KubernetesServicePatch(
+            self,
+            lambda: [ServicePort(name="tester", port=self.port)],
+            refresh_event=self.on.config_changed,
+            client=self.new_client,
+        )
+
+
+@patch.object(KubernetesServicePatch, "_namespace", PropertyMock(return_value="edge"))
+@patch.object(KubernetesServicePatch, "_is_patched", lambda *_: False)
+@patch("lightkube.Client")
+class TestKubernetesServicePatch(unittest.TestCase):
+    def setUp(self):
+        self.harness = Harness(ServicePatchCharm, meta=METADATA)
+        self.addCleanup(self.harness.cleanup)
+        self.harness.begin()
+
+    def test_given_unit_is_not_leader_when_install_then_service_is_not_patched(self, client):
+        self.harness.charm.on.install.emit()
+
+        client.assert_not_called()
+
+    def test_given_spec_already_applied_when_refresh_event_then_api_is_not_contacted(self, client):
+        self.harness.set_leader(True)
+        self.harness.charm.on.install.emit()
+        client.reset_mock()
+
+        self.harness.charm.on.config_changed.emit()
+
+        client.assert_not_called()
+
+    def test_given_spec_changed_when_refresh_event_then_service_is_patched(self, client):
+        self.harness.set_leader(True)
+        self.harness.charm.on.install.emit()
+        client.reset_mock()
+        self.harness.charm.port = 9092
+        self.harness.charm.service_patcher._service = None
+
+        self.harness.charm.on.config_changed.emit()
+
+        client.return_value.patch.assert_called_once()
+
+    def test_given_spec_already_applied_when_upgrade_charm_then_service_is_patched(self, client):
+        self.harness.set_leader(True)
+        self.harness.charm.on.install.emit()
+        client.reset_mock()
+
+        self.harness.charm.on.upgrade_charm.emit()
+
+        client.return_value.patch.assert_called_once()
+
+    def test_given_client_callable_when_install_then_service_is_patched_with_its_client(
+        self, client
+    ):
+        new_client = MagicMock()
+        with patch.object(ServicePatchCharm, "new_client", new_client):
+            harness = Harness(ServicePatchCharm, meta=METADATA)
+            self.addCleanup(harness.cleanup)
+            harness.begin()
+        harness.set_leader(True)
+
+        harness.charm.on.install.emit()
+
+        new_client.return_value.patch.assert_called_once()
+        client.assert_not_called()
@@ -0,0 +1,115 @@
+# Copyright 2022 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+import json
+import unittest
+
+from charms.prometheus_k8s.v0.prometheus_scrape import MetricsEndpointAggregator
+from ops.charm import CharmBase
+from ops.testing import Harness
+
+METADATA = """
+name: cos-proxy
+provides:
+  downstream-prometheus-scrape:
+    interface: prometheus_scrape
+requires:
+  prometheus-target:
+    interface: http
+  prometheus-rules:
+    interface: prometheus-rules
+"""
+
+RULES = """
+- alert: CPUOverUse
+  expr: process_cpu_seconds_total > 0.12
+  labels:
+    severity: Low
+"""
+
+
+class AggregatorCharm(CharmBase):
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.aggregator = MetricsEndpointAggregator(
+            self,
+            {
+                "prometheus": "downstream-prometheus-scrape",
+                "scrape_target": "prometheus-target",
+                "alert_rules": "prometheus-rules",
+            },
+        )
+
+
+class TestMetricsEndpointAggregator(unittest.TestCase):
+    def setUp(self):
+        self.harness = Harness(AggregatorCharm, meta=METADATA)
+        self.addCleanup(self.harness.cleanup)
+        self.harness.set_model_name("edge")
+        self.harness.set_leader(True)
+        self.harness.begin()
+        self.prometheus_id = self.harness.add_relation("downstream-prometheus-scrape", "prom")
+        self.harness.add_relation_unit(self.prometheus_id, "prom/0")
+
+    def add_target(self, app_name: str, units: int) -> int:
+        relation_id = self.harness.add_relation("prometheus-target", app_name)
+        for index in range(units):
+            unit_name = f"{app_name}/{index}"
+            self.harness.add_relation_unit(relation_id, unit_name)
+            self.harness.update_relation_data(
+                relation_id, unit_name, {"hostname": f"{app_name}-{index}", "port": "9100"}
+            )
+        return relation_id
+
+    def published(self, relation_id=None) -> dict:
+        data = self.harness.get_relation_data(relation_id or self.prometheus_id, "cos-proxy")
+        return {"scrape_jobs": json.loads(data["scrape_jobs"]), "alert_rules": data["alert_rules"]}
+
+    def static_targets(self) -> dict:
+        return {
+            job["job_name"].split("_")[-3]: sorted(
+                target for config in job["static_configs"] for target in config["targets"]
+            )
+            for job in self.published()["scrape_jobs"]
+        }
+
+    def test_given_targets_changed_when_published_then_each_application_has_its_job(self):
+        self.add_target("node", 2)
+        self.add_target("mysql", 1)
+
+        self.assertEqual(
+            self.static_targets(),
+            {"node": ["node-0:9100", "node-1:9100"], "mysql": ["mysql-0:9100"]},
+        )
+
+    def test_given_unit_departs_when_published_then_only_its_target_is_removed(self):
+        node_id = self.add_target("node", 2)
+        mysql_id = self.add_target("mysql", 1)
+
+        self.harness.remove_relation_unit(node_id, "node/1")
+        self.harness.remove_relation_unit(mysql_id, "mysql/0")
+
+        self.assertEqual(self.static_targets(), {"node": ["node-0:9100"]})
+
+    def test_given_alert_rules_when_unit_departs_then_its_rules_are_removed(self):
+        relation_id = self.harness.add_relation("prometheus-rules", "node")
+        for unit_name in ("node/0", "node/1"):
+            self.harness.add_relation_unit(relation_id, unit_name)
+            self.harness.update_relation_data(relation_id, unit_name, {"groups": RULES})
+        rules = json.loads(self.published()["alert_rules"])["groups"][0]["rules"]
+        self.assertEqual([rule["labels"]["juju_unit"] for rule in rules], ["node/0", "node/1"])
+
+        self.harness.remove_relation_unit(relation_id, "node/0")
+        rules = json.loads(self.published()["alert_rules"])["groups"][0]["rules"]
+        self.assertEqual([rule["labels"]["juju_unit"] for rule in rules], ["node/1"])
+
+        self.harness.remove_relation_unit(relation_id, "node/1")
+        self.assertEqual(self.published()["alert_rules"], "{}")
+
+    def test_given_stored_jobs_when_new_prometheus_joins_then_it_gets_them(self):
+        self.add_target("node", 1)
+
+        relation_id = self.harness.add_relation("downstream-prometheus-scrape", "other-prom")
+        self.harness.add_relation_unit(relation_id, "other-prom/0")
+
+        self.assertEqual(self.published(relation_id), self.published())
@@ -0,0 +1,249 @@
+# Copyright 2022 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+import json
+import unittest
+from unittest.mock import patch
+
+from charms.prometheus_k8s.v0.prometheus_scrape import (
+    COMPACT_ENCODING,
+    SUPPORTED_ENCODINGS_KEY,
+    MetricsEndpointConsumer,
+    PromqlTransformer,
+    _compact_dumps,
+)
+from ops.charm import CharmBase
+from ops.testing import Harness
+
+METADATA = """
+name: prometheus-k8s
+requires:
+  metrics-endpoint:
+    interface: prometheus_scrape
+"""
+
+
+def scrape_metadata(app_name: str) -> str:
+    return json.dumps(
+        {
+            "model": "edge",
+            "model_uuid": "f2c1b2a8-0e0f-4b5f-9c1a-3d2f0c4b5a6e",
+            "application": app_name,
+            "unit": f"{app_name}/0",
+            "charm_name": "prometheus-edge-hub",
+        }
+    )
+
+
+SCRAPE_JOBS = json.dumps(
+    [{"metrics_path": "/metrics", "static_configs": [{"targets": ["*:9091"]}]}]
+)
+
+
+def alert_rules(app_name: str, expr: str = "up < 1") -> str:
+    return json.dumps(
+        {
+            "groups": [
+                {
+                    "name": f"{app_name}_alerts",
+                    "rules": [
+                        {
+                            "alert": "HubDown",
+                            "expr": expr,
+                            "labels": {"juju_model": "edge", "juju_application": app_name},
+                        }
+                    ],
+                }
+            ]
+        }
+    )
+
+
+class ConsumerCharm(CharmBase):
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.metrics_consumer = MetricsEndpointConsumer(self)
+
+
+class TestMetricsEndpointConsumer(unittest.TestCase):
+    def setUp(self):
+        self.harness = Harness(ConsumerCharm, meta=METADATA)
+        self.addCleanup(self.harness.cleanup)
+        self.harness.begin()
+        self.relation_ids = {}
+        for app_name in ("hub-a", "hub-b"):
+            relation_id = self.harness.add_relation("metrics-endpoint", app_name)
+            self.harness.add_relation_unit(relation_id, f"{app_name}/0")
+            self.update_alert_rules(relation_id, app_name, alert_rules(app_name))
+            self.relation_ids[app_name] = relation_id
+            self.update_unit_address(app_name, f"10.0.0.{len(self.relation_ids)}")
+
+    def update_alert_rules(self, relation_id: int, app_name: str, rules: str):
+        self.harness.update_relation_data(
+            relation_id,
+            app_name,
+            {
+                "scrape_metadata": scrape_metadata(app_name),
+                "scrape_jobs": SCRAPE_JOBS,
+                "alert_rules": rules,
+            },
+        )
+
+    def update_unit_address(self, app_name: str, address: str):
+        self.harness.update_relation_data(
+            self.relation_ids[app_name],
+            f"{app_name}/0",
+            {"prometheus_scrape_unit_address": address},
+        )
+
+    def test_given_unchanged_relations_when_alerts_then_rules_are_not_transformed_again(self):
+        alerts = self.harness.charm.metrics_consumer.alerts()
+
+        with patch.object(PromqlTransformer, "apply_label_matchers") as patched_apply:
+            self.assertEqual(self.harness.charm.metrics_consumer.alerts(), alerts)
+
+        patched_apply.assert_not_called()
+
+    def test_given_one_relation_changed_when_alerts_then_only_its_rules_are_transformed_again(
+        self,
+    ):
+        self.harness.charm.metrics_consumer.alerts()
+        self.update_alert_rules(
+            self.relation_ids["hub-b"], "hub-b", alert_rules("hub-b", expr="absent(up)")
+        )
+
+        with patch.object(
+            PromqlTransformer, "apply_label_matchers", side_effect=lambda rules: rules
+        ) as patched_apply:
+            alerts = self.harness.charm.metrics_consumer.alerts()
+
+        patched_apply.assert_called_once()
+        self.assertEqual(len(alerts), 2)
+        expressions = sorted(
+            group["rules"][0]["expr"] for rules in alerts.values() for group in rules["groups"]
+        )
+        self.assertEqual(
+            expressions,
+            ["absent(up)", 'up{juju_model="edge",juju_application="hub-a"} < 1'],
+        )
+
+    def test_given_library_upgraded_when_alerts_then_rules_are_transformed_again(self):
+        self.harness.charm.metrics_consumer.alerts()
+
+        with patch("charms.prometheus_k8s.v0.prometheus_scrape.LIBPATCH", 1000), patch.object(
+            PromqlTransformer, "apply_label_matchers", side_effect=lambda rules: rules
+        ) as patched_apply:
+            self.harness.charm.metrics_consumer.alerts()
+
+        self.assertEqual(patched_apply.call_count, 2)
+
+    def test_given_relation_removed_when_alerts_then_its_rules_are_dropped(self):
+        self.harness.charm.metrics_consumer.alerts()
+
+        self.harness.remove_relation(self.relation_ids["hub-a"])
+
+        self.assertEqual(len(self.harness.charm.metrics_consumer.alerts()), 1)
+        self.assertEqual(len(self.harness.charm.metrics_consumer._stored.alerts), 1)
+
+    def test_given_unchanged_relations_when_jobs_then_scrape_configs_are_not_built_again(self):
+        jobs = self.harness.charm.metrics_consumer.jobs()
+
+        with patch.object(MetricsEndpointConsumer, "_static_scrape_config") as patched_config:
+            self.assertEqual(self.harness.charm.metrics_consumer.jobs(), jobs)
+
+        patched_config.assert_not_called()
+
+    def test_given_library_upgraded_when_jobs_then_scrape_configs_are_built_again(self):
+        self.harness.charm.metrics_consumer.jobs()
+
+        with patch("charms.prometheus_k8s.v0.prometheus_scrape.LIBPATCH", 1000), patch.object(
+            MetricsEndpointConsumer, "_static_scrape_config", return_value=[]
+        ) as patched_config:
+            self.harness.charm.metrics_consumer.jobs()
+
+        self.assertEqual(patched_config.call_count, 2)
+
+    def test_given_unit_address_changed_when_jobs_then_only_its_relation_is_built_again(self):
+        self.harness.charm.metrics_consumer.jobs()
+        self.update_unit_address("hub-a", "10.0.0.9")
+
+        with patch.object(
+            MetricsEndpointConsumer,
+            "_static_scrape_config",
+            autospec=True,
+            side_effect=MetricsEndpointConsumer._static_scrape_config,
+        ) as patched_config:
+            jobs = self.harness.charm.metrics_consumer.jobs()
+
+        patched_config.assert_called_once()
+        targets = sorted(
+            target
+            for job in jobs
+            for config in job["static_configs"]
+            for target in config["targets"]
+        )
+        self.assertEqual(targets, ["10.0.0.2:9091", "10.0.0.9:9091"])
+
+    def test_given_same_unit_address_set_again_when_relation_changed_then_event_is_suppressed(
+        self,
+    ):
+        consumer = self.harness.charm.metrics_consumer
+        self.update_unit_address("hub-a", "10.0.0.9")
+
+        with patch.object(consumer.on, "targets_changed") as patched_targets_changed:
+            self.harness.charm.on["metrics-endpoint"].relation_changed.emit(
+                self.harness.model.get_relation("metrics-endpoint", self.relation_ids["hub-a"]),
+                self.harness.model.get_app("hub-a"),
+                self.harness.model.get_unit("hub-a/0"),
+            )
+
+        patched_targets_changed.emit.assert_not_called()
+        self.assertEqual(consumer.suppressed_events, 1)
+
+    def test_given_reencoded_alert_rules_when_relation_changed_then_event_is_suppressed(self):
+        consumer = self.harness.charm.metrics_consumer
+        rules = json.dumps(json.loads(alert_rules("hub-b")), indent=2)
+
+        with patch.object(consumer.on, "targets_changed") as patched_targets_changed:
+            self.update_alert_rules(self.relation_ids["hub-b"], "hub-b", rules)
+            self.update_alert_rules(
+                self.relation_ids["hub-b"], "hub-b", alert_rules("hub-b", expr="absent(up)")
+            )
+
+        patched_targets_changed.emit.assert_called_once_with(
+            relation_id=self.relation_ids["hub-b"]
+        )
+        self.assertEqual(consumer.suppressed_events, 1)
+
+    def test_given_known_unit_addresses_when_jobs_in_a_new_hook_then_unit_data_is_not_read(self):
+        consumer = self.harness.charm.metrics_consumer
+        jobs = consumer.jobs()
+        # a new hook starts with a new charm instance, and a clean relation data cache
+        consumer._snapshots.clear()
+        self.harness.model.relations._invalidate("metrics-endpoint")
+
+        backend = self.harness._backend
+        with patch.object(backend, "relation_get", wraps=backend.relation_get) as patched_get:
+            self.assertEqual(consumer.jobs(), jobs)
+
+        read = sorted(call.args[1] for call in patched_get.call_args_list)
+        self.assertEqual(read, ["hub-a", "hub-b"])
+
+    def test_given_leader_when_provider_joins_then_compact_encoding_is_advertised(self):
+        self.harness.set_leader(True)
+        relation_id = self.harness.add_relation("metrics-endpoint", "hub-c")
+        self.harness.add_relation_unit(relation_id, "hub-c/0")
+
+        data = self.harness.get_relation_data(relation_id, "prometheus-k8s")
+        self.assertEqual(json.loads(data[SUPPORTED_ENCODINGS_KEY]), [COMPACT_ENCODING])
+
+    def test_given_compact_encoded_scrape_jobs_when_jobs_then_they_are_decoded(self):
+        jobs = self.harness.charm.metrics_consumer.jobs()
+
+        self.harness.update_relation_data(
+            self.relation_ids["hub-a"],
+            "hub-a",
+            {"scrape_jobs": _compact_dumps(SCRAPE_JOBS)},
+        )
+
+        self.assertEqual(self.harness.charm.metrics_consumer.jobs(), jobs)
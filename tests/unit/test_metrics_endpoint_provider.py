@@ -0,0 +1,57 @@
+# Copyright 2022 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+import unittest
+from unittest.mock import patch
+
+from ops.testing import Harness
+
+from charm import PrometheusEdgeHubCharm
+
+
+class TestMetricsEndpointProvider(unittest.TestCase):
+    @patch("charm.KubernetesServicePatch", lambda x, y, **kwargs: None)
+    def setUp(self):
+        self.harness = Harness(PrometheusEdgeHubCharm)
+        self.addCleanup(self.harness.cleanup)
+        hub_ready_timeout = patch("charm.HUB_READY_TIMEOUT", 0)
+        hub_ready_timeout.start()
+        self.addCleanup(hub_ready_timeout.stop)
+        self.harness.add_relation("replicas", "prometheus-edge-hub")
+        self.harness.set_leader(True)
+        self.harness.begin()
+        self.harness.set_can_connect("prometheus-edge-hub", True)
+        self.relation_id = self.harness.add_relation("metrics-endpoint", "prometheus-k8s")
+        self.harness.add_relation_unit(self.relation_id, "prometheus-k8s/0")
+        self.provider = self.harness.charm.metrics_endpoint_provider
+
+    def written_keys(self, emit) -> list:
+        backend = self.harness._backend
+        with patch.object(
+            backend, "update_relation_data", wraps=backend.update_relation_data
+        ) as patched_update:
+            emit()
+        return [call.args[2] for call in patched_update.call_args_list]
+
+    def test_given_unchanged_spec_when_scrape_job_spec_set_again_then_nothing_is_written(self):
+        self.assertEqual(self.written_keys(lambda: self.provider._set_scrape_job_spec(None)), [])
+
+    def test_given_unchanged_address_when_refresh_event_then_unit_data_is_not_written(self):
+        written = self.written_keys(
+            lambda: self.harness.container_pebble_ready("prometheus-edge-hub")
+        )
+
+        self.assertNotIn("prometheus_scrape_unit_address", written)
+        self.assertNotIn("prometheus_scrape_unit_name", written)
+
+    def test_given_changed_jobs_when_update_scrape_job_spec_then_only_jobs_are_written(self):
+        jobs = [{"static_configs": [{"targets": ["*:9999"]}]}]
+
+        self.assertEqual(
+            self.written_keys(lambda: self.provider.update_scrape_job_spec(jobs)),
+            ["scrape_jobs"],
+        )
+        self.assertIn(
+            "*:9999",
+            self.harness.get_relation_data(self.relation_id, "prometheus-edge-hub")["scrape_jobs"],
+        )
@@ -0,0 +1,127 @@
+# Copyright 2022 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+import os
+import re
+import shutil
+import subprocess
+import unittest
+from typing import FrozenSet, List, Tuple
+
+from charms.prometheus_k8s.v0.prometheus_scrape import (
+    PromqlTransformer,
+    _inject_label_matchers,
+)
+
+# the promql-transform binary the corpus is checked against, which the CI conformance job
+# downloads and points PROMQL_TRANSFORM_BINARY at
+PROMQL_TRANSFORM = os.environ.get("PROMQL_TRANSFORM_BINARY") or shutil.which("promql-transform")
+TOPOLOGY = {"juju_model": "edge", "juju_application": "hub"}
+INJECTED = {'juju_model="edge"', 'juju_application="hub"'}
+
+# Expressions and the selectors the promql-transform binary leaves in them, as
+# (metric name, label matchers) pairs. They are written by hand, so the conformance test below
+# checks the same corpus against the binary itself, which the CI conformance job always runs
+CORPUS = [
+    ("up == 0", [("up", INJECTED)]),
+    ('up{job="hub"} < 1', [("up", INJECTED | {'job="hub"'})]),
+    ('absent(up{job="hub",})', [("up", INJECTED | {'job="hub"'})]),
+    ('{__name__="up"}', [("", INJECTED | {'__name__="up"'})]),
+    (
+        'sum by (job) (rate(http_requests_total{code=~"5.."}[5m]))'
+        " / sum without(instance) (rate(http_requests_total[5m]))",
+        [
+            ("http_requests_total", INJECTED | {'code=~"5.."'}),
+            ("http_requests_total", INJECTED),
+        ],
+    ),
+    ("avg_over_time(up[1h:5m] offset 1d) > bool 0.5", [("up", INJECTED)]),
+    ("up offset -5m @ start()", [("up", INJECTED)]),
+    (
+        "histogram_quantile(0.99, sum(rate(latency_bucket[5m])) by (le))",
+        [("latency_bucket", INJECTED)],
+    ),
+    (
+        "node_load1 * on(instance) group_left(nodename) node_uname_info",
+        [("node_load1", INJECTED), ("node_uname_info", INJECTED)],
+    ),
+    (
+        'label_replace(up, "dst", "$1", "src", "(.*)")',
+        [("up", INJECTED)],
+    ),
+    ("topk(5, node:cpu:rate5m) > 0x1f", [("node:cpu:rate5m", INJECTED)]),
+    ("count(up) > Inf", [("up", INJECTED)]),
+    ('up{instance!~"foo,bar"} # not {this}', [("up", INJECTED | {'instance!~"foo,bar"'})]),
+    ("time() - process_start_time_seconds > 3600", [("process_start_time_seconds", INJECTED)]),
+    ('vector(1) and on() absent(up{job="x"})', [("up", INJECTED | {'job="x"'})]),
+]
+
+SELECTOR = re.compile(r'([a-zA-Z_:][a-zA-Z0-9_:]*)?\{((?:[^}"]|"(?:[^"\\]|\\.)*")*)\}')
+MATCHER = re.compile(r'([a-zA-Z_][a-zA-Z0-9_]*)\s*(=~|!~|!=|=)\s*("(?:[^"\\]|\\.)*")')
+
+
+def selectors(expression: str) -> List[Tuple[str, FrozenSet[str]]]:
+    """Selectors of an expression whose selectors all have braces, e.g. after injection."""
+    expression = re.sub(r"#[^\n]*", "", expression)
+    return [
+        (name or "", frozenset("".join(m) for m in MATCHER.findall(matchers)))
+        for name, matchers in SELECTOR.findall(expression)
+    ]
+
+
+class TestPromqlTransform(unittest.TestCase):
+    def test_given_corpus_when_inject_label_matchers_then_selectors_match_the_binary(self):
+        for expression, expected in CORPUS:
+            with self.subTest(expression=expression):
+                transformed = _inject_label_matchers(expression, tuple(TOPOLOGY.items()))
+
+                self.assertEqual(
+                    selectors(transformed), [(name, frozenset(m)) for name, m in expected]
+                )
+
+    @unittest.skipUnless(PROMQL_TRANSFORM, "promql-transform is not installed")
+    def test_given_corpus_when_inject_label_matchers_then_output_matches_live_binary(self):
+        for expression, _ in CORPUS:
+            with self.subTest(expression=expression):
+                args = [str(PROMQL_TRANSFORM)]
+                args += ["--label-matcher={}={}".format(k, v) for k, v in TOPOLOGY.items()]
+                binary = subprocess.run(
+                    args + [expression], check=True, stdout=subprocess.PIPE, text=True
+                ).stdout.strip()
+
+                transformed = _inject_label_matchers(expression, tuple(TOPOLOGY.items()))
+
+                self.assertEqual(selectors(transformed), selectors(binary))
+
+    def test_given_rules_when_apply_label_matchers_then_expressions_are_rewritten(self):
+        rules = {
+            "groups": [
+                {
+                    "name": "hub",
+                    "rules": [{"alert": "HubDown", "expr": "up < 1", "labels": dict(TOPOLOGY)}],
+                }
+            ]
+        }
+
+        PromqlTransformer(None).apply_label_matchers(rules)
+
+        self.assertEqual(
+            rules["groups"][0]["rules"][0]["expr"],
+            'up{juju_model="edge",juju_application="hub"} < 1',
+        )
+
+    def test_given_same_expression_and_topology_when_transformed_again_then_result_is_memoized(
+        self,
+    ):
+        transformer = PromqlTransformer(None)
+        transformer._apply_label_matcher("memoized_metric > 1", TOPOLOGY)
+        hits = _inject_label_matchers.cache_info().hits
+
+        transformer._apply_label_matcher("memoized_metric > 1", TOPOLOGY)
+
+        self.assertEqual(_inject_label_matchers.cache_info().hits, hits + 1)
+
+    def test_given_invalid_expression_when_transformed_then_expression_is_unchanged(self):
+        self.assertEqual(
+            PromqlTransformer(None)._apply_label_matcher("sum(up", TOPOLOGY), "sum(up"
+        )
@@ -0,0 +1,136 @@
+# Copyright 2022 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+import json
+import unittest
+
+from charms.prometheus_edge_hub.v0.push_endpoint import (
+    DEFAULT_VNODES,
+    HashRing,
+    PushEndpointRequirer,
+    PushRouter,
+)
+from ops.charm import CharmBase
+from ops.testing import Harness
+
+REQUIRER_METADATA = """
+name: pusher
+requires:
+  push-endpoint:
+    interface: prometheus_edge_hub_push
+"""
+
+FAMILIES = [f"metric_family_{i}" for i in range(2000)]
+
+
+class PusherCharm(CharmBase):
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.push_endpoint = PushEndpointRequirer(self)
+
+
+class TestHashRing(unittest.TestCase):
+    def test_given_same_nodes_when_ring_built_in_any_order_then_keys_map_to_same_nodes(self):
+        ring = HashRing(["hub/0", "hub/1", "hub/2"])
+        reversed_ring = HashRing(["hub/2", "hub/1", "hub/0"])
+
+        self.assertEqual(
+            [ring.get(family) for family in FAMILIES],
+            [reversed_ring.get(family) for family in FAMILIES],
+        )
+
+    def test_given_three_nodes_when_keys_hashed_then_every_node_owns_a_fair_share(self):
+        ring = HashRing(["hub/0", "hub/1", "hub/2"])
+
+        owners = [ring.get(family) for family in FAMILIES]
+
+        for node in ring.nodes:
+            self.assertGreater(owners.count(node), len(FAMILIES) / 3 * 0.7)
+
+    def test_given_node_added_when_keys_hashed_then_only_keys_moving_to_new_node_change_owner(
+        self,
+    ):
+        ring = HashRing(["hub/0", "hub/1", "hub/2"])
+        before = {family: ring.get(family) for family in FAMILIES}
+
+        ring.add("hub/3")
+
+        moved = [family for family in FAMILIES if ring.get(family) != before[family]]
+        self.assertTrue(moved)
+        self.assertTrue(all(ring.get(family) == "hub/3" for family in moved))
+
+    def test_given_node_removed_when_keys_hashed_then_only_its_keys_change_owner(self):
+        ring = HashRing(["hub/0", "hub/1", "hub/2"])
+        before = {family: ring.get(family) for family in FAMILIES}
+
+        ring.remove("hub/1")
+
+        for family in FAMILIES:
+            if before[family] != "hub/1":
+                self.assertEqual(ring.get(family), before[family])
+            else:
+                self.assertIn(ring.get(family), ["hub/0", "hub/2"])
+
+    def test_given_empty_ring_when_key_hashed_then_no_node_is_returned(self):
+        self.assertIsNone(HashRing().get("up"))
+
+
+class TestPushEndpointRequirer(unittest.TestCase):
+    def setUp(self):
+        self.harness = Harness(PusherCharm, meta=REQUIRER_METADATA)
+        self.addCleanup(self.harness.cleanup)
+        self.harness.begin()
+
+    def test_given_hub_units_published_endpoints_when_router_built_then_families_route_to_them(
+        self,
+    ):
+        relation_id = self.harness.add_relation("push-endpoint", "prometheus-edge-hub")
+        self.harness.update_relation_data(
+            relation_id, "prometheus-edge-hub", {"hash_ring": json.dumps({"vnodes": 16})}
+        )
+        for i in range(2):
+            unit_name = f"prometheus-edge-hub/{i}"
+            self.harness.add_relation_unit(relation_id, unit_name)
+            self.harness.update_relation_data(
+                relation_id,
+                unit_name,
+                {
+                    "push_endpoint": json.dumps(
+                        {
+                            "unit": unit_name,
+                            "http": f"http://hub-{i}:9091",
+                            "grpc": f"hub-{i}:9092",
+                        }
+                    )
+                },
+            )
+
+        router = self.harness.charm.push_endpoint.router()
+
+        expected_router = PushRouter(self.harness.charm.push_endpoint.endpoints, vnodes=16)
+        self.assertEqual(
+            sorted(router.endpoints), ["prometheus-edge-hub/0", "prometheus-edge-hub/1"]
+        )
+        for family in FAMILIES[:100]:
+            self.assertEqual(router.route(family), expected_router.route(family))
+
+    def test_given_invalid_hash_ring_when_vnodes_read_then_default_is_used(self):
+        relation_id = self.harness.add_relation("push-endpoint", "prometheus-edge-hub")
+        for hash_ring in ("{", "[]", '{"vnodes": "many"}', '{"vnodes": null}', '{"vnodes": 0}'):
+            with self.subTest(hash_ring=hash_ring):
+                self.harness.update_relation_data(
+                    relation_id, "prometheus-edge-hub", {"hash_ring": hash_ring}
+                )
+
+                self.assertEqual(self.harness.charm.push_endpoint.vnodes, DEFAULT_VNODES)
+
+    def test_given_invalid_push_endpoint_when_endpoints_read_then_unit_is_skipped(self):
+        relation_id = self.harness.add_relation("push-endpoint", "prometheus-edge-hub")
+        self.harness.add_relation_unit(relation_id, "prometheus-edge-hub/0")
+        for push_endpoint in ("{", "[]", "null", "1"):
+            with self.subTest(push_endpoint=push_endpoint):
+                self.harness.update_relation_data(
+                    relation_id, "prometheus-edge-hub/0", {"push_endpoint": push_endpoint}
+                )
+
+                self.assertEqual(self.harness.charm.push_endpoint.endpoints, {})
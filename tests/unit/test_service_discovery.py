@@ -0,0 +1,123 @@
+# Copyright 2022 Canonical Ltd.
+# See LICENSE file for licensing details.
+
+import json
+import unittest
+import urllib.error
+import urllib.request
+
+from charms.prometheus_k8s.v0.prometheus_scrape import (
+    MetricsEndpointConsumer,
+    TargetGroupServer,
+)
+from ops.charm import CharmBase
+from ops.testing import Harness
+
+METADATA = """
+name: prometheus-k8s
+requires:
+  metrics-endpoint:
+    interface: prometheus_scrape
+"""
+
+SCRAPE_METADATA = json.dumps(
+    {
+        "model": "edge",
+        "model_uuid": "f2c1b2a8-0e0f-4b5f-9c1a-3d2f0c4b5a6e",
+        "application": "hub",
+        "unit": "hub/0",
+        "charm_name": "prometheus-edge-hub",
+    }
+)
+SCRAPE_JOBS = json.dumps(
+    [
+        {"job_name": "edge", "static_configs": [{"targets": ["*:9091", "gateway:9091"]}]},
+        {"job_name": "external", "static_configs": [{"targets": ["gateway:9100"]}]},
+    ]
+)
+JOB_NAME = "juju_edge_f2c1b2a8-0e0f-4b5f-9c1a-3d2f0c4b5a6e_hub_prometheus-edge-hub_prometheus_scrape_edge"  # noqa: E501
+
+
+class ConsumerCharm(CharmBase):
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.metrics_consumer = MetricsEndpointConsumer(self)
+
+
+class TestServiceDiscovery(unittest.TestCase):
+    def setUp(self):
+        self.harness = Harness(ConsumerCharm, meta=METADATA)
+        self.addCleanup(self.harness.cleanup)
+        self.harness.begin()
+        self.relation_id = self.harness.add_relation("metrics-endpoint", "hub")
+        self.harness.update_relation_data(
+            self.relation_id,
+            "hub",
+            {"scrape_metadata": SCRAPE_METADATA, "scrape_jobs": SCRAPE_JOBS},
+        )
+        self.add_unit(0)
+        self.consumer = self.harness.charm.metrics_consumer
+
+    def add_unit(self, index: int):
+        unit_name = f"hub/{index}"
+        self.harness.add_relation_unit(self.relation_id, unit_name)
+        self.harness.update_relation_data(
+            self.relation_id,
+            unit_name,
+            {
+                "prometheus_scrape_unit_name": unit_name,
+                "prometheus_scrape_unit_address": f"10.0.0.{index}",
+            },
+        )
+
+    def test_given_jobs_when_sd_jobs_then_only_unit_targets_are_discovered(self):
+        jobs = {job["job_name"]: job for job in self.consumer.sd_jobs(file_sd_dir="/etc/sd")}
+
+        self.assertEqual(
+            jobs[JOB_NAME]["file_sd_configs"], [{"files": [f"/etc/sd/{JOB_NAME}.json"]}]
+        )
+        self.assertEqual(
+            [config["targets"] for config in jobs[JOB_NAME]["static_configs"]],
+            [["gateway:9091"]],
+        )
+        self.assertIn("juju_unit", jobs[JOB_NAME]["relabel_configs"][-1]["source_labels"])
+        external = jobs[JOB_NAME.rsplit("_", 1)[0] + "_external"]
+        self.assertEqual(external["static_configs"][0]["targets"], ["gateway:9100"])
+
+    def test_given_unit_joins_when_sd_jobs_then_only_target_groups_change(self):
+        jobs = self.consumer.sd_jobs(http_sd_url="http://localhost:8080/")
+        groups = self.consumer.target_groups()
+
+        self.add_unit(1)
+
+        self.assertEqual(self.consumer.sd_jobs(http_sd_url="http://localhost:8080/"), jobs)
+        self.assertEqual(
+            jobs[0]["http_sd_configs"], [{"url": f"http://localhost:8080/{JOB_NAME}"}]
+        )
+        self.assertEqual(len(groups[JOB_NAME]), 1)
+        groups = self.consumer.target_groups()[JOB_NAME]
+        self.assertEqual(
+            [group["targets"] for group in groups], [["10.0.0.0:9091"], ["10.0.0.1:9091"]]
+        )
+        self.assertEqual(groups[1]["labels"]["juju_unit"], "hub/1")
+
+    def test_given_no_or_both_destinations_when_sd_jobs_then_value_error_is_raised(self):
+        with self.assertRaises(ValueError):
+            self.consumer.sd_jobs()
+        with self.assertRaises(ValueError):
+            self.consumer.sd_jobs(http_sd_url="http://localhost", file_sd_dir="/etc/sd")
+
+    def test_given_target_groups_when_served_then_prometheus_can_fetch_them(self):
+        server = TargetGroupServer(host="127.0.0.1")
+        server.start()
+        self.addCleanup(server.stop)
+        server.update(self.consumer.target_groups())
+
+        url = self.consumer.sd_jobs(http_sd_url=server.url)[0]["http_sd_configs"][0]["url"]
+        with urllib.request.urlopen(url) as response:
+            self.assertEqual(response.headers["Content-Type"], "application/json")
+            self.assertEqual(json.loads(response.read()), self.consumer.target_groups()[JOB_NAME])
+
+        server.update({})
+        with self.assertRaises(urllib.error.HTTPError):
+            urllib.request.urlopen(url)